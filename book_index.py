@@ -0,0 +1,172 @@
+import os
+import posixpath
+import re
+import threading
+import zipfile
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import unquote
+
+import lxml.html
+from bs4 import BeautifulSoup
+from loguru import logger
+
+# ===================================================================== #
+# 单本书的引用索引：spine顺序、各html的图片引用/class用量/标题候选
+# 打开或解压书籍时一次性并行构建并常驻内存，供图片统计、Class分析、补全后记、章节分割等功能共用，避免各自重复解析
+
+HTML_SUFFIXES = ('.xhtml', '.html', '.htm')
+SAMPLE_LIMIT = 15 # 每个class收集的实例数上限
+LEAD_LINES = 20 # 标题候选取body开头的行数
+BODY_RE = re.compile(r'<body[^>]*>([\s\S]*)$', re.I)
+LEAD_TEXT_RE = re.compile(r'(?=<[^>]+>([^<]*)</[^>]+>)') # 前瞻匹配 与逐位置search等价(相邻标签共用边界也能取到)
+
+def index_html(data, name, want_sample=None):
+    """
+    单个html的索引条目(一次lxml解析+一次文本扫描)
+    name: posix路径(zip内路径或解压后的绝对路径)，图片路径按其所在目录解析、反转义并规范化
+    want_sample(class): 是否收集该class的实例片段(每个文件每个class最多SAMPLE_LIMIT个)，为None则不收集
+    返回 {'counts': {class: 次数}, 'samples': {class: [(文件, 片段)]}, 'class_tags': [(class, 标签)], 'img_counts': {图片路径: 次数},
+          'img_refs': [(标签, 图片路径, 原始引用, class)], 'title': 标题, 'lead_texts': [body前20行内标签的文本]}
+    """
+    entry = {'counts': {}, 'samples': {}, 'class_tags': [], 'img_counts': {}, 'img_refs': [], 'title': '', 'lead_texts': []}
+    try:
+        text = data.decode('utf-8', 'ignore') if isinstance(data, bytes) else data
+        if m := BODY_RE.search(text):
+            entry['lead_texts'] = [t.strip() for t in LEAD_TEXT_RE.findall("\n".join(m.group(1).splitlines()[:LEAD_LINES])) if t.strip()]
+        root = lxml.html.fromstring(data)
+        base_dir = posixpath.dirname(name)
+        if titles := root.xpath('//*[local-name()="title"]'): entry['title'] = titles[0].text_content().strip()
+        # XPath 一次遍历提取class、img、svg image的标签
+        for el in root.xpath('//*[@class] | //img | //*[(local-name()="image")]'):
+            tag = el.tag.rsplit('}', 1)[-1].lower()
+            if tag in ('img', 'image'): # 兼容src、href、xlink:href等属性，跳过http/data等外部引用
+                src = el.get('src') or el.get('href') or el.get('xlink:href') or el.get('{http://www.w3.org/1999/xlink}href')
+                if src and ':' not in src.split('/', 1)[0]:
+                    abs_p = posixpath.normpath(posixpath.join(base_dir, unquote(src.split('#')[0].split('?')[0])))
+                    entry['img_counts'][abs_p] = entry['img_counts'].get(abs_p, 0) + 1
+                    entry['img_refs'].append((tag, abs_p, src, ' '.join((el.get('class') or '').split())))
+            if cls_str := el.get('class'): # img也可能带有class 不使用elif
+                cls_list, s_raw = cls_str.split(), ""
+                if want_sample and any(want_sample(c) for c in cls_list): # 只在需要时生成实例字符串
+                    s_raw = lxml.html.tostring(el, encoding='unicode', method='html', with_tail=False).strip()
+                for c in cls_list:
+                    entry['counts'][c] = entry['counts'].get(c, 0) + 1
+                    entry['class_tags'].append((c, tag))
+                    if s_raw and len(entry['samples'].get(c, [])) < SAMPLE_LIMIT:
+                        entry['samples'].setdefault(c, []).append((name, re.sub(r'\s+', ' ', s_raw)[:150]))
+    except Exception as e:
+        logger.error(f"解析 {name} 出错: {e}")
+    return entry
+
+def compact_entry(entry):
+    """
+    条目压缩为跨进程回传的紧凑结构：class按文件内首次出现顺序编号，计数与首个标签为按编号对齐的数组，逐元素的class_tags不再回传
+    返回 {'names': [class], 'counts': array('I'), 'tags': [首个标签], 'samples': {编号: [(文件, 片段)]}, 'img_counts': {图片路径: 次数}}
+    """
+    ids = {c: i for i, c in enumerate(entry['counts'])}
+    tags = [None] * len(ids)
+    for c, t in entry['class_tags']:
+        if tags[ids[c]] is None: tags[ids[c]] = t
+    return {'names': list(ids), 'counts': array('I', entry['counts'].values()), 'tags': tags,
+            'samples': {ids[c]: s for c, s in entry['samples'].items()}, 'img_counts': entry['img_counts']}
+
+def mp_index_html(args):
+    """worker入口(线程或子进程)：(字节, 文件名, 实例已收满的class集合) -> 紧凑条目，集合外的class才收集实例"""
+    data, name, full = args
+    return compact_entry(index_html(data, name, lambda c: c not in full))
+
+def read_spine(opf_path):
+    """按spine顺序返回html文件路径(不检查是否存在)"""
+    soup = BeautifulSoup(opf_path.read_text('utf-8'), 'xml')
+    m = {it['id']: it['href'] for it in soup.find('manifest').find_all('item')}
+    return [opf_path.parent / href for r in soup.find('spine').find_all('itemref')
+            if (idr := r.get('idref')) and (href := m.get(idr)) and Path(href).suffix.lower() in HTML_SUFFIXES]
+
+class BookIndex:
+    """
+    解压目录的引用索引：条目按文件(修改时间, 大小)校验，文件被改写或新增后按需重新索引；spine按OPF修改时间校验
+    未调用build时为空索引，首次访问各条目时再解析(与直接解析等价)
+    """
+    def __init__(self, root, opf_path):
+        self.root, self.opf_path = Path(root), Path(opf_path)
+        self._entries, self._spine = {}, (None, [])
+
+    @classmethod
+    def build(cls, root, opf_path, workers=8):
+        """线程池并行解析全部html(lxml解析期间释放GIL)并读取spine"""
+        index = cls(root, opf_path)
+        files = [f for f in index.root.rglob('*') if f.suffix.lower() in HTML_SUFFIXES and f.is_file()]
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(files)))) as executor: list(executor.map(index.entry, files))
+        index.spine_files()
+        return index
+
+    def entry(self, path):
+        """文件的最新索引条目，文件不存在返回None"""
+        key = os.path.normpath(path)
+        try: st = os.stat(key)
+        except OSError: return None
+        if (cached := self._entries.get(key)) and cached[0] == (st.st_mtime_ns, st.st_size): return cached[1]
+        entry = index_html(Path(key).read_bytes(), Path(key).as_posix())
+        self._entries[key] = ((st.st_mtime_ns, st.st_size), entry)
+        return entry
+
+    def stats(self):
+        """索引规模 {'html': 已索引的html文件数, 'spine': spine中存在的文件数} (不定义__len__ 空索引也为真值)"""
+        return {'html': len(self._entries), 'spine': len(self.spine_files())}
+
+    def entries(self):
+        """目录内全部html的最新条目 [(路径, 条目)]"""
+        return [(f, e) for f in sorted(self.root.rglob('*')) if f.suffix.lower() in HTML_SUFFIXES and (e := self.entry(f)) is not None]
+
+    def spine_files(self):
+        """按spine顺序排列且存在的html文件"""
+        mtime = self.opf_path.stat().st_mtime_ns
+        if self._spine[0] != mtime: self._spine = (mtime, read_spine(self.opf_path))
+        return [f for f in self._spine[1] if self.exists(f)]
+
+    def exists(self, path):
+        return Path(path).exists()
+
+    def read_text(self, path):
+        return Path(path).read_text('utf-8', 'ignore')
+
+    def lead_match(self, path, keyword):
+        """body前20行内有标签文本包含keyword(标题候选)"""
+        return bool((e := self.entry(path)) and any(keyword in t for t in e['lead_texts']))
+
+class ArchiveBookIndex(BookIndex):
+    """
+    直接读取EPUB压缩包的索引(只读预览用)：root下只需解压OPF/NCX/nav等目录文件，html的存在性、条目与文本都从压缩包按需读取并缓存
+    压缩包在索引存续期间视为不变；读取加锁，可在后台线程中使用
+    """
+    def __init__(self, root, opf_path, epub_path):
+        super().__init__(root, opf_path)
+        self._zip, self._lock, self._texts = zipfile.ZipFile(epub_path), threading.Lock(), {}
+        self._names = set(self._zip.namelist())
+
+    def _member(self, path):
+        """映射目录下的路径 -> 压缩包内的文件名，不在root下返回None"""
+        try: return Path(os.path.normpath(path)).relative_to(os.path.normpath(self.root)).as_posix()
+        except ValueError: return None
+
+    def exists(self, path):
+        return self._member(path) in self._names
+
+    def _read(self, name):
+        with self._lock: return self._zip.read(name)
+
+    def entry(self, path):
+        key = os.path.normpath(path)
+        if (cached := self._entries.get(key)) is not None: return cached
+        if (name := self._member(key)) not in self._names: return None
+        entry = self._entries[key] = index_html(self._read(name), Path(key).as_posix())
+        return entry
+
+    def read_text(self, path):
+        if (key := os.path.normpath(path)) not in self._texts: self._texts[key] = self._read(self._member(key)).decode('utf-8', 'ignore')
+        return self._texts[key]
+
+    def close(self):
+        with self._lock: self._zip.close()
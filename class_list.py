@@ -1,34 +1,210 @@
 import atexit
+import bisect
+import hashlib
+from collections import OrderedDict
 import os
+import pickle
 import re
 import shutil
+import sys
 import tempfile
+import threading
 import time
 import zipfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import tkinter as tk
 from tkinter import ttk, messagebox
-import lxml.html
 from bs4 import BeautifulSoup
 from loguru import logger
 from tkinterdnd2 import DND_FILES
 
+from book_index import SAMPLE_LIMIT, mp_index_html
+from text_index import TextIndex
+from worker_pool import available_cpus, choose_strategy, estimate_cost, make_executor, resolve_backend
+
+FRAME_MS = 50 # 解析期间合并结果刷新到分类树的间隔
+VIRTUAL_ROWS = 1000 # 每个分类一次实体化的行数上限 其余以占位行显示剩余数量
+PREVIEW_CACHE_BYTES = 64 * 2**20 # 预览解码内容LRU的字节预算
+CACHE_VERSION, CACHE_MAX_BOOKS = 1, 200 # 分析缓存的格式版本(解析逻辑变化时递增) 与保留的书籍数上限
+CATEGORY_RULES = [('Class列表', lambda t: True), ('Span列表', lambda t: t == 'span'), ('图片Class列表', lambda t: t == 'img'),
+                  ('非P标签列表', lambda t: t != 'p'), ('非P、img、body标签列表', lambda t: t not in ('p', 'img', 'body'))]
+
+def css_rules(text):
+    """提取css中选择器涉及的class/标签名，返回[(名称, 选择器, 声明块)]"""
+    return [(c, p, re.sub(r';\s*', ';\n  ', b.strip()))
+            for sel, b in re.findall(r'([^{]+)\{([^}]+)\}', re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL))
+            for p in [s.strip() for s in sel.split(',')]
+            for m in re.findall(r'(?:\.([\w-]+))|(?:\b([a-zA-Z1-6]+)\b)', p)
+            for c in m if c]
+
+def user_cache_dir(name):
+    """
+    当前用户私有的缓存目录(Windows: %LOCALAPPDATA%，其他: $XDG_CACHE_HOME 或 ~/.cache)，不存在时以0700创建
+    POSIX下目录不属于当前用户时返回None，属于当前用户但权限过宽时收紧为0700
+    """
+    base = os.environ.get('LOCALAPPDATA') if os.name == 'nt' else os.environ.get('XDG_CACHE_HOME')
+    path = Path(base or Path.home() / ".cache", "sesame-to-ruby", name)
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if os.name != 'nt':
+        if (st := path.stat()).st_uid != os.getuid(): return None
+        if st.st_mode & 0o077: path.chmod(0o700)
+    return path
+
+class AnalysisCache:
+    """
+    Class分析结果的持久化缓存：每本书一个条目文件(按EPUB绝对路径哈希命名)，保存各html/css的解析结果
+    EPUB大小与修改时间未变时整本命中；否则按zip目录中各文件的(CRC32, 大小)逐个校验，只重新解析内容变化的文件
+    条目文件的修改时间即最近使用时间，超过书籍数上限时淘汰最久未用的
+    条目为pickle，只能放在当前用户私有的目录(见user_cache_dir)，不能放在共享的临时目录；root为None时缓存停用
+    """
+    def __init__(self, root, max_books=CACHE_MAX_BOOKS):
+        self.root, self.max_books = root and Path(root), max_books
+
+    def _path(self, epub_path):
+        return self.root / f"{hashlib.sha256(str(Path(epub_path).resolve()).encode()).hexdigest()[:32]}.pkl"
+
+    @staticmethod
+    def _book_sig(epub_path):
+        st = os.stat(epub_path)
+        return st.st_size, st.st_mtime_ns
+
+    def load(self, epub_path, z):
+        """返回 {文件名: 解析结果}，只含仍然有效的条目；z为已打开的EPUB(读取各文件的CRC)"""
+        if not self.root: return {}
+        try:
+            with open(path := self._path(epub_path), 'rb') as f: data = pickle.load(f)
+            if data.get('version') != CACHE_VERSION: return {}
+            os.utime(path)
+        except Exception: return {}
+        if data['book'] == self._book_sig(epub_path): return {n: r for n, (_, r) in data['files'].items()}
+        infos = {i.filename: (i.CRC, i.file_size) for i in z.infolist()}
+        return {n: r for n, (sig, r) in data['files'].items() if infos.get(n) == sig}
+
+    def save(self, epub_path, z, results):
+        """results: {文件名: 解析结果}，签名取自z中各文件的(CRC32, 大小)"""
+        if not self.root: return
+        self._write(self._path(epub_path), {'version': CACHE_VERSION, 'book': self._book_sig(epub_path),
+                                            'files': {n: (((i := z.getinfo(n)).CRC, i.file_size), r) for n, r in results.items()}})
+        for old in sorted(self.root.glob('*.pkl'), key=lambda e: e.stat().st_mtime, reverse=True)[self.max_books:]: old.unlink(missing_ok=True)
+
+    def forget(self, epub_path, names):
+        """EPUB被改写后丢弃指定文件的条目与整本签名，其余条目下次打开时按CRC校验后复用"""
+        if not self.root: return
+        try:
+            with open(path := self._path(epub_path), 'rb') as f: data = pickle.load(f)
+        except Exception: return
+        data['book'] = None; [data['files'].pop(n, None) for n in names]
+        self._write(path, data)
+
+    @staticmethod
+    def _write(path, data): # 写入临时文件后替换 中途失败不留下损坏的条目
+        tmp = path.with_name(f".{path.name}.tmp")
+        with open(tmp, 'wb') as f: pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+class ArchiveReader:
+    """
+    会话内共用的EPUB只读句柄：文件名 -> ZipInfo 索引 + 按字节预算淘汰的解码内容LRU
+    每次访问检查EPUB大小与修改时间，被保存改写后自动重新打开并清空缓存；读取加锁，可在多个线程中使用
+    """
+    def __init__(self, path, budget=PREVIEW_CACHE_BYTES):
+        self.path, self.budget = path, budget
+        self._zip, self._sig, self._infos, self._texts, self._used = None, None, {}, OrderedDict(), 0
+        self._lock = threading.RLock()
+
+    def _ensure(self):
+        st = os.stat(self.path)
+        if self._zip and self._sig == (st.st_size, st.st_mtime_ns): return self._zip
+        self.close()
+        self._zip, self._sig = zipfile.ZipFile(self.path, 'r'), (st.st_size, st.st_mtime_ns)
+        self._infos = {i.filename: i for i in self._zip.infolist()}
+        return self._zip
+
+    def names(self):
+        with self._lock: self._ensure(); return list(self._infos)
+
+    def __contains__(self, name):
+        with self._lock: self._ensure(); return name in self._infos
+
+    def read(self, name):
+        with self._lock: return self._ensure().read(self._infos[name])
+
+    def text(self, name):
+        """utf-8解码后的内容(命中时移到LRU末尾)，超出字节预算时从最久未用的开始淘汰"""
+        with self._lock:
+            self._ensure()
+            if (t := self._texts.get(name)) is not None: self._texts.move_to_end(name); return t
+            t = self._texts[name] = self._zip.read(self._infos[name]).decode('utf-8', 'ignore')
+            self._used += self._infos[name].file_size # 按成员解压后的字节数计入预算
+            while self._used > self.budget and len(self._texts) > 1: self._used -= self._infos[self._texts.popitem(last=False)[0]].file_size
+            return t
+
+    def close(self):
+        """释放句柄(Windows下替换EPUB前必须关闭)，下次访问时重新打开"""
+        with self._lock:
+            if self._zip: self._zip.close()
+            self._zip, self._sig, self._infos, self._used = None, None, {}, 0
+            self._texts.clear()
+
+class VirtualCategory:
+    """
+    分类树中一个分类节点的虚拟化行：只实体化当前排序下的前limit行，其余合计显示在末尾的占位行(双击加载更多)
+    新增条目按排序键二分定位后单次插入，不再整体重排；keys/names按排序键升序保存已实体化的行，倒序时显示顺序相反
+    """
+    def __init__(self, tree, node, limit=VIRTUAL_ROWS):
+        self.tree, self.node, self.limit = tree, node, limit
+        self.keys, self.names, self.iids, self.hidden, self.more = [], [], {}, 0, None
+
+    def reset(self, items, reverse, value_of):
+        """按[(排序键, 名称)]重新实体化(排序/筛选/加载更多时调用)"""
+        [self.tree.delete(iid) for iid in self.iids.values()]
+        shown = sorted(items, reverse=reverse)[:self.limit]
+        for key, name in shown: self.iids[name] = self.tree.insert(self.node, "end", text=name, values=(value_of(name),))
+        self.keys, self.names = [k for k, _ in shown][::-1 if reverse else 1], [n for _, n in shown][::-1 if reverse else 1]
+        self.iids = {n: self.iids[n] for n in self.names}
+        self.hidden = len(items) - len(shown); self._sync_more()
+
+    def add(self, key, name, reverse, value):
+        i = bisect.bisect_left(self.keys, key)
+        if len(self.names) >= self.limit and i == (0 if reverse else len(self.keys)): # 排在已实体化的末行之后
+            self.hidden += 1; return self._sync_more()
+        self.keys.insert(i, key); self.names.insert(i, name)
+        self.iids[name] = self.tree.insert(self.node, len(self.keys) - 1 - i if reverse else i, text=name, values=(value,))
+        if len(self.names) > self.limit:
+            j = 0 if reverse else -1; self.keys.pop(j); self.tree.delete(self.iids.pop(self.names.pop(j))); self.hidden += 1
+        self._sync_more()
+
+    def update(self, name, value):
+        if iid := self.iids.get(name): self.tree.item(iid, values=(value,))
+
+    def _sync_more(self):
+        if self.hidden and not self.more: self.more = self.tree.insert(self.node, "end", tags=('more',))
+        if self.more: self.tree.move(self.more, self.node, "end")
+        if self.hidden: self.tree.item(self.more, text=f"… 另有 {self.hidden} 项 (双击显示更多)")
+        elif self.more: self.tree.delete(self.more); self.more = None
+
 class ClassList:
-    def __init__(self, root, epub_path, get_temp, set_temp, append_temp, workers_cfg='Auto', win_size=None):
+    def __init__(self, root, epub_path, get_temp, set_temp, append_temp, workers_cfg='Auto', win_size=None, backend_cfg='Auto'):
         self.root, self.epub_path = root, epub_path
         self.get_temp_style_content, self.set_temp_style_content, self.append_temp_style_content = get_temp, set_temp, append_temp
-        self.workers_cfg = workers_cfg
+        self.workers_cfg, self.backend_cfg = workers_cfg, backend_cfg
         self.win_size = win_size
         self.style_data, self.samples_data, self.counts_data, self.img_counts = {}, {}, {}, {}
         self.cats = {k: set() for k in ['Class列表', 'Span列表', '图片Class列表', '非P标签列表', '非P、img、body标签列表']}
-        self.all_items_refs, self.n_map, self.st = [], {"": ""}, {"#0": False, "count": False}
+        self.n_map, self.st = {"": ""}, {"#0": False, "count": False}
+        self._merge_lock, self._pending = threading.Lock(), {'imgs': set(), 'classes': set(), 'new': []} # 子线程合并的待刷新变更
+        self._full_samples = set() # 实例已收满的class 随任务下发给解析端跳过实例提取
         self.preview_window = self.details_window = None
         self._after_ids = []
         self._running = True
         self.modified_files = {}
         self._dragging = False # 拖入拖出 互斥锁
         self.sesame_root = Path(tempfile.gettempdir(), "sesame_cache"); self.sesame_root.mkdir(parents=True, exist_ok=True)
+        try: cache_root = user_cache_dir("class_list_cache") or logger.warning("Class分析缓存目录不属于当前用户，本次不使用缓存")
+        except OSError as e: cache_root = logger.warning(f"Class分析缓存目录不可用: {e}")
+        self.cache = AnalysisCache(cache_root)
+        self.text_index = TextIndex() # 预览搜索的全文索引 首次搜索时按需建立
+        self.archive = ArchiveReader(epub_path) # 预览/搜索/拖出/OPF同步共用的只读句柄
         self.show_class_list()
 
     def show_class_list(self):
@@ -38,6 +214,7 @@ class ClassList:
                                                       [c.after_cancel(aid) for aid in self._after_ids], 
                                                       [(w.unbind('<Destroy>'), w.destroy()) for w in c.winfo_children()], 
                                                       [clean_old_epub_cache()],  # 关闭时清理旧缓存
+                                                      self.archive.close(),
                                                       c.destroy()))
         rec = self.win_size.setup(cw, "class_list_main", f"600x480+{self.root.winfo_x()+30}+{self.root.winfo_y()+30}", mode='cascade')
         cw.bind('<Configure>', rec, add='+')
@@ -61,7 +238,7 @@ class ClassList:
                     [z_out.writestr(item.filename, z_in.read(item.filename)) for item in z_in.infolist() if item.filename not in self.modified_files]
                     # 写入内存中新增或修改的文件内容（包括_sync_opf生成的opf字节流），content为None则代表删除
                     [z_out.writestr(path, content) for path, content in self.modified_files.items() if content is not None]
-                shutil.move(tmp_path, self.epub_path); self.modified_files.clear()
+                self.archive.close(); shutil.move(tmp_path, self.epub_path); self.cache.forget(self.epub_path, self.modified_files); self.modified_files.clear()
                 logger.success("修改已成功保存至epub。"); messagebox.showinfo("保存", "修改已成功保存至EPUB。", parent=cw)
             except Exception as e: 
                 logger.exception(f"保存epub失败: {e}"); messagebox.showerror("保存失败", str(e), parent=cw)
@@ -124,8 +301,7 @@ class ClassList:
                     out = self.sesame_root / f"epub_out_{h_p}_{ts}"
                     out.exists() or [out.mkdir(parents=True), atexit.register(lambda: shutil.rmtree(out, ignore_errors=True))]
                     files = [f'{{{t.resolve().as_posix()}}}' for i in sel if not (p := ftree.item(i, "tags")[0]).endswith('/')
-                             and (t := out / Path(p).name).write_bytes(self.modified_files.get(p) or 
-                             zipfile.ZipFile(self.epub_path).read(p))]
+                             and (t := out / Path(p).name).write_bytes(self.modified_files.get(p) or self.archive.read(p))]
                     if files: logger.info(f"拖出导出了 {len(files)} 个文件到临时目录")
                     return ('copy', DND_FILES, " ".join(files)) if files else "break"
                 except Exception as ex: 
@@ -152,13 +328,13 @@ class ClassList:
         tf = ttk.Frame(rf); tf.pack(fill="both", expand=True, padx=(0, 3), pady=2)
         tree = ttk.Treeview(tf, columns=("count",), show="tree headings", selectmode="extended")
 
-        # 排序逻辑函数
+        # 排序逻辑函数 (排序键: 类名或总量，加载期间新增条目按插入时的总量定位)
         self.lc = None
+        sort_key = lambda c: (self.counts_data.get(c, 0), c.lower()) if self.lc == "count" else (c.lower(), c)
+        reverse = lambda: self.lc is not None and not self.st[self.lc]
         def sort_col(col):
             self.st[col], self.lc = ((col == "#0") if col != self.lc else not self.st[col]), col
-            for n in nodes.values():
-                items = sorted([(tree.set(c, "count"), tree.item(c, "text"), c) for c in tree.get_children(n)], key=lambda x: int(x[0]) if col=="count" else x[1].lower(), reverse=not self.st[col])
-                [tree.move(it[2], n, i) for i, it in enumerate(items)]
+            rebuild()
             [tree.heading(c, text=f"{'类名' if c=='#0' else '总量'}{(' ▲' if self.st[c] else ' ▼') if c==col else ''}") for c in ["#0", "count"]]
 
         # 初始表头设置
@@ -170,8 +346,16 @@ class ClassList:
         ttk.Style().configure("Treeview", indent=8) #调整Treeview缩进余白
         # 默认展开控制
         nodes = {k: tree.insert("", "end", text=k, open=(k in ['Class列表', 'Span列表', '图片Class列表'])) for k in self.cats}
-        class_to_iid = {}
-        filter_var.trace_add("write", lambda *args: do_filter()) # 绑定筛选输入变化事件
+        views = {k: VirtualCategory(tree, n) for k, n in nodes.items()}
+        # 重新实体化分类(排序/筛选/加载更多)：筛选匹配类名或其CSS内容
+        def matches(cls, keyword):
+            return not keyword or keyword in cls.lower() or any(keyword in (r['selector'] + r['content']).lower() for rs in self.style_data.get(cls, {}).values() for r in rs)
+        def rebuild(keys=None):
+            keyword = filter_var.get().strip().lower()
+            with self._merge_lock: # 快照包含尚未刷新的新条目 清空待插入队列避免重复
+                cats = {k: list(self.cats[k]) for k in views}; self._pending['new'] = [kc for kc in self._pending['new'] if keys and kc[0] not in keys]
+            for k in keys or views:
+                views[k].reset([(sort_key(c), c) for c in cats[k] if matches(c, keyword)], reverse(), self.counts_data.get)
 
         # 预览逻辑+搜索框
         def preview_file(e):
@@ -194,15 +378,14 @@ class ClassList:
                         target.write_bytes(self.modified_files[p])
                     elif not target.exists():
                         # 一次性全量解压(这里可能需要性能优化 改成异步处理或者按需解压)
-                        with zipfile.ZipFile(self.epub_path, 'r') as z:
-                            [(td / Path(x).name).write_bytes(z.read(x)) for x in z.namelist() if x.lower().endswith(exts)]
+                        [(td / Path(x).name).write_bytes(self.archive.read(x)) for x in self.archive.names() if x.lower().endswith(exts)]
                     return os.startfile(target) if hasattr(os, 'startfile') else __import__('subprocess').run(['open', target])
                 # 内存读取预览文本逻辑 显示内容+正则搜索
                 key = "class_list_preview"
                 rec = self.win_size.setup(win := tk.Toplevel(cw), key, f"600x500+{self.root.winfo_x()-300}+{self.root.winfo_y()+50}", mode='cascade')
                 win.bind('<Configure>', rec, add='+')
                 win.protocol("WM_DELETE_WINDOW", win.destroy); win.focus_force()
-                state = {"current_file": p, "search_results": [], "search_index": -1, "last_q": None} # 状态存储 (用于搜索)
+                state = {"current_file": p, "search_results": [], "keys": [], "search_index": -1, "last_q": None, "job": None} # 状态存储 (用于搜索)
 
                 # 定义跳过图片的获取逻辑 (用于左右键切换)
                 def get_next_text(rev):
@@ -232,46 +415,79 @@ class ClassList:
                 def load_content_to_text(fpath):
                     state["current_file"] = fpath; win.title(fpath)
                     content = (self.modified_files[fpath].decode('utf-8', 'ignore') if fpath in self.modified_files and self.modified_files[fpath] is not None else
-                            zipfile.ZipFile(self.epub_path, 'r').read(fpath).decode('utf-8', 'ignore') if fpath in zipfile.ZipFile(self.epub_path, 'r').namelist() else "")
+                            self.archive.text(fpath) if fpath in self.archive else "")
                     # 为极长的标签块换行 大幅降低wrap="word"的渲染压力
                     content = re.sub(r'(</(?:div|p|h[1-6]|ul|ol|li|section|html|body|table)>)\s*', r'\1\n', content, flags=re.I)
                     txt.config(state="normal"); txt.delete("1.0", "end"); txt.insert("1.0", content); txt.config(state="disabled")
-                    [(ftree.selection_set(n), ftree.see(n)) for n in self.n_map.values() if n and ftree.exists(n) and ftree.item(n, "tags")[0] == fpath]
+                    if (n := self.n_map.get(fpath)) and ftree.exists(n): ftree.selection_set(n); ftree.see(n) # n_map直接按路径取节点 不再遍历整棵树
 
                 # 执行正则搜索定位，支持全局匹配与高亮
+                # 查询变化时先搜当前文件并立即定位，其余文件按帧在后台搜索(全文索引预过滤)，结果按文件顺序插入并持续刷新计数
                 def do_find(rev=False, reset=False):
-                    [txt.tag_remove(t, "1.0", "end") for t in ("m", "cur")]
-                    if not (q := se.get()): return sl.config(text="0/0")
-                    if q != state["last_q"] or reset: # 仅在查询变动或重置时重新扫描
-                        state.update({"last_q": q, "search_results": [], "search_index": -1})
+                    if not (q := se.get()): return (cancel_search(), [txt.tag_remove(t, "1.0", "end") for t in ("m", "cur")], sl.config(text="0/0"))
+                    if q != state["last_q"] or reset: return start_search(q)
+                    show_result(rev)
+
+                def cancel_search():
+                    if state["job"]: win.after_cancel(state["job"]); state["job"] = None
+
+                def start_search(q):
+                    cancel_search()
+                    try: rx = re.compile(q)
+                    except re.error as e:
+                        logger.error(f"正则搜索失败: {e}")
+                        return sl.config(text="Err")
+                    nl = set(self.archive.names())
+                    s_files = sorted({f for f in (nl if global_search_var.get() else {state["current_file"]}) | set(self.modified_files)
+                                      if f.endswith((".html", ".xhtml")) and (f in nl or self.modified_files.get(f) is not None)})
+                    order, cur = {f: i for i, f in enumerate(s_files)}, state["current_file"]
+                    state.update({"last_q": q, "search_results": [], "keys": [], "search_index": -1})
+                    def add(f, spans): # 按文件顺序插入，插入点在当前项之前时当前项后移
+                        if not spans: return
+                        pos = bisect.bisect_left(state["keys"], order[f])
+                        state["keys"][pos:pos] = [order[f]] * len(spans)
+                        state["search_results"][pos:pos] = [{"path": f, "span": sp} for sp in spans]
+                        if 0 <= pos <= state["search_index"]: state["search_index"] += len(spans)
+                    def scan(files):
+                        ver = os.stat(self.epub_path).st_mtime_ns
+                        token_of = lambda f: self.modified_files[f] if self.modified_files.get(f) is not None else ver # 修改后的字节对象或EPUB修改时间
+                        yield from self.text_index.search(rx, files, token_of, lambda f: self.modified_files.get(f) or self.archive.read(f))
+                    if cur in order: [add(f, spans) for f, spans in scan([cur])]
+                    rest = scan([f for f in s_files if f != cur])
+                    def step():
+                        if not win.winfo_exists(): return
+                        t0, done = time.perf_counter(), True
                         try:
-                            with zipfile.ZipFile(self.epub_path, "r") as z:
-                                nl = z.namelist()
-                                s_files = sorted({f for f in (nl if global_search_var.get() else [state["current_file"]]) + list(self.modified_files.keys()) 
-                                                if f.endswith((".html", ".xhtml")) and (f in nl or self.modified_files.get(f) is not None)})
-                                [state["search_results"].extend([{"path": f, "span": m.span()} for m in re.finditer(q, (self.modified_files[f] if f in self.modified_files 
-                                and self.modified_files[f] is not None else z.read(f)).decode("utf-8", "ignore"))]) for f in s_files]
-                            if res := state["search_results"]: state["search_index"] = next((i for i, r in enumerate(res) if r["path"] == state["current_file"]), 0)
-                        except Exception as e: 
-                            logger.error(f"正则搜索失败: {e}")
-                            return sl.config(text="Err")
-                    if not state["search_results"]: return sl.config(text="0/0")
-                    state["search_index"] = (state["search_index"] + (-1 if rev else 1)) % len(state["search_results"]) if not reset else state["search_index"]
-                    target = state["search_results"][state["search_index"]]
+                            for f, spans in rest:
+                                add(f, spans)
+                                if time.perf_counter() - t0 > FRAME_MS / 1000: done = False; break
+                        except Exception as e: logger.error(f"正则搜索失败: {e}")
+                        state["job"] = None if done else win.after(1, step)
+                        if state["search_index"] < 0 and state["search_results"]: show_result(reset=True)
+                        else: sl.config(text=f"{state['search_index'] + 1}/{len(state['search_results'])}{'' if done else '…'}")
+                    if state["search_results"]: show_result(reset=True)
+                    step()
+
+                def show_result(rev=False, reset=False):
+                    [txt.tag_remove(t, "1.0", "end") for t in ("m", "cur")]
+                    if not (res := state["search_results"]): return sl.config(text="0/0")
+                    if reset: state["search_index"] = next((i for i, r in enumerate(res) if r["path"] == state["current_file"]), 0)
+                    else: state["search_index"] = (state["search_index"] + (-1 if rev else 1)) % len(res)
+                    target = res[state["search_index"]]
                     if target["path"] != state["current_file"]: load_content_to_text(target["path"])
                     # 分批高亮所有匹配项 txt.search改用re以支持\b等高级正则
-                    ms, m_rs = list(re.finditer(q, txt.get("1.0", "end-1c"))), []
+                    ms, m_rs = list(re.finditer(state["last_q"], txt.get("1.0", "end-1c"))), []
                     for m in ms:
                         m_rs.extend((f"1.0+{m.start()}c", f"1.0+{m.end()}c"))
                         if len(m_rs) >= 1000: txt.tag_add("m", *m_rs); m_rs.clear() # 500个匹配项一批 分批渲染
                     if m_rs: txt.tag_add("m", *m_rs)
                     # 高亮并跳转到当前特定匹配项
-                    m_idx = sum(1 for i in range(state["search_index"]) if state["search_results"][i]["path"] == target["path"])
+                    m_idx = sum(1 for i in range(state["search_index"]) if res[i]["path"] == target["path"])
                     if m_idx < len(ms):
                         m = ms[m_idx]
                         txt.tag_add("cur", (s_idx := f"1.0+{m.start()}c"), f"1.0+{m.end()}c")
                         txt.see(s_idx)
-                    sl.config(text=f"{state['search_index'] + 1}/{len(state['search_results'])}")
+                    sl.config(text=f"{state['search_index'] + 1}/{len(res)}{'…' if state['job'] else ''}")
 
                 # 批量绑定快捷键：左右键切换文件，上下键切换搜索结果，输入框自动防抖搜索
                 [win.bind(k, lambda e, r=v: [ftree.selection_set(nxt := get_next_text(r)), ftree.see(nxt), load_content_to_text(ftree.item(nxt, "tags")[0]), do_find(reset=True)]) for k, v in [("<Left>", 1), ("<Right>", 0)]]
@@ -286,11 +502,10 @@ class ClassList:
         # bs4解析并从内存/磁盘同步删除OPF引用
         def _sync_opf(deleted_paths):
                 try:
-                    with zipfile.ZipFile(self.epub_path, 'r') as z:
-                        if not (opf_p := (BeautifulSoup(z.read("META-INF/container.xml"), "xml").find("rootfile") or {}).get("full-path")): return
-                        opf_dir = os.path.dirname(opf_p)
-                        # 优先从内存读取已有的修改，实现链式删除
-                        soup = BeautifulSoup(self.modified_files.get(opf_p) or z.read(opf_p), "xml")
+                    if not (opf_p := (BeautifulSoup(self.archive.read("META-INF/container.xml"), "xml").find("rootfile") or {}).get("full-path")): return
+                    opf_dir = os.path.dirname(opf_p)
+                    # 优先从内存读取已有的修改，实现链式删除
+                    soup = BeautifulSoup(self.modified_files.get(opf_p) or self.archive.read(opf_p), "xml")
                     rel_ps = {os.path.relpath(p, opf_dir).replace("\\", "/") for p in deleted_paths}
                     # 在提取 rid 时增加有效性检查，防止匹配到 None
                     rem_ids = {rid for it in soup.find_all("item") if (rid := it.get("id")) and it.get("href") in rel_ps and [it.decompose()]}
@@ -313,66 +528,34 @@ class ClassList:
                         if (idref := itemref.get("idref")) and idref in manifest}
             except: return {}
 
-        # 解析单个HTML文件的函数（子线程执行：纯计算，无UI操作）
-        def _parse_html_file(file_content_bytes, filename):
-            results = {'counts': {}, 'samples': {}, 'class_tags': [], 'img_counts': {}}
-            try:
-                import posixpath # 性能优于pathlib 且强制使用正斜杠符合epub规范
-                root = lxml.html.fromstring(file_content_bytes)
-                base_dir = posixpath.dirname(filename)
-                # XPath 一次遍历提取class、img、svg、image的标签
-                for el in root.xpath('//*[@class] | //img | //*[(local-name()="image")]'):
-                    tag = el.tag.rsplit('}', 1)[-1].lower()
-                    # 处理图片路径
-                    if tag in ('img', 'image'):
-                        # 兼容src、href、xlink:href等属性
-                        src = el.get('src') or el.get('href') or el.get('xlink:href') or el.get('{http://www.w3.org/1999/xlink}href')
-                        if src and not src.startswith(('http', 'data:')):
-                            # 规范化路径，处理 ../ 符号并去掉 URL 参数/锚点
-                            clean_src = src.split('#')[0].split('?')[0]
-                            abs_p = posixpath.normpath(posixpath.join(base_dir, clean_src))
-                            results['img_counts'][abs_p] = results['img_counts'].get(abs_p, 0) + 1
-                    # 处理包含class的节点（这里不使用elif，因为img也可能带有class）
-                    if cls_str := el.get('class'):
-                        cls_list = cls_str.split()
-                        s_raw = ""
-                        # 性能优化：在子线程预先判断是否需要提取实例字符串
-                        if any(len(self.samples_data.get(c, [])) < 15 for c in cls_list):
-                            s_raw = lxml.html.tostring(el, encoding='unicode', method='html', with_tail=False).strip()
-                        for c in cls_list:
-                            results['counts'][c] = results['counts'].get(c, 0) + 1
-                            results['class_tags'].append((c, tag))
-                            if s_raw and len(results['samples'].get(c, [])) < 15: # 每个class仅收集前15个实例，避免过度内存占用
-                                results['samples'].setdefault(c, []).append((filename, re.sub(r'\s+', ' ', s_raw)[:150]))
-            except Exception as e:
-                logger.error(f"解析 {filename} 出错: {e}")
-            return results
-
-        # 合并解析结果到主数据结构（主线程执行：包含UI更新）
+        # 合并解析结果到主数据结构（主进程的子线程执行：只更新数据并记录待刷新的变更，不操作UI）
+        # results为紧凑条目(见book_index.compact_entry)，class名驻留(intern)后作为键 各文件的同名class共用一个字符串对象
         def _merge_results(results):
-            # 同步更新左侧文件树的图片计数
-            for p, cnt in results.get('img_counts', {}).items():
-                self.img_counts[p] = self.img_counts.get(p, 0) + cnt
-                if p in self.n_map and ftree.exists(self.n_map[p]):
-                    ftree.item(self.n_map[p], values=(f"{self.img_counts[p]}",))
-
-            for c, cnt in results['counts'].items():
-                self.counts_data[c] = self.counts_data.get(c, 0) + cnt
-                # 处理html提取的class数据 (保留原码判断逻辑与Treeview更新)
-                for tag in [t for cls, t in results['class_tags'] if cls == c]:
-                    [ (self.cats[k].add(c), key := (k, c),
-                       tree.item(class_to_iid[key], values=(self.counts_data[c],)) if key in class_to_iid else
-                       (class_to_iid.update({key: tree.insert(nodes[k], "end", text=c, values=(self.counts_data[c],))}),
-                        self.all_items_refs.append((k, c, class_to_iid[key])),
-                        # 字母顺序重排
-                        ch := sorted(tree.get_children(nodes[k]), key=lambda x: tree.item(x, 'text').lower()),
-                        [tree.move(child, nodes[k], idx) for idx, child in enumerate(ch)]))
-                      for k, v in [('Class列表', 1), ('Span列表', tag=='span'), ('图片Class列表', tag=='img'), 
-                                   ('非P标签列表', tag!='p'), ('非P、img、body标签列表', tag not in ['p','img','body'])] if v ]
-                    break # 每个class在一次结果合并中只更新一次分类树
-            for c, s_list in results['samples'].items():
-                if len(self.samples_data.get(c, [])) < 15: # 仅在样本不足时合并，避免过度覆盖
-                    self.samples_data.setdefault(c, []).extend(s_list[:15 - len(self.samples_data.get(c, []))])
+            with self._merge_lock:
+                pending = self._pending
+                for p, cnt in results['img_counts'].items():
+                    self.img_counts[p] = self.img_counts.get(p, 0) + cnt; pending['imgs'].add(p)
+                for i, (c, cnt, tag) in enumerate(zip(results['names'], results['counts'], results['tags'])):
+                    c = sys.intern(c)
+                    self.counts_data[c] = self.counts_data.get(c, 0) + cnt; pending['classes'].add(c)
+                    for k, rule in CATEGORY_RULES: # 每个class按本文件中首次出现的标签归类
+                        if rule(tag) and c not in self.cats[k]: self.cats[k].add(c); pending['new'].append((k, c))
+                    if (s_list := results['samples'].get(i)) and len(have := self.samples_data.get(c, [])) < SAMPLE_LIMIT: # 仅在样本不足时合并，避免过度覆盖
+                        self.samples_data[c] = have = have + s_list[:SAMPLE_LIMIT - len(have)]
+                        if len(have) >= SAMPLE_LIMIT: self._full_samples.add(c)
+
+        # 按固定帧率把待刷新的变更写入文件树与分类树（主线程执行）：新条目按排序键二分插入，已有条目只更新总量
+        def flush():
+            with self._merge_lock:
+                imgs, classes, new = self._pending['imgs'], self._pending['classes'], self._pending['new']
+                self._pending = {'imgs': set(), 'classes': set(), 'new': []}
+            for p in imgs:
+                if p in self.n_map and ftree.exists(self.n_map[p]): ftree.item(self.n_map[p], values=(f"{self.img_counts[p]}",))
+            keyword, rev, added = filter_var.get().strip().lower(), reverse(), set()
+            for k, c in sorted(new, key=lambda kc: sort_key(kc[1])):
+                if matches(c, keyword): views[k].add(sort_key(c), c, rev, self.counts_data[c]); added.add((k, c))
+            for c in classes:
+                [views[k].update(c, self.counts_data[c]) for k in views if (k, c) not in added]
 
         # 构建epub文件树 提取样式和实例数据
         def parse_gen():
@@ -394,39 +577,69 @@ class ClassList:
 
                 css_files = [f for f in nl if f.endswith('.css')]
                 html_files = [f for f in nl if f.endswith(('.html', '.xhtml'))]
+                # 持久化缓存：未变化的css/html直接复用上次的解析结果，本次全部结果(含复用的)解析完成后写回
+                cached, results = self.cache.load(self.epub_path, z), {}
                 # 提取css样式
                 for f in css_files:
                     if not self._running: return
-                    b_txt = z.read(f).decode('utf-8', 'ignore')
-                    [[self.style_data.setdefault(c, {}).setdefault(f, []).append({'selector': p, 'content': re.sub(r';\s*', ';\n  ', b.strip())})
-                      for p in [s.strip() for s in sel.split(',')]
-                      for m in re.findall(r'(?:\.([\w-]+))|(?:\b([a-zA-Z1-6]+)\b)', p)
-                      for c in m if c] for sel, b in re.findall(r'([^{]+)\{([^}]+)\}', re.sub(r'/\*.*?\*/', '', b_txt, flags=re.DOTALL))]
-                    yield
+                    results[f] = rules = cached[f] if f in cached else css_rules(z.read(f).decode('utf-8', 'ignore'))
+                    [self.style_data.setdefault(c, {}).setdefault(f, []).append({'selector': p, 'content': b}) for c, p, b in rules]
+                    if f not in cached: yield
+                # 缓存命中的html按spine顺序直接合并，每200个刷新一次
+                for i, f in enumerate(hits := [f for f in html_files if f in cached]):
+                    if not self._running: return
+                    _merge_results(results.setdefault(f, cached[f]))
+                    if i % 200 == 199 or i == len(hits) - 1: flush(); yield
+                todo = [f for f in html_files if f not in cached]
+                if hits: logger.info(f"Class分析缓存命中 {len(hits)} 个html，需解析 {len(todo)} 个")
 
                 # 多线程动态分发处理html
-                max_workers = int(w) if (w := self.workers_cfg) != 'Auto' else max(2, min(os.cpu_count() or 2, 8)) # 读取配置 自动(最低2最高8)或手动的线程数
-                all_tasks = [] # 主线程预读字节流 规避ZipFile线程锁.准备动态分发
-                for f in html_files:
-                    try: all_tasks.append((z.read(f), f))
-                    except: pass
-                # 按线程动态分发任务.子线程仅负责解析 按文件独立提交.主线程负责结果合并和UI更新
-                with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                    fs = {executor.submit(_parse_html_file, data, name): name for data, name in all_tasks}
-                    count = 0
-                    for future in as_completed(fs):
-                        if not self._running: break
-                        res = future.result()
-                        if res: _merge_results(res) # 回主线程合并数据并更新UI
-                        # 10%的任务完成率刷新一次UI，保持界面响应性
-                        count += 1
-                        if count % 10 == 0:
-                            yield
+                max_workers = int(w) if (w := self.workers_cfg) != 'Auto' else max(2, min(available_cpus(), 8)) # 读取配置 自动(最低2最高8 遵循CPU亲和性与cgroup配额)或手动的线程数
+                # 解析后端：Thread线程池 / Process进程池(子进程只解析并回传紧凑结果，合并仍在主进程)，Auto按GIL状态选择
+                # 进程池启动开销摊不薄的小书仍用线程池
+                sizes = [(f, z.getinfo(f).file_size) for f in todo]
+                mode = resolve_backend(self.backend_cfg)
+                if mode == 'process' and choose_strategy(estimate_cost(sizes), max_workers)[0] != 'process': mode = 'thread'
+                # 有界流水线：专用读取线程独立打开zip(不与主线程共用ZipFile)按spine顺序读一个提交一个，解析完成后回调合并
+                # 在途任务数受信号量限制(背压)，读取速度超过解析速度时读取线程等待，内存占用只与worker数和单文件大小有关
+                slots, state = threading.BoundedSemaphore(max_workers * 2), {'fed': 0, 'merged': 0}
+                def on_done(future, name): # 线程池在worker线程、进程池在结果管理线程中回调
+                    try:
+                        if not future.cancelled(): _merge_results(results.setdefault(name, future.result()))
+                    except Exception as e: logger.error(f"解析结果合并出错: {e}")
+                    finally:
+                        with self._merge_lock: state['merged'] += 1
+                        slots.release()
+                def feed(executor):
+                    with zipfile.ZipFile(self.epub_path, 'r') as zr:
+                        for f in todo:
+                            while not slots.acquire(timeout=0.1): # 等待空位，窗口关闭时放弃
+                                if not self._running: return
+                            if not self._running: slots.release(); return
+                            with self._merge_lock: full = frozenset(self._full_samples) # 合并回调在其他线程向集合添加 快照需持锁
+                            try: future = executor.submit(mp_index_html, (zr.read(f), f, full))
+                            except Exception as e: slots.release(); logger.error(f"读取 {f} 出错: {e}"); continue
+                            state['fed'] += 1; future.add_done_callback(lambda fu, f=f: on_done(fu, f))
+                t0 = time.perf_counter()
+                with make_executor(mode, max_workers, max((c for _, c in sizes), default=0)) as executor:
+                    reader = threading.Thread(target=feed, args=(executor,), name="class_list_reader", daemon=True)
+                    reader.start()
+                    while self._running and (reader.is_alive() or state['merged'] < state['fed']): # 不阻塞主线程 每帧刷新一次
+                        flush(); yield FRAME_MS
+                    reader.join()
+                if todo: logger.info(f"Class分析解析 {state['merged']} 个html，{mode} x{max_workers}，用时 {time.perf_counter() - t0:.2f}s")
+                if self._running and todo and all(f in results for f in todo): # 有新解析结果时写回，中途关闭或有文件解析失败时不写回
+                    try: self.cache.save(self.epub_path, z, results)
+                    except Exception as e: logger.warning(f"Class分析缓存写入失败: {e}")
+                flush()
+                if self._running and self.lc == "count": # 加载期间按插入时的总量定位，总量仍在增长，完成后按最终总量整体重排一次(保留选中项)
+                    picked = {tree.item(i, "text") for i in tree.selection()}; rebuild()
+                    tree.selection_set([iid for v in views.values() for n, iid in v.iids.items() if n in picked])
                 yield # 每批次完成后交还UI控制权
         gen = parse_gen()
         def run_step(): # 递归调用生成器分步处理
             if self._running:
-                try: (next(gen), self._after_ids.append(cw.after(1, run_step)))
+                try: self._after_ids.append(cw.after(next(gen) or 1, run_step)) # 生成器可返回下一步的延迟(毫秒)
                 except StopIteration: pass # 正常结束，静默处理
                 except Exception: logger.exception("class_list run_step 发生异常")
         run_step()
@@ -434,12 +647,14 @@ class ClassList:
         # 显示样式详情+实例
         def show_details(event=None):
             if not (item := (tree.identify_row(event.y) if event else (tree.selection() or [None])[0])) or item in nodes.values(): return
+            if 'more' in tree.item(item, "tags"): # 占位行：该分类再实体化一批
+                k = next(k for k, n in nodes.items() if n == tree.parent(item)); views[k].limit += VIRTUAL_ROWS; return rebuild([k])
             win = tk.Toplevel(cw)
             rec = self.win_size.setup(win, "class_list_details", f"500x480+{self.root.winfo_x()+320}+{self.root.winfo_y()-20}", mode='cascade')
             win.bind('<Configure>', rec, add='+')
             win.protocol("WM_DELETE_WINDOW", win.destroy); win.focus_force()
             # 获取下一个节点的 lambda，用于左右键切换
-            get_nxt = lambda r: (b := tree.get_children(tree.parent(tree.selection()[0])))[(b.index(tree.selection()[0]) + (-1 if r else 1)) % len(b)]
+            get_nxt = lambda r: (b := [c for c in tree.get_children(tree.parent(tree.selection()[0])) if 'more' not in tree.item(c, "tags")])[(b.index(tree.selection()[0]) + (-1 if r else 1)) % len(b)]
 
             pw = ttk.PanedWindow(win, orient="vertical"); pw.pack(fill="both", expand=True, padx=5, pady=5)
             ts = [tk.Text(f := ttk.Frame(pw), height=1, font=('Consolas', 10 if i==0 else 9), bg="#ffffff" if i==0 else "#f9f9f9", wrap="word") for i in range(2)]
@@ -460,7 +675,7 @@ class ClassList:
         tree.bind("<Double-1>", show_details)
 
         def copy_selected():
-            items = tree.selection()
+            items = [i for i in tree.selection() if 'more' not in tree.item(i, "tags") and i not in nodes.values()]
             details_list = []
             for i in items:
                 name = tree.item(i, "text")
@@ -477,7 +692,7 @@ class ClassList:
             tree.focus_set()
 
         def write_selected_to_style_mem():
-            items = tree.selection()
+            items = [i for i in tree.selection() if 'more' not in tree.item(i, "tags") and i not in nodes.values()]
             style_lines = []
             for i in items:
                 name = tree.item(i, "text")
@@ -503,17 +718,9 @@ class ClassList:
                 menu.post(event.x_root, event.y_root)
         tree.bind("<Button-3>", on_right_click)
 
-        # 筛选功能
+        # 筛选功能：关键词为空、匹配类名或匹配 CSS 内容
         def do_filter(*_):
-            keyword = filter_var.get().strip().lower()
-            tree.selection_remove(tree.selection())
-            for group, cls, iid in self.all_items_refs:
-                tree.detach(iid)
-                # 提取所有相关的 CSS 文本
-                css_texts = [rule['selector'] + rule['content'] for rules in self.style_data.get(cls, {}).values() for rule in rules]
-                # 执行综合匹配：关键词为空、匹配类名或匹配 CSS 内容
-                if not keyword or keyword in cls.lower() or any(keyword in text.lower() for text in css_texts):
-                    tree.reattach(iid, nodes[group], "end")
+            tree.selection_remove(tree.selection()); rebuild()
         filter_var.trace_add("write", do_filter)
 
         # 编辑临时样式：弹出一个可编辑的Text窗口，显示全部暂存样式，编辑后自动保存
@@ -253,8 +253,8 @@ class EpubNCXGenerator:
             f.write(str(opf_soup))
 
     @staticmethod
-    def fix_ncx_paths(opf_path, offset_enabled=True, atokagi_enabled=True, manual_offset=0):
-        """检查并修正ncx中的src路径,尝试-1修正目录，补全あとがき条目"""
+    def fix_ncx_paths(opf_path, offset_enabled=True, atokagi_enabled=True, manual_offset=0, index=None):
+        """检查并修正ncx中的src路径,尝试-1修正目录，补全あとがき条目 (index: 书籍引用索引BookIndex，提供时直接查询标题候选与文件存在性)"""
         opf_path = Path(opf_path)
         opf_soup = BeautifulSoup(opf_path.read_text(encoding='utf-8'), 'xml')
 
@@ -287,7 +287,8 @@ class EpubNCXGenerator:
             ncx_srcs = re.findall(r'src="([^"]+)"', ncx_text)
             last_f = ncx_srcs[-1] if ncx_srcs else ""; last_src = last_f.split('#')[0]
             m_v = int(manual_offset or 0)
-            missing = last_src and not (opf_path.parent / last_src).exists()
+            last_p = opf_path.parent / last_src
+            missing = last_src and not (index.exists(last_p) if index else last_p.exists())
             shift = m_v if m_v else (-1 if (offset_enabled and missing) else 0)
             if shift:
                 l_t = (BeautifulSoup(ncx_text, 'xml').find_all('navPoint') or [None])[-1]
@@ -312,7 +313,7 @@ class EpubNCXGenerator:
         if atokagi_enabled:
             # 寻找唯一 あとがき 文件 (Body前20行内且全书唯一的HTML)
             if ncx_missing or nav_missing:
-                candidates = [
+                candidates = [h for h in spine_files if index.lead_match(opf_path.parent / h, 'あとがき')] if index else [
                     h for h in spine_files 
                     if (f := opf_path.parent / h).exists() 
                     and (c := f.read_text(encoding='utf-8', errors='ignore'))
@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from PIL import Image, ImageEnhance, ImageOps
+
+# ===================================================================== #
+# 图片转换处理：参数语法与image_converter.exe一致
+# 可作为命令行程序运行(nuitka编译为exe)，也可由主程序直接调用(无exe或非Windows时自动使用)
+# 用法: python image_converter.py -i @list.txt -f webp -q80 -H1300 -W1200 -s1.0 -A -m4 -w8
+# 列表文件每行一个图片路径，可写作 路径|覆盖参数 为单张图片追加参数(如 -r -90 -R 1:2)
+
+VALUE_FLAGS = {'-f': 'format', '-q': 'quality', '-H': 'height', '-W': 'width', '-s': 'sharpen',
+               '-m': 'method', '-w': 'workers', '-r': 'rotate', '-R': 'ratio', '-i': 'input'}
+DEFAULTS = {'format': 'webp', 'quality': 80, 'height': 0, 'width': 0, 'sharpen': 1.0, 'alpha': False,
+            'method': 4, 'workers': 0, 'rotate': 0, 'ratio': '', 'input': ''}
+TYPES = {'quality': int, 'height': int, 'width': int, 'sharpen': float, 'method': int, 'workers': int, 'rotate': int}
+PIL_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG'}
+CACHE_MAX_BYTES = 512 * 2**20 # 转换结果缓存容量上限 超出后按LRU淘汰
+RULE_SIZE, RULE_THRESHOLD = (32, 128), 0.7 # 罫線分类器的归一化尺寸(短边, 长边)与判定阈值
+RULE_SOLID_ASPECT = 4.0 # 纯色图(无墨迹可分析)长宽比达到该值时视为实心罫線
+EXIF_ORIENTATION = 0x0112 # EXIF方向标签 1为正常，5-8为转置(宽高互换)
+
+def parse_params(tokens, base=None):
+    """
+    解析转换参数(-q80 与 -q 80 两种写法均可)，在base基础上覆盖后返回新字典
+    -f格式 -q质量 -H/-W最大高宽 -s锐化 -A保留透明 -m WebP压缩等级 -w进程数 -r旋转角度(正值逆时针) -R触发旋转的比例
+    """
+    opts, it = dict(base or DEFAULTS), iter(tokens)
+    for tok in it:
+        if tok == '-A': opts['alpha'] = True; continue
+        if not (key := VALUE_FLAGS.get(tok[:2])): continue
+        val = tok[2:] or next(it, '')
+        try: opts[key] = TYPES[key](val) if key in TYPES else val.lower() if key == 'format' else val
+        except ValueError: raise ValueError(f"参数 {tok[:2]} 的值无效: {val}") from None
+    if opts['format'] not in PIL_FORMATS: raise ValueError(f"不支持的输出格式: {opts['format']}")
+    return opts
+
+def parse_ratio(text):
+    """-R 触发旋转的比例 1.5 / 1:2 / 128x1366 统一为 长边/短边 的倍数，为空返回0(不限制)"""
+    if not text: return 0.0
+    a, b = ([float(x) for x in re.split(r'[:x]', text.lower()) if x] + [1.0])[:2]
+    return max(a, b) / min(a, b)
+
+def should_rotate(width, height, opts):
+    """指定了-r且 高/宽 达到-R比例时旋转(竖排罫線等细长竖图转为横向)，未指定-R则总是旋转"""
+    return bool(opts['rotate']) and (not (ratio := parse_ratio(opts['ratio'])) or height / max(width, 1) >= ratio)
+
+def drop_flags(tokens, flags):
+    """从参数列表中去掉指定参数及其取值(-r-90 与 -r -90 两种写法均可)"""
+    out, it = [], iter(tokens)
+    for tok in it:
+        if tok[:2] not in flags: out.append(tok)
+        elif len(tok) == 2 and tok in VALUE_FLAGS: next(it, None)
+    return out
+
+def has_alpha(im):
+    return im.mode in ('RGBA', 'LA', 'PA') or (im.mode == 'P' and 'transparency' in im.info)
+
+def probe_image(path):
+    """只读取文件头(不解码像素)，返回(格式, 宽, 高, 是否含透明通道, EXIF方向)，宽高为按EXIF方向摆正后的尺寸，无法识别返回None"""
+    try:
+        with Image.open(path) as im:
+            orientation = im.getexif().get(EXIF_ORIENTATION, 1)
+            w, h = (im.height, im.width) if orientation in (5, 6, 7, 8) else (im.width, im.height)
+            return im.format, w, h, has_alpha(im), orientation
+    except Exception: return None
+
+def probe_images(paths, workers=8):
+    """线程池并行探测图片文件头，返回{路径: probe_image结果}"""
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths)))) as executor:
+        return dict(zip(paths, executor.map(probe_image, paths)))
+
+def is_compliant(info, opts):
+    """已是目标格式、不超过-H/-W、无需摆正EXIF方向/旋转/锐化/去除透明通道的图片原样保留 避免重复有损编码"""
+    if not info: return False
+    fmt, width, height, alpha, orientation = info
+    return (fmt == PIL_FORMATS[opts['format']] and orientation == 1 and (not opts['width'] or width <= opts['width']) and (not opts['height'] or height <= opts['height'])
+            and not should_rotate(width, height, opts) and opts['sharpen'] == 1.0 and (opts['alpha'] or not alpha))
+
+def load_rule_sample(path):
+    """解码为长边竖直的归一化灰度小图(透明区域铺白，JPEG按需降采样解码)，返回(长宽比, uint8数组)，失败返回None"""
+    import numpy as np
+    try:
+        with Image.open(path) as im:
+            long_side, short_side = max(im.size), max(min(im.size), 1)
+            im.draft('L', (RULE_SIZE[0] * 4, RULE_SIZE[1] * 4))
+            if has_alpha(im):
+                rgba = im.convert('RGBA'); im = Image.new('RGB', rgba.size, 'white'); im.paste(rgba, mask=rgba.getchannel('A'))
+            im = im.convert('L')
+            if im.width > im.height: im = im.transpose(Image.Transpose.ROTATE_90)
+            return long_side / short_side, np.asarray(im.resize(RULE_SIZE, Image.BILINEAR))
+    except Exception: return None
+
+def classify_rules(paths, workers=8, threshold=RULE_THRESHOLD):
+    """
+    罫線(装饰线)图片分类器：线程池并行解码为归一化小图后整批向量化计算特征(依赖numpy)
+    背景取四边像素中位数，与背景差异大的像素为墨迹；特征按长边竖直方向计算：
+    长宽比、墨迹密度(线条稀疏)、长轴覆盖率(有墨迹的行占比 线条贯穿全长)、行投影均匀度(1-变异系数)、短轴占用(有墨迹的列占比 线条集中)
+    纯色/空白图(背景即整图 样本不含墨迹信息)：长宽比达到RULE_SOLID_ASPECT的视为实心罫線，其余无法判断
+    返回{路径: (是否罫線, 得分, 特征说明)}，无法读取或无法判断的图片不在结果中(由调用方按出现次数阈值判定)
+    """
+    import numpy as np
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths)))) as executor:
+        samples = {p: s for p, s in zip(paths, executor.map(load_rule_sample, paths)) if s}
+    if not samples: return {}
+    names = list(samples)
+    aspect = np.array([samples[p][0] for p in names], dtype=np.float32)
+    px = np.stack([samples[p][1] for p in names]).astype(np.float32) # (N, 长边, 短边)
+    bg = np.median(np.concatenate([px[:, 0, :], px[:, -1, :], px[:, :, 0], px[:, :, -1]], axis=1), axis=1)
+    ink = np.abs(px - bg[:, None, None]) > 48
+    rows, cols = ink.mean(axis=2), ink.mean(axis=1) # 行/列投影
+    density, coverage, spread = ink.mean(axis=(1, 2)), (rows > 0).mean(axis=1), (cols > 0.05).mean(axis=1)
+    uniform = 1 - np.minimum(rows.std(axis=1) / np.maximum(rows.mean(axis=1), 1e-6), 1)
+    score = (0.3 * np.clip((aspect - 1.5) / 3, 0, 1) + 0.25 * coverage + 0.15 * uniform
+             + 0.2 * (1 - np.clip(density / 0.5, 0, 1)) + 0.1 * (1 - spread))
+    flat, solid = density < 0.002, aspect >= RULE_SOLID_ASPECT # 纯色/空白图 扣除背景后没有墨迹
+    score = np.where(flat, np.where(solid, 1.0, 0.0), score)
+    return {p: (bool(score[i] >= threshold), float(score[i]),
+                f"纯色 长宽比{aspect[i]:.1f}" if flat[i] else
+                f"长宽比{aspect[i]:.1f} 密度{density[i]:.3f} 覆盖{coverage[i]:.2f} 均匀{uniform[i]:.2f} 列占用{spread[i]:.2f}")
+            for i, p in enumerate(names) if not flat[i] or solid[i]}
+
+def convert_one(path, opts):
+    """转换单张图片，输出为同名新后缀文件(格式相同时原地覆盖)，返回(是否成功, 源路径, 输出路径, 说明)"""
+    src = Path(path)
+    dst = src.with_suffix(f".{opts['format']}")
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    try:
+        with Image.open(src) as im:
+            im.load()
+            notes = []
+            if (orientation := im.getexif().get(EXIF_ORIENTATION, 1)) != 1: # 先按EXIF方向摆正 旋转判定与缩放基于显示尺寸
+                im = ImageOps.exif_transpose(im); notes.append(f"EXIF方向{orientation}")
+            if should_rotate(im.width, im.height, opts): # PIL角度正值为逆时针
+                im = im.rotate(opts['rotate'], expand=True); notes.append(f"旋转{opts['rotate']}")
+            scale = min(opts['width'] / im.width if opts['width'] else 1, opts['height'] / im.height if opts['height'] else 1, 1)
+            if scale < 1: # 按比例缩小 小图不放大
+                im = im.resize((max(1, round(im.width * scale)), max(1, round(im.height * scale))), Image.LANCZOS)
+                notes.append(f"缩放{im.width}x{im.height}")
+            alpha, fmt = has_alpha(im), PIL_FORMATS[opts['format']]
+            if alpha and opts['alpha'] and fmt != 'JPEG': im = im.convert('RGBA')
+            elif alpha: # 不保留透明通道时铺白底
+                rgba = im.convert('RGBA'); im = Image.new('RGB', rgba.size, 'white'); im.paste(rgba, mask=rgba.getchannel('A'))
+            elif im.mode not in ('RGB', 'L') or (fmt == 'WEBP' and im.mode != 'RGB'): im = im.convert('RGB')
+            if opts['sharpen'] != 1.0: im = ImageEnhance.Sharpness(im).enhance(opts['sharpen'])
+            save = {'WEBP': {'quality': opts['quality'], 'method': opts['method']},
+                    'JPEG': {'quality': opts['quality'], 'optimize': True}, 'PNG': {'optimize': True}}[fmt]
+            im.save(tmp, fmt, **save)
+        os.replace(tmp, dst)
+        return (True, str(src), str(dst), ' '.join(notes))
+    except Exception as e:
+        tmp.unlink(missing_ok=True)
+        return (False, str(src), str(dst), str(e))
+
+def available_cpus():
+    """可用CPU数：遵循主程序worker_pool的亲和性与cgroup配额，单独编译为exe时退回亲和性掩码/cpu_count"""
+    try: from worker_pool import available_cpus as cpus
+    except ImportError:
+        try: return len(os.sched_getaffinity(0))
+        except AttributeError: return os.cpu_count() or 1
+    return cpus()
+
+def read_list(spec):
+    """读取 @列表文件 或单个路径，返回[(路径, 覆盖参数字符串)]"""
+    lines = Path(spec[1:]).read_text('utf-8').splitlines() if spec.startswith('@') else [spec]
+    return [(p.strip(), ov.strip()) for l in lines if l.strip() for p, _, ov in [l.partition('|')]]
+
+def convert_images(lines, params, workers=None, progress=None, initializer=None):
+    """
+    按进程池并行转换图片 lines: [路径 或 路径|覆盖参数]，params: 主参数列表
+    progress(序号, 总数, 源路径, 是否成功, 说明) 每完成一张回调一次(主进程内)；返回(成功数, 总数, [错误信息])
+    """
+    base = parse_params(params)
+    tasks = [(p, parse_params(ov.split(), base) if ov else base) for l in lines for p, _, ov in [l.partition('|')]]
+    workers = workers or base['workers'] or available_cpus()
+    pool = ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=initializer) if workers > 1 and len(tasks) > 1 else None
+    results = (f.result() for f in as_completed([pool.submit(convert_one, p, o) for p, o in tasks])) if pool else (convert_one(p, o) for p, o in tasks)
+    success, errors = 0, []
+    try:
+        for i, (ok, src, dst, msg) in enumerate(results, 1):
+            success += ok
+            if not ok: errors.append(f"{Path(src).name}: {msg}")
+            if progress: progress(i, len(tasks), src, ok, msg)
+    finally:
+        if pool: pool.shutdown()
+    return success, len(tasks), errors
+
+class ImageCache:
+    """
+    按内容寻址的图片转换结果缓存(跨书籍共享)：键 = 源图片内容哈希 + 转换后端 + 生效参数(含追加覆盖参数)
+    条目文件的修改时间即最近使用时间，超过容量上限时按LRU淘汰
+    """
+    def __init__(self, root, max_bytes=CACHE_MAX_BYTES):
+        self.root, self.max_bytes = Path(root), max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.hits = self.misses = self.saved_bytes = 0
+
+    @staticmethod
+    def effective_params(tokens):
+        """规范化生效参数(不同写法/顺序得到相同结果)，进程数等不影响输出的参数不计入"""
+        opts = {k: v for k, v in parse_params(tokens).items() if k not in ('workers', 'input')}
+        if not opts['rotate']: opts['ratio'] = ''
+        return json.dumps(opts, sort_keys=True)
+
+    def key(self, digest, tokens, backend):
+        """digest: 源图片内容的sha256十六进制摘要"""
+        return hashlib.sha256(f"{digest}\0{backend}\0{self.effective_params(tokens)}".encode()).hexdigest()[:40]
+
+    def fetch(self, key, dst):
+        """命中时把缓存结果写到dst并刷新最近使用时间，返回是否命中"""
+        if not (entry := self.root / key).is_file(): self.misses += 1; return False
+        tmp = Path(dst).with_name(f".{Path(dst).name}.tmp")
+        shutil.copyfile(entry, tmp); os.replace(tmp, dst); os.utime(entry)
+        self.hits += 1; self.saved_bytes += entry.stat().st_size
+        return True
+
+    def store(self, key, src):
+        tmp = self.root / f".{key}.tmp"
+        shutil.copyfile(src, tmp); os.replace(tmp, self.root / key)
+
+    def evict(self):
+        """按最近使用时间淘汰条目直到总大小不超过上限，返回淘汰数"""
+        entries = sorted((st.st_mtime, st.st_size, e) for e in self.root.iterdir() if e.is_file() and not e.name.startswith('.') for st in [e.stat()])
+        total, removed = sum(size for _, size, _ in entries), 0
+        for _, size, e in entries:
+            if total <= self.max_bytes: break
+            e.unlink(missing_ok=True); total -= size; removed += 1
+        return removed
+
+    def reset_stats(self): self.hits = self.misses = self.saved_bytes = 0
+
+    def summary(self):
+        n = self.hits + self.misses
+        return f"图片缓存命中 {self.hits}/{n} ({self.hits / n:.0%})，复用 {self.saved_bytes / 2**20:.1f}MB" if n else ""
+
+def main(argv):
+    opts = parse_params(argv)
+    if not opts['input']: return print("用法: image_converter -i @列表文件|图片路径 [-f webp -q80 -H1300 -W1200 -s1.0 -A -m4 -w8]") or 2
+    lines = [f"{p}|{ov}" if ov else p for p, ov in read_list(opts['input'])]
+    report = lambda i, n, src, ok, msg: print(f"[{i}/{n}] {'√' if ok else '×'} {Path(src).name} {msg}", flush=True)
+    success, total, errors = convert_images(lines, argv, progress=report)
+    [print(f"失败 {e}") for e in errors]
+    print(f"成功 {success}/{total}")
+    return 0 if success or not total else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,12 +1,53 @@
 import os
 import re
 import sys
+import time
 import shutil
+import threading
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, wait
 from pathlib import Path
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 from loguru import logger
 from tooltip import ToolTip # tooltip.py
+from worker_pool import (auto_workers, choose_strategy, estimate_cost, make_executor, plan_batches, resolve_backend, run_batch,
+                         TaskWatch, watch_step, MP_RULE_TIMEOUT, MP_FILE_TIMEOUT, MP_WATCH_INTERVAL)
+
+PROFILE_SLOW_SHARE = 0.25 # 耗时占全部规则该比例以上的规则标红
+PROFILE_COLORS = {'slow': '#FFE4E1', 'dead': '#EEEEEE'} # 耗时大/出错/超时、未命中任何文件的规则输入框底色
+PROFILE_ERROR, PROFILE_TIMEOUT = -1, -2 # 替换次数的特殊值：规则出错 / 超时被看门狗中止(耗时记为超时前已用的秒数)
+
+def mp_profile_rules(args):
+    """
+    worker入口：(文件名, 文本, [(正则, 替换)], 跳过的规则序号) -> (文件名, [(耗时秒, 替换次数)])
+    规则按顺序链式作用于同一文本(与转换流水线的正则替换步骤一致，后面的规则看到前面规则替换后的结果)，出错的规则替换次数记为-1
+    跳过的规则(此前在该文件上超时)不执行，记为(0, 0)由主进程填入超时结果；每条规则开始时向看门狗登记步骤
+    """
+    name, content, rules, skip = args
+    stats = []
+    for i, (pattern, repl) in enumerate(rules):
+        if i in skip: stats.append((0.0, 0)); continue
+        watch_step(i); t0 = time.perf_counter()
+        try: content, n = re.subn(pattern, repl, content)
+        except Exception: n = PROFILE_ERROR
+        stats.append((time.perf_counter() - t0, n))
+    return name, stats
+
+def summarize_profile(results, n_rules):
+    """
+    汇总各文件的结果 [(文件名, [(耗时, 次数)])] -> 按规则顺序的
+    [{'time': 总耗时, 'matches': 替换次数, 'files': 命中文件数, 'errors': 出错文件数, 'timeouts': 超时文件数, 'worst': (最慢文件, 耗时)}]
+    """
+    summary = [{'time': 0.0, 'matches': 0, 'files': 0, 'errors': 0, 'timeouts': 0, 'worst': ('', 0.0)} for _ in range(n_rules)]
+    for name, stats in results:
+        for s, (sec, n) in zip(summary, stats):
+            s['time'] += sec
+            if n == PROFILE_TIMEOUT: s['timeouts'] += 1
+            elif n < 0: s['errors'] += 1
+            elif n: s['matches'] += n; s['files'] += 1
+            if sec > s['worst'][1]: s['worst'] = (name, sec)
+    return summary
 
 class AutoScrollbar(ttk.Scrollbar):
     """自动隐藏的滚动条，place到canvas左侧，不影响布局宽度"""
@@ -22,7 +63,7 @@ class AutoScrollbar(ttk.Scrollbar):
         super().set(lo, hi)
 
 class RegexManager:
-    def __init__(self, root, config_path="config.ini", log_level_var=None, parent=None):
+    def __init__(self, root, config_path="config.ini", log_level_var=None, parent=None, config_text=None):
         self.root = root
         self.config_file = Path(config_path)
         self.regex_entries = []
@@ -32,7 +73,7 @@ class RegexManager:
         self.selected_ini = tk.StringVar(value=str(self.config_file))  # 当前选中的ini文件
         self.parent = parent  # 主程序对象
         self.init_ui()
-        self.load_config()
+        self.load_config(text=config_text)
 
     def _init_ini_files(self):
         """初始化ini文件列表并更新下拉框"""
@@ -59,8 +100,9 @@ class RegexManager:
         self.frame.pack(fill=tk.BOTH, padx=5, pady=5, expand=True)
         btn_frame = tk.Frame(self.frame)
         btn_frame.pack(fill=tk.X, pady=3)
-        [tk.Button(btn_frame, text=t, command=c, font=("宋体", 12)).pack(side=tk.LEFT, padx=2)
-         for t, c in [("添加正则", self.add_entry), ("保存设置", None)]]
+        btns = [tk.Button(btn_frame, text=t, command=c, font=("宋体", 12)) for t, c in [("添加正则", self.add_entry), ("保存设置", None), ("规则分析", self.profile_rules)]]
+        [b.pack(side=tk.LEFT, padx=2) for b in btns]
+        ToolTip(btns[2], "用当前规则分析EPUB(已载入的EPUB，没有则选择)\n统计各规则耗时/替换次数/命中文件数/最慢文件")
         # 配置文件下拉框，限制宽度为20
         ini_menu = ttk.Combobox(btn_frame, textvariable=self.selected_ini, values=[], state="readonly", font=("宋体", 12), width=11)
         ini_menu.pack(side=tk.LEFT, padx=2)
@@ -110,13 +152,14 @@ class RegexManager:
         logger.add(sys.stderr, level=level.upper())
         if show_log: logger.log(level.upper(), "日志级别: {}", level)
 
-    def load_config(self, config_path=None):
+    def load_config(self, config_path=None, text=None):
+        """加载规则，text为主程序启动时已读取的配置文件内容(避免重复读盘)，切换ini时为None从文件读取"""
         if config_path:
             self.config_file = Path(config_path)
         # 清空UI（防止重复加载）
         [entry[2].destroy() for entry in getattr(self, 'regex_entries', []) if hasattr(entry[2], 'destroy')]
         self.regex_entries, self.tooltips = [], []
-        self._load_from_ini() if self.config_file.exists() else (self._create_default_rules())
+        self._load_from_ini(text) if text is not None or self.config_file.exists() else (self._create_default_rules())
         self._init_ini_files()
         # 保持下拉框选中项同步
         if hasattr(self, 'ini_names') and hasattr(self, 'ini_menu'):
@@ -126,24 +169,23 @@ class RegexManager:
             except Exception:
                 pass
 
-    def _load_from_ini(self):
+    def _load_from_ini(self, text=None):
         """ini配置加载"""
-        with open(self.config_file, 'r', encoding='utf-8') as f:
-            current_rule, current_key = { }, None
-            lines = [line.rstrip('\n') for line in f]
-            for line in lines:
-                if line.strip() == "[RegexRules]": continue
-                if line.startswith('rule_'):
-                    current_rule and self._add_rule_from_dict(current_rule)
-                    current_rule, current_key = {}, None
-                    continue
-                if not line.strip(): continue
-                if '=' in line:
-                    key, value = line.split('=', 1)
-                    current_rule[key.strip()], current_key = value, key.strip()
-                elif current_key and (line.startswith(' ') or line.startswith('\t')):
-                    current_rule[current_key] += '\n' + line.lstrip()
-            current_rule and self._add_rule_from_dict(current_rule)
+        current_rule, current_key = { }, None
+        lines = (self.config_file.read_text('utf-8') if text is None else text).split('\n')
+        for line in lines:
+            if line.strip() == "[RegexRules]": continue
+            if line.startswith('rule_'):
+                current_rule and self._add_rule_from_dict(current_rule)
+                current_rule, current_key = {}, None
+                continue
+            if not line.strip(): continue
+            if '=' in line:
+                key, value = line.split('=', 1)
+                current_rule[key.strip()], current_key = value, key.strip()
+            elif current_key and (line.startswith(' ') or line.startswith('\t')):
+                current_rule[current_key] += '\n' + line.lstrip()
+        current_rule and self._add_rule_from_dict(current_rule)
 
     def _add_rule_from_dict(self, rule_dict):
         """从字典添加规则"""
@@ -322,6 +364,117 @@ class RegexManager:
             if entry[0].get().strip()
         ]
 
+    def profile_rules(self):
+        """
+        规则耗时分析：当前规则列表按顺序作用于EPUB内全部html(已载入的EPUB，没有则选择)，按文件并行，后台线程执行不阻塞界面
+        除非指定线程后端，一律用带看门狗的进程池(小书也是)：单条规则在一个文件上超过MP_RULE_TIMEOUT时结束worker，
+        该文件跳过这条规则重新分析，其余文件继续；结果写入各规则的悬浮提示并标出耗时大/出错/超时(红)与未命中(灰)的规则，另开窗口列出明细并可导出CSV
+        """
+        if getattr(self, '_profiling', False): return logger.warning("规则分析进行中")
+        if not (epub := getattr(self.parent, 'epub_path', None) or filedialog.askopenfilename(filetypes=[('EPUB文件', '*.epub')])): return
+        entries = [e for e in self.regex_entries if e[2].winfo_exists() and e[0].get().strip()]
+        if not entries: return messagebox.showwarning("警告", "没有可分析的正则规则")
+        rules = [(e[0].get(), e[1].get()) for e in entries]
+        backend = self.parent._settings_vars_dict['executor_backend_var'].get() if self.parent else 'Auto'
+        self._profiling, state = True, {}
+        def work():
+            try:
+                t0 = time.perf_counter()
+                with zipfile.ZipFile(epub) as z:
+                    tasks = [((n, z.read(n).decode('utf-8', 'ignore'), rules, frozenset()), z.getinfo(n).file_size)
+                             for n in z.namelist() if n.lower().endswith(('.xhtml', '.html'))] # 与转换流水线处理的文件一致
+                largest = max((c for _, c in tasks), default=0)
+                mode, wk, _ = choose_strategy(estimate_cost(tasks), auto_workers(8, largest)[0], resolve_backend(backend))
+                if resolve_backend(backend) == 'process': mode = 'process' # 超时的正则只能结束worker进程中断
+                else: logger.warning("规则分析使用线程后端，超时的规则无法中断(看门狗仅对进程池生效)")
+                watch = TaskWatch(len(tasks), MP_RULE_TIMEOUT, MP_FILE_TIMEOUT) if mode == 'process' else None
+                results, timeouts, running = [], {}, {} # timeouts: {任务号: {规则序号: 超时前已用秒}}
+                with make_executor(mode, wk, largest, watch=watch) as executor:
+                    def submit(items): # items: [(任务号, 参数)]
+                        running[executor.submit(run_batch, mp_profile_rules, [a for _, a in items], [t for t, _ in items])] = items
+                    [submit(batch) for batch, _ in plan_batches([((i, arg), c) for i, (arg, c) in enumerate(tasks)], wk)]
+                    while running:
+                        done, _ = wait(running, timeout=MP_WATCH_INTERVAL if watch else None, return_when=FIRST_COMPLETED)
+                        if watch:
+                            for tid, step, kind, sec in watch.check([t for items in running.values() for t, _ in items]):
+                                logger.warning(f"规则分析超时 结束worker: {tasks[tid][0][0]}" + (f" 规则{step + 1}" if step >= 0 else "") + f" {sec:.0f}s")
+                        for future in done:
+                            items = running.pop(future)
+                            try: batch = future.result()
+                            except BrokenExecutor: # 进程池中有worker被看门狗结束：超时的文件跳过该规则，其余(含已完成但结果随批次丢失的)重新提交
+                                if not watch: raise
+                                retry = []
+                                for tid, (name, content, rs, skip) in items:
+                                    step, _, sec = watch.killed.get(tid) or (None, None, 0.0); watch.reset(tid)
+                                    if step is None: retry.append((tid, (name, content, rs, skip))); continue
+                                    if step < 0: logger.error(f"规则分析超时 [{name}] {sec:.0f}s，已放弃该文件"); continue
+                                    timeouts.setdefault(tid, {})[step] = sec; retry.append((tid, (name, content, rs, skip | {step})))
+                                if retry: submit(retry)
+                                continue
+                            for (tid, _), ((name, stats), _) in zip(items, batch):
+                                for step, sec in timeouts.get(tid, {}).items(): stats[step] = (sec, PROFILE_TIMEOUT)
+                                results.append((name, stats))
+                state.update(summary=summarize_profile(results, len(rules)), files=len(results), wall=time.perf_counter() - t0, mode=f"{mode} x{wk}")
+            except BaseException as e: state['error'] = e # 任何异常都要让poll结束，否则_profiling一直为真
+        def poll():
+            if not state: return self.root.after(50, poll)
+            self._profiling = False
+            if 'error' in state: return logger.error(f"规则分析失败: {state['error']}")
+            self._apply_profile(entries, rules, state['summary'])
+            self._show_profile(epub, rules, state)
+        threading.Thread(target=work, name="regex_profile", daemon=True).start()
+        logger.info(f"规则分析开始: {len(rules)} 条规则 {Path(epub).name}")
+        poll()
+
+    def _apply_profile(self, entries, rules, summary):
+        """分析结果写入规则悬浮提示(note 不随配置保存)并按耗时/命中情况标色，分析期间已删除或改动的规则跳过"""
+        total = sum(s['time'] for s in summary) or 1e-9
+        for e, (pattern, _), s in zip(entries, rules, summary):
+            if not e[2].winfo_exists() or e[0].get() != pattern: continue
+            note = (f"[分析] 耗时 {s['time'] * 1000:.1f}ms ({s['time'] / total:.0%})，替换 {s['matches']} 次 / {s['files']} 个文件"
+                    + (f"\n最慢: {s['worst'][0]} {s['worst'][1] * 1000:.1f}ms" if s['worst'][0] else "")
+                    + (f"\n{s['errors']} 个文件出错" if s['errors'] else "")
+                    + (f"\n{s['timeouts']} 个文件超时(≥{MP_RULE_TIMEOUT:.0f}s) 已中止: {s['worst'][0]} 等" if s['timeouts'] else ""))
+            e[3].note = e[4].note = note
+            kind = 'slow' if s['errors'] or s['timeouts'] or s['time'] / total >= PROFILE_SLOW_SHARE else 'dead' if not s['files'] else None
+            e[0].config(bg=PROFILE_COLORS.get(kind, 'white'))
+
+    def _show_profile(self, epub, rules, state):
+        """分析明细窗口：按耗时降序列出各规则，可导出CSV"""
+        summary, total = state['summary'], sum(s['time'] for s in state['summary']) or 1e-9
+        logger.info(f"规则分析完成: {state['files']} 个文件，{state['mode']}，规则总耗时 {total:.2f}s，墙钟 {state['wall']:.2f}s")
+        rows = sorted(((i + 1, p, s) for i, ((p, _), s) in enumerate(zip(rules, summary))), key=lambda r: r[2]['time'], reverse=True)
+        win = tk.Toplevel(self.root)
+        win.title(f"规则耗时分析 - {Path(epub).name}")
+        win.geometry(f"640x360+{self.root.winfo_x()+150}+{self.root.winfo_y()+150}"); win.focus_force()
+        frame = ttk.Frame(win); frame.pack(fill="both", expand=True, padx=8, pady=(8, 0))
+        cols = ("no", "regex", "time", "share", "matches", "files", "worst")
+        tree = ttk.Treeview(frame, columns=cols, show="headings")
+        [tree.heading(c, text=t) for c, t in zip(cols, ("#", "正则", "耗时ms", "占比", "替换次数", "命中文件", "最慢文件"))]
+        [tree.column(c, width=w, stretch=c in ("regex", "worst")) for c, w in zip(cols, (30, 180, 70, 50, 70, 60, 160))]
+        tree.tag_configure('slow', background=PROFILE_COLORS['slow']); tree.tag_configure('dead', background=PROFILE_COLORS['dead'])
+        for no, p, s in rows:
+            kind = 'slow' if s['errors'] or s['timeouts'] or s['time'] / total >= PROFILE_SLOW_SHARE else 'dead' if not s['files'] else ''
+            tree.insert("", "end", tags=(kind,), values=(no, p, f"{s['time'] * 1000:.1f}", f"{s['time'] / total:.0%}",
+                        f"{s['matches']}" + (f" (出错{s['errors']})" if s['errors'] else "") + (f" (超时{s['timeouts']})" if s['timeouts'] else ""),
+                        s['files'], (f"超时 ≥{MP_RULE_TIMEOUT:.0f}s: " if s['timeouts'] else "") + s['worst'][0]))
+        tree.pack(fill="both", expand=True, side="left")
+        vsb = ttk.Scrollbar(frame, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=vsb.set); vsb.pack(side="right", fill="y")
+        def export():
+            if not (fn := filedialog.asksaveasfilename(parent=win, defaultextension='.csv', filetypes=[('CSV文件', '*.csv')],
+                                                       initialfile=f"{Path(epub).stem}_regex_profile.csv")): return
+            import csv
+            try:
+                with open(fn, 'w', encoding='utf-8-sig', newline='') as f: # 带BOM Excel可直接打开
+                    w = csv.writer(f)
+                    w.writerow(["序号", "正则", "替换", "耗时ms", "占比", "替换次数", "命中文件数", "出错文件数", "超时文件数", "最慢文件", "最慢文件耗时ms"])
+                    w.writerows([no, p, rules[no - 1][1], f"{s['time'] * 1000:.3f}", f"{s['time'] / total:.4f}", s['matches'], s['files'],
+                                 s['errors'], s['timeouts'], s['worst'][0], f"{s['worst'][1] * 1000:.3f}"] for no, p, s in rows)
+                logger.info(f"规则分析已导出: {fn}")
+            except Exception as e: messagebox.showerror("导出失败", str(e), parent=win)
+        ttk.Button(win, text="导出CSV", command=export).pack(pady=5)
+
     def update_ini_files(self):
         """刷新ini列表"""
         ini = str(self.config_file)
@@ -1,34 +1,35 @@
 import atexit
+import contextlib
 import os
 import re
 import sys
-import copy
 import zipfile
 import tempfile
 import time
 import subprocess
 import shutil
 from pathlib import Path
-from urllib.parse import unquote
+from urllib.parse import quote, unquote
 import configparser
+import hashlib
 
 # 多线程并发导入
 import threading
 import multiprocessing
 import concurrent.futures
 
-import psutil
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from tkinterdnd2 import DND_FILES, TkinterDnD
-from bs4 import BeautifulSoup, NavigableString # bs4需要lxml库 会优先自动使用
 from loguru import logger
 
 from Image import icon_base64
 from tooltip import ToolTip
-from epub_ncx_generator import EpubNCXGenerator
 from regex_manager import RegexManager, AutoScrollbar
-from class_list import ClassList
+from worker_pool import (run_batch, plan_batches, lpt_makespan, makespan_report, estimate_cost, choose_strategy, auto_workers,
+                         resolve_backend, make_executor, benchmark, run_stages, BACKENDS, TaskWatch, WatchedCall, TaskTimeout, guarded, watch_step, WATCH_COMMITTED,
+                         split_budget, IMAGE_WORKER_RSS, MP_RULE_TIMEOUT, MP_FILE_TIMEOUT, MP_WATCH_INTERVAL)
+# bs4(需要lxml库 会优先自动使用)、psutil及目录/Class分析/书籍索引模块在各函数首次使用时才导入，缩短启动到窗口显示的时间
 
 # ===================================================================== #
 # 多进程工作函数 (提取到模块层级，脱离GUI依赖，实现纯数据流转)
@@ -41,6 +42,54 @@ def mp_fmt(soup):
     return soup.decode(formatter=HTMLFormatter(entity_substitution=lambda s: 
         sub_func(s).replace('\u00A0', '&#160;')))
 
+MP_BODY_OPEN_RE = re.compile(r'<body\b[^>]*>', re.I)
+MP_BLANK_MARK = 'sesame-blank'
+MP_CHUNK_BYTES = 256 * 1024 # 超过2倍该大小的xhtml按body顶层子节点分块并行处理
+MP_TAG_RE = re.compile(r'<!--.*?-->|<(/?)([A-Za-z][^\s/>]*)(?:[^>"\']|"[^"]*"|\'[^\']*\')*>', re.S)
+MP_VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+MP_BLANK_MARK_RE = re.compile(rf'<!--{MP_BLANK_MARK}-->(.*?)<!--/{MP_BLANK_MARK}-->', re.S)
+# html/svg的src/href/xlink:href属性值与css url()：带引号的值到配对的引号为止(可含括号)，只有不带引号的url()到)为止
+# 分组 (前缀, 值) 依次为 (1, 3) 属性 / (4, 6) 带引号url / (7, 8) 不带引号url
+MP_REF_RE = re.compile(r'''((?<![\w-])((?:xlink:)?href|src(set)?)\s*=\s*(["']))((?:(?!\4).)*)|(url\(\s*(["']))((?:(?!\7).)*)|(url\(\s*)([^"'()\s][^)\s]*)''', re.I)
+MP_SRCSET_RE = re.compile(r'(^|,)(\s*)([^\s,](?:\S*[^\s,])?)') # srcset的各候选 "地址 描述符, 地址 描述符"
+MP_REF_SUFFIXES = ('.xhtml', '.html', '.htm', '.css', '.svg')
+
+def mp_split_chunks(inner, chunk_bytes):
+    """
+    按body顶层子节点把片段切分为约chunk_bytes大小的分块(纯文本扫描 不构建DOM)
+    只在标签深度0处切分；顶层ruby之后(中间只隔script/style也算)不切分，保证连续ruby合并所需的相邻关系；结构异常时深度回不到0则不切分
+    """
+    chunks, start, depth, pos, after_ruby = [], 0, 0, 0, False
+    while (m := MP_TAG_RE.search(inner, pos)):
+        pos, (close, name) = m.end(), (m.group(1), (m.group(2) or '').lower())
+        if not name: continue # 注释
+        if close: depth = max(depth - 1, 0)
+        elif name in ('script', 'style'): # 原始文本元素 直接跳到结束标签
+            pos = e.end() if (e := re.compile(rf'</{name}\s*>', re.I).search(inner, pos)) else len(inner)
+        elif not m.group(0).endswith('/>') and name not in MP_VOID_TAGS: depth += 1
+        if depth: continue
+        if name not in ('script', 'style'): after_ruby = name == 'ruby'
+        if pos - start >= chunk_bytes and not after_ruby:
+            chunks.append(inner[start:pos]); start = pos
+    return chunks + [inner[start:]]
+
+def mp_split_body(content):
+    """按body标签切分文本为(body前含<body>, body内, </body>起的尾部)，无body返回None"""
+    if not (m := MP_BODY_OPEN_RE.search(content)): return None
+    end = max(content.rfind('</body'), content.rfind('</BODY'))
+    end = end if end >= m.end() else len(content)
+    return content[:m.end()], content[m.end():end], content[end:]
+
+def mp_expand_large_file(xf_str, chunk_bytes):
+    """把大xhtml拆成骨架文件(头部+空body)与若干分块文件，返回(骨架路径, [分块路径])；无body或只有一块时返回None"""
+    with open(xf_str, 'r', encoding='utf-8') as f: content = f.read()
+    if not (sp := mp_split_body(content)) or len(chunks := mp_split_chunks(sp[1], chunk_bytes)) < 2: return None
+    skel, chunk_strs = f"{xf_str}.skel", [f"{xf_str}.{i:03d}.part" for i in range(len(chunks))]
+    with open(skel, 'w', encoding='utf-8') as f: f.write(f"{sp[0]}\n{sp[2]}")
+    for path, chunk in zip(chunk_strs, chunks):
+        with open(path, 'w', encoding='utf-8') as f: f.write(chunk)
+    return skel, chunk_strs
+
 def mp_process_ruby(soup):
     """Ruby标签规格化处理 合并连续的ruby标理"""
     ruby_tags, i = soup.find_all('ruby'), 0
@@ -135,8 +184,13 @@ def mp_post_process_images(soup):
                     else:  # 如果是 svg，替换 svg
                         tag.replace_with(new_div)
 
-def mp_process_blank_lines(soup, remove_blank, limit_blank, remove_head_blank=False):
-    """全局空行清理与连续空行限制、首部空行清理"""
+def mp_process_blank_lines(soup, remove_blank, limit_blank, remove_head_blank=False, mark_lead=False):
+    """
+    全局空行清理与连续空行限制、首部空行清理
+    mark_lead: 用于合并拼接的片段，开头连续空行的去留取决于前文，只用注释包裹标记，交由mp_resolve_blank_marks裁决
+    返回(开头空行数, 是否全为空行, 结尾空行数) 供拼接阶段接续空行状态
+    """
+    from bs4 import Comment
     def is_blank_tag(tag):
         if tag.name == 'br': return True
         if tag.name == 'p':
@@ -165,14 +219,15 @@ def mp_process_blank_lines(soup, remove_blank, limit_blank, remove_head_blank=Fa
 
     body = soup.body if soup.body else soup
     all_nodes = list(flatten_nodes(body))  # DOM树扁平化采样
-    if not all_nodes: return
+    if not all_nodes: return (0, True, 0)
     to_delete_ids = set() # 存放需要删除节点的内存地址
-    cursor = 0
-    # 1. 计算清理首部空行 通过游标快速定位第一个实质内容
-    if remove_head_blank:
+    cursor, trail = 0, 0
+    # 1. 计算清理首部空行 通过游标快速定位第一个实质内容 (标记模式下只包裹标记 不删除)
+    if remove_head_blank or mark_lead:
         for node in all_nodes:
             if hasattr(node, 'name') and is_blank_tag(node):
-                to_delete_ids.add(id(node))
+                if mark_lead: node.insert_before(Comment(MP_BLANK_MARK)); node.insert_after(Comment(f'/{MP_BLANK_MARK}'))
+                else: to_delete_ids.add(id(node))
                 cursor += 1
             else: break # 遇到第一个非空行节点停止
     # 2.计算连续空行的删除与限制
@@ -191,13 +246,32 @@ def mp_process_blank_lines(soup, remove_blank, limit_blank, remove_head_blank=Fa
                 group.append(node)
             elif group:
                 process_group(group); group.clear()
+        trail = len(group)
         if group: process_group(group) # 收尾最后一组
     # 3. 统一执行物理删除
     for node in all_nodes:
         if id(node) in to_delete_ids: node.decompose()
+    return (cursor, cursor == len(all_nodes), cursor if cursor == len(all_nodes) else trail)
+
+def mp_resolve_blank_marks(fragment, summary, state, remove_blank, limit_blank):
+    """
+    按前文状态裁决片段开头被标记的空行，并原地更新state
+    state: {'head': 仍处于文件首部(首部空行清理), 'run': 前文结尾连续空行数}
+    缺少摘要(如进程池损坏后结果丢失且无法读取.blank)时无法裁决，只去掉标记保留空行
+    """
+    if not summary: return MP_BLANK_MARK_RE.sub(r'\1', fragment) if MP_BLANK_MARK in fragment else fragment
+    lead, all_blank, trail = summary
+    d = int(remove_blank) if remove_blank != '-' else 0
+    l = int(limit_blank) if limit_blank != '-' else float('inf')
+    pos = iter(range(state['run'], state['run'] + lead))
+    fragment = MP_BLANK_MARK_RE.sub(lambda m: '' if state['head'] or not (d <= next(pos) < d + l) else m.group(1), fragment)
+    if not all_blank: state.update(head=False, run=trail)
+    elif not state['head']: state['run'] += lead
+    return fragment
 
 def mp_normalize_xhtml_header(soup, lang_val, rel_css):
     """xhtml规格化头部信息与CSS重建"""
+    from bs4 import NavigableString
     html = soup.find('html') or soup.append(soup.new_tag('html')) or soup.find('html')
     # 规格化 HTML 属性
     html.attrs = {'xmlns': "http://www.w3.org/1999/xhtml", 'xmlns:epub': "http://www.idpf.org/2007/ops", 'xml:lang': lang_val}
@@ -213,6 +287,7 @@ def mp_normalize_xhtml_header(soup, lang_val, rel_css):
 
 def set_low_priority():
     """调用psutil设置低优先度"""
+    import psutil
     try:
         level = psutil.BELOW_NORMAL_PRIORITY_CLASS if os.name == 'nt' else 10
         psutil.Process(os.getpid()).nice(level)
@@ -225,6 +300,7 @@ def mp_process_single_file_pipeline(args):
     完全独立于主进程的 GUI 和 TKinter。纯数据驱动。
     可调整执行顺序
     """
+    from bs4 import BeautifulSoup
     (xf_str, rel_css, lang_val, class_name, flags, regex_rules) = args
     
     try:
@@ -234,7 +310,8 @@ def mp_process_single_file_pipeline(args):
         # ==============================================================
         # 1: 首次 BS4 解析 (修正头部、执行 Ruby 与傍点转换)
         soup = BeautifulSoup(content, 'html.parser')
-        if flags.get('is_style'): mp_normalize_xhtml_header(soup, lang_val, rel_css)
+        if flags.get('is_style') and not flags.get('fragment'): mp_normalize_xhtml_header(soup, lang_val, rel_css)
+        elif flags.get('is_style') or flags.get('strip_script'): [s.decompose() for s in soup.select('script')] # 分块片段没有头部、被合并文件 只清理script
         if flags.get('is_process_ruby'): mp_process_ruby(soup)
         if flags.get('is_modify_html'): mp_modify_html(soup, class_name)
 
@@ -243,31 +320,118 @@ def mp_process_single_file_pipeline(args):
         # ==============================================================
         # 2: 正则替换 如果正则破坏了结构(例如出现孤立的</span>)，将在步骤3被自动修复
         if regex_rules:
-            for pattern, repl in regex_rules:
-                try:
-                    content = re.sub(pattern, repl, content)
-                except Exception:
-                    pass # 忽略编写错误的正则，防止整书崩溃
+            skip = set(flags.get('skip_rules', ())) # 曾在本文件上超时的规则序号
+            while True: # 当前线程/线程池执行时正则在看门狗子进程中执行，超时的规则跳过后重做
+                try: content = guarded(mp_apply_rules, (content, regex_rules, skip)); break
+                except TaskTimeout as e:
+                    if e.args[0] < 0: raise
+                    logger.error(f"正则超时 [{Path(xf_str).name}] 规则{e.args[0] + 1} {regex_rules[e.args[0]][0].pattern} 用时超过{e.args[2]:.0f}s，已跳过该规则重新处理")
+                    skip.add(e.args[0])
 
         # ==============================================================
         # 3: 二次BS4解析 (兜底纠错、处理图片交互与空行)
         soup = BeautifulSoup(content, 'html.parser')
 
         if flags.get('is_process_images'): mp_post_process_images(soup)
+        blank = None # 合并组片段(blank_mark)返回空行状态摘要 供拼接阶段跨文件接续
         if flags.get('remove_blank') != '-' or flags.get('limit_blank') != '-' or flags.get('remove_head_blank'):
-            mp_process_blank_lines(soup, flags.get('remove_blank'), flags.get('limit_blank'), flags.get('remove_head_blank'))
+            blank = mp_process_blank_lines(soup, flags.get('remove_blank'), flags.get('limit_blank'), flags.get('remove_head_blank'), flags.get('blank_mark', False))
 
         # ==============================================================
         # 4: XML声明与保存
-        if flags.get('is_style') and (html_tag := soup.find('html')): # 只输出html标签内的内容 强制规格化xml声明跟DOCTYPE信息
+        if flags.get('is_style') and not flags.get('fragment') and (html_tag := soup.find('html')): # 只输出html标签内的内容 强制规格化xml声明跟DOCTYPE信息
             content = f'<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE html>\n\n{mp_fmt(html_tag)}'
-        else: # 如果没勾选样式修改，则直接导出整个soup 
+        else: # 如果没勾选样式修改或为分块片段，则直接导出整个soup 
             content = mp_fmt(soup)
 
-        Path(xf_str).write_text(content, 'utf-8')
-        return (True, xf_str, "")
+        if flags.get('blank_mark') and blank: Path(f"{xf_str}.blank").write_text(' '.join(str(int(v)) for v in blank), 'utf-8') # 先于提交落盘 结果丢失时由主进程读回
+        Path(tmp := f"{xf_str}.tmp").write_text(content, 'utf-8'); os.replace(tmp, xf_str) # 原子写入 进程池损坏时已写入的文件不会被重复处理
+        watch_step(WATCH_COMMITTED)
+        return (True, xf_str, "", blank if flags.get('blank_mark') else None)
     except Exception as e:
-        return (False, xf_str, str(e))
+        return (False, xf_str, str(e), None)
+
+def mp_apply_rules(args):
+    """正则替换步骤：(文本, [(正则, 替换)], 跳过的规则序号) -> 文本，按顺序链式替换，每条规则开始时向看门狗登记步骤"""
+    content, regex_rules, skip = args
+    for i, (pattern, repl) in enumerate(regex_rules):
+        if i in skip: continue
+        watch_step(i) # 看门狗按规则计时(灾难性回溯时re.sub不可中断 超时由主进程结束worker)
+        try:
+            content = re.sub(pattern, repl, content)
+        except Exception:
+            pass # 忽略编写错误的正则，防止整书崩溃
+    watch_step()
+    return content
+
+def mp_join_document(args):
+    """
+    拼接任务(多进程)：章节合并组或大文件分块的各片段已由各自worker独立处理
+    外壳文件提供头部与尾部，按顺序写入各片段的body内容，片段开头的空行标记按前文状态裁决，使空行规则跨拼接处生效
+    items: [(类型, 文本或路径, 空行摘要)] 类型 text=分隔符文本 file=正文片段 sub=被合并文件(worker已去除script 只取body)
+    """
+    (out_str, (shell_str, shell_summary), blank_cfg, items) = args
+    remove_blank, limit_blank, remove_head_blank = blank_cfg
+    state = {'head': bool(remove_head_blank), 'run': 0}
+    resolve = lambda text, summary: mp_resolve_blank_marks(text, summary, state, remove_blank, limit_blank)
+    try:
+        if not (shell := mp_split_body(Path(shell_str).read_text('utf-8'))): return (False, out_str, "缺失body", None)
+        with open(tmp := f"{out_str}.tmp", 'w', encoding='utf-8') as out: # 写入临时文件后替换 片段在替换后才删除 中断时可整体重试
+            out.write(shell[0]); out.write(resolve(shell[1], shell_summary))
+            for kind, value, summary in items:
+                if kind == 'text': out.write(resolve(value, summary)); continue
+                text = sp[1] if (sp := mp_split_body(text := Path(value).read_text('utf-8'))) else text
+                out.write(resolve(text, summary))
+                del text, sp
+            out.write(shell[2])
+        os.replace(tmp, out_str); watch_step(WATCH_COMMITTED)
+        [Path(value).unlink(missing_ok=True) for kind, value, _ in items if kind != 'text']
+        if shell_str != out_str: Path(shell_str).unlink(missing_ok=True)
+        return (True, out_str, "", None)
+    except Exception as e:
+        return (False, out_str, str(e), None)
+
+def mp_concat_document(out_str, shell_str, items):
+    """
+    拼接任务失败时的兜底(主进程)：不裁决拼接处的空行，只去掉空行标记后按顺序写入各片段的body内容
+    外壳缺失body时片段插在</html>之前(没有则接在末尾)；完成后删除片段与骨架文件。items同拼接任务但不含空行摘要
+    """
+    text = Path(shell_str).read_text('utf-8')
+    if not (shell := mp_split_body(text)): shell = (text[:(end := text.rfind('</html') if '</html' in text else len(text))], '', text[end:])
+    body = [shell[1], *(v[0] if k == 'text' else (sp[1] if (sp := mp_split_body(t := Path(v).read_text('utf-8'))) else t) for k, v in items)]
+    Path(tmp := f"{out_str}.tmp").write_text(shell[0] + MP_BLANK_MARK_RE.sub(r'\1', ''.join(body)) + shell[2], 'utf-8'); os.replace(tmp, out_str)
+    [Path(v).unlink(missing_ok=True) for k, v in items if k != 'text']
+    if shell_str != out_str: Path(shell_str).unlink(missing_ok=True)
+
+def mp_rewrite_refs(args):
+    """
+    单文件资源引用改写(多进程)：只匹配src/srcset/href/xlink:href属性值(不区分大小写 data-src等不匹配)与css url()，
+    去掉?查询与#片段后按所在目录解析为绝对路径精确查表，文件名相同的无关文本不受影响
+    args: (文件路径, {原绝对路径: 新绝对路径})；同目录只替换文件名保留原写法，否则写为相对路径；返回(是否成功, 文件路径, 错误, 改写数)
+    """
+    (file_str, path_map) = args
+    base, count = os.path.realpath(os.path.dirname(file_str)), 0
+    def fix(val):
+        nonlocal count
+        ref, tail = re.match(r'([^?#]*)(.*)', val, re.S).groups()
+        if not ref or ':' in ref or not (target := path_map.get(os.path.normpath(os.path.join(base, unquote(ref))))): return val
+        count += 1
+        head, _, _ = ref.rpartition('/')
+        enc = (lambda s: quote(s, safe='/')) if unquote(ref) != ref else (lambda s: s) # 保持原引用的写法 原本未转义的(如日文文件名)不做百分号编码
+        if os.path.dirname(target) == os.path.normpath(os.path.join(base, unquote(head))): new = (head + '/' if '/' in ref else '') + enc(os.path.basename(target))
+        else: new = enc(os.path.relpath(target, base).replace('\\', '/'))
+        return new + tail
+    def repl(m):
+        pre, val = next((m.group(i), m.group(j)) for i, j in ((1, 5), (6, 8), (9, 10)) if m.group(i) is not None)
+        if m.group(3): return pre + MP_SRCSET_RE.sub(lambda c: c.group(1) + c.group(2) + fix(c.group(3)), val)
+        return pre + fix(val)
+    try:
+        content = Path(file_str).read_text('utf-8')
+        if (new := MP_REF_RE.sub(repl, content)) != content: Path(file_str).write_text(new, 'utf-8')
+        return (True, file_str, "", count)
+    except Exception as e:
+        return (False, file_str, str(e), 0)
+
 # ===================================================================== #
 
 class EpubProcessor:
@@ -276,6 +440,7 @@ class EpubProcessor:
         self.regex_entries = []
         self.excluded_toc_entries = []
         self._exclude_tempdirs = set()
+        self._book_indexes = {} # {opf路径: BookIndex} 解压后构建 处理结束时释放
         self.sesame_root = Path(tempfile.gettempdir(), "sesame_cache"); self.sesame_root.mkdir(parents=True, exist_ok=True)
         FONT = ("宋体", 12)
 
@@ -331,22 +496,26 @@ class EpubProcessor:
             ('convert_images_var', '转换图片', '图片转换设置', [
                 ('image_params_var', '-f webp -q80 -H1300 -s1 -w8 -A', tk.Entry, {'w': 10, 'sticky': 'ew'}, 
                  ('-f 可选webp,jpg,png\n-q 质量\n-H -W 高宽按比例缩小,小图不放大\n'
-                  '-s 锐化 默认1.0不处理\n-A 保留透明通道Alpha\n-w 线程数\n-m WebP压缩等级 1-6'))]),
+                  '-s 锐化 默认1.0不处理\n-A 保留透明通道Alpha\n-w 线程数\n-m WebP压缩等级 1-6')),
+                ('image_dedup_enabled', '合并重复', tk.Checkbutton, {'px': (3, 0)}, '内容相同的图片只编码一次\n勾选: 合并为同一个manifest条目并改写引用\n不勾选: 复制为各自独立的文件\n封面(properties/meta cover/guide cover)不合并')]),
             ('auto_override_enabled', '旋转图片', '用于 飾り罫線 自动旋转\n超过阈值追加覆盖成新的转换参数\n需要触发阈值、没被排除、-R参数命中才会旋转', [
+                ('override_classify_enabled', '罫線识别', tk.Checkbutton, {'px': (3, 0)}, '按像素特征(长宽比/墨迹密度/行列投影)识别罫線图片 需要numpy\n勾选: 由识别结果决定追加参数的图片，阈值只用于无法识别的图片(含非细长的纯色图)\n不勾选(默认): 按出现次数阈值'),
                 ('override_count_var', '10', tk.Entry, {'w': 3}, '触发追加参数的最低出现次数阈值'),
                 ('override_skip_var', 'gaiji', tk.Entry, {'w': 8, 'px': (4,0)}, '正则排除图片(匹配class或src)\n例:gaiji|cover\\.jpg |隔开多个输入'),
                 ('override_param_var', '-r -90 -R 1:2', tk.Entry, {'w': 25, 'px': (4,0), 'sticky': 'ew'}, 
                  '追加覆盖的参数\n-r-90 [旋转方向(+90,-90,180,270)默认0不旋转]\n-R1:2 [触发旋转的比例(1.5, 128x1366, 1:2)，为空则不限制]')]),
             ('set_lang_enabled', '语言标识', 'opf跟head的头部语言标识参数', [
                 ('set_lang_var', 'ja', tk.Entry, {'w': 10}, 'ja\nzh-CN'),
-                ('max_workers_var', 'Auto', ttk.Combobox, {'w': 4, 'px': (110,0), 'val': ['Auto']+[str(i) for i in range(1, 33)]}, '多线程/进程并发数\nAuto限制最高为8')]),
+                ('max_workers_var', 'Auto', ttk.Combobox, {'w': 4, 'px': (110,0), 'val': ['Auto']+[str(i) for i in range(1, 33)]}, '多线程/进程并发数\nAuto限制最高为8'),
+                ('executor_backend_var', 'Auto', ttk.Combobox, {'w': 6, 'px': (3,0), 'val': BACKENDS}, '并行后端\nAuto: 自由线程版Python(GIL禁用)用线程，否则用进程\nProcess: 进程池\nThread: 线程池(免序列化)')]),
             ('remove_head_blank_enabled', '清理首部空行', '自动删除顶部空行 遇到非空节点停止\n(属于全局空行删除与限制的附加功能)', []),
         ]
+        self.CFG_OFF = {'image_dedup_enabled', 'override_classify_enabled'} # 默认不勾选的开关(会改写书籍结构或改变既有判定的可选功能)
         # 1.变量初始化
         for k, _, _, ex in self.CFG:
-            v = tk.BooleanVar(value=True); self._settings_vars_dict[k] = v; setattr(self, k, v)
+            v = tk.BooleanVar(value=k not in self.CFG_OFF); self._settings_vars_dict[k] = v; setattr(self, k, v)
             for ek, ev, cls, _, _ in ex:
-                var = (tk.BooleanVar(value=True) if cls == tk.Checkbutton else tk.StringVar(value=ev))
+                var = (tk.BooleanVar(value=ek not in self.CFG_OFF) if cls == tk.Checkbutton else tk.StringVar(value=ev))
                 self._settings_vars_dict[ek] = var; setattr(self, ek, var)
         # 2.布局
         f_scroll = tk.Frame(root); f_scroll.pack(fill=tk.X, padx=(1, 0), pady=0)
@@ -377,13 +546,14 @@ class EpubProcessor:
         # 配置路径与读写
         base_dir = Path(getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(sys.argv[0]))))
         self.config_file = base_dir / "config.ini"
-        self.win_size = WinSize(self.config_file)
+        config_text = self.config_file.read_text('utf-8') if self.config_file.exists() else None # 启动时只读一次 窗口尺寸/设置/正则规则共用
+        self.win_size = WinSize(self.config_file, config_text)
         self.log_level_var = self._settings_vars_dict.setdefault('log_level', tk.StringVar(value="info"))
-        self.load_app_settings()
+        self.load_app_settings(config_text)
         recorder = self.win_size.setup(root, "main", "350x620+600+160")
         root.bind('<Configure>', recorder, add='+')
 
-        self.regex_manager = RegexManager(root, self.config_file, self.log_level_var, self)
+        self.regex_manager = RegexManager(root, self.config_file, self.log_level_var, self, config_text)
         self._save_config()
 
         # 拖拽支持
@@ -416,6 +586,7 @@ class EpubProcessor:
         out = Path(ps[0]).parent / 'output'; out.mkdir(exist_ok=True)
         def _batch_worker():
             counts = {'ERROR': 0, 'WARNING': 0}
+            if cache := self._get_image_cache(): cache.reset_stats()
             logger_id = logger.add(lambda r: counts.__setitem__(r.record["level"].name, counts[r.record["level"].name]+1) or None, level='WARNING')
             for p in ps:
                 try:
@@ -424,12 +595,13 @@ class EpubProcessor:
                 except Exception:
                     logger.opt(exception=True).error(f"文件处理失败: {Path(p).name}")
             logger.remove(logger_id)
-            logger.success(f"批量转换完成: 共{len(ps)}，ERROR:{counts['ERROR']}，WARNING:{counts['WARNING']}")
+            logger.success(f"批量转换完成: 共{len(ps)}，ERROR:{counts['ERROR']}，WARNING:{counts['WARNING']}"
+                           + (f"，{summary}" if cache and (summary := cache.summary()) else ""))
         # 启动后台线程执行批量循环，避免卡住 Tkinter 界面
         threading.Thread(target=_batch_worker, daemon=True).start()
 
     def process_epub(self, output_filename):
-        """实际开始处理流程，分为结构处理、内容并发、打包三个阶段"""
+        """实际开始处理流程，分为结构处理、内容并发、打包三个阶段；图片编码作为独立分支与前两个阶段并发"""
         logger.info(f"开始处理epub文件: {self.epub_path}")
 
         with tempfile.TemporaryDirectory(dir=self.sesame_root) as temp_dir:
@@ -439,96 +611,24 @@ class EpubProcessor:
             # 解析 container.xml，找到 .opf 文件路径
             opf_full_path = self._get_opf_path(temp_dir)
             logger.debug(f"OPF文件路径: {opf_full_path}")
-
-            # ================= Phase 1: 结构级操作 (单线程) ================= #
-            # 图片转换 调用外部程序处理图片
-            if self.convert_images_var.get():
-                self.convert_epub_images(temp_dir)
-
-            # 清理OPF样式、添加CSS文件及更改语言标识[规格化头部信息与CSS重建移至多进程逻辑]
-            self.process_opf_and_styles(temp_dir)
-
-            opf_path = self._get_opf_path(temp_dir)
-            # 生成ncx并更新opf
-            if self.generate_ncx_enabled.get():
-                success, msg = EpubNCXGenerator.generate_ncx(opf_path)
-                if not success: logger.warning(f"NCX生成警告: {msg}")
-
-            # 调用fix_ncx_paths并传递 目录偏移、强制偏移、补全あとが 开关状态
-            EpubNCXGenerator.fix_ncx_paths(opf_path, self.ncx_offset_enabled.get(), self.ncx_atokagi_enabled.get(), self.ncx_manual_offset_val.get())
-
-            # 转换epub版本并删除nav
-            if self.convert_epub_version_enabled.get():
-                success, msg = EpubNCXGenerator.convert_to_epub2(opf_path)
-                if not success: logger.warning(f"版本转换警告: {msg}")
-
-            # 重新解析目录 正则匹配追加、分割章节
-            opf_path = self._get_opf_path(temp_dir)
-            toc_data = self._parse_toc(BeautifulSoup(opf_path.read_text('utf-8'), 'xml'), opf_path)
-            self._apply_regex_split(temp_dir, toc_data)
-
-            # 章节间合并
-            if self.merge_xhtml_enabled.get():
-                self.merge_xhtml_files(temp_dir)
-
-            # ================= Phase 2: 单页内容级操作 (多进程逻辑) ================= #
-
-            # 1. 抽取正则规则 (纯数据列表，规避 GUI 组件 pickling 问题)
-            regex_rules = []
+            self._build_book_index(temp_dir, opf_full_path)
+
+            # ================= Phase 1/2: 按依赖关系并发的阶段 ================= #
+            # 图片编码只依赖转换前的图片统计，与结构处理及Phase 2并发；html图片引用与OPF媒体类型在两条分支汇合后统一修正
+            images = self.plan_epub_images(temp_dir) if self.convert_images_var.get() else None
+            # 两条分支共用CPU与内存预算：图片编码进程数(-w或CPU数)限制为可用CPU的一半，Auto下Phase 2的worker数扣除这部分
+            if images:
+                m = re.search(r'(?:^|\s)-w\s*(\d+)', ' '.join(images['params']))
+                images['workers'] = split_budget(int(m.group(1)) if m else 0)
+                self._image_reserve = (images['workers'], images['workers'] * IMAGE_WORKER_RSS)
             try:
-                regex_rules = self.regex_manager.get_rules()
-            except Exception as e:
-                logger.warning(f"提取内存正则规则失败: {e}")
-
-            # 2. 抽取布尔开关和变量为纯字典
-            flags_dict = {
-                'is_lang': self.set_lang_enabled.get(),
-                'is_style': self.delete_style_enabled.get(),
-                'is_process_ruby': self.process_ruby_enabled.get(),
-                'is_modify_html': self.modify_html_enabled.get(),
-                'is_process_images': self.process_images_enabled.get(),
-                'remove_blank': self._settings_vars_dict['merge_remove_blank_lines_var'].get(),
-                'limit_blank': self._settings_vars_dict['merge_limit_blank_lines_var'].get(),
-                'remove_head_blank': self._settings_vars_dict['remove_head_blank_enabled'].get()
-            }
-            lang_val = self.set_lang_var.get().strip() if flags_dict['is_lang'] else "ja"
-            class_name = self.class_name_var.get()
-
-            css_dir = opf_path.parent / 'css'
-            html_files = [str(xf) for xf in Path(temp_dir).rglob("*") if xf.suffix.lower() in ('.xhtml', '.html')]
-
-            # 3. 组装数据包裹
-            mp_args = []
-            for xf_str in html_files:
-                rel_css = os.path.relpath(css_dir / 'style.css', Path(xf_str).parent).replace('\\', '/')
-                mp_args.append((
-                    xf_str, rel_css, lang_val, class_name, flags_dict, regex_rules
-                ))
-
-            logger.info(f"启动多进程流水线处理 {len(html_files)} 个文件")
-
-            # 读取UI配置，Auto则计算2-8动态核心数，否则使用指定数值
-            wk = int(uw) if (uw := self._settings_vars_dict['max_workers_var'].get()) != 'Auto' else max(2, min(os.cpu_count() or 2, 8))
-            # 使用ProcessPoolExecutor低优先级进程并行处理xhtml 限制自动最大进程数为8 防止内存占用过高
-            with concurrent.futures.ProcessPoolExecutor(max_workers=wk, initializer=set_low_priority) as executor:
-                for future in concurrent.futures.as_completed([executor.submit(mp_process_single_file_pipeline, arg) for arg in mp_args]):
-                    success, xf_str, err = future.result()
-                    if not success:
-                        logger.error(f"处理文件崩溃 [{Path(xf_str).name}]: {err}")
-
-            # 汇报日志输出 使用flags_dict和regex_rules 避免重复调用get
-            f = flags_dict.get
-            [logger.info(msg) for cond, msg in [
-                (f('is_style'), "xhtml头部信息规格化与css重建 √"),
-                (f('is_process_ruby'), "Ruby标签规格化 √"),
-                (f('is_modify_html'), "傍点转换ruby格式 √"),
-                (regex_rules, "正则替换 √"),
-                (f('is_process_images'), "图片标签规格化 √")
-            ] if cond]
-
-            # 空行处理移至多线程逻辑 这里只显示个日志
-            if flags_dict['remove_blank'] != '-' or flags_dict['limit_blank'] != '-':
-                logger.info("空行数量限制清理 √")
+                run_stages({
+                    'image_encode': (lambda r: self.convert_epub_images(temp_dir, images), ()),
+                    'structure': (lambda r: self._structure_stage(temp_dir), ()),
+                    'content': (lambda r: self._content_stage(temp_dir, *r['structure']), ('structure',)),
+                    'image_refs': (lambda r: r['image_encode'] and self.fix_image_refs(temp_dir, images), ('image_encode', 'content')),
+                })
+            finally: self._book_indexes.pop(os.path.normpath(opf_full_path), None); self._image_reserve = (0, 0)
 
             # ================= Phase 3: 收尾与重打包 ================= #
             with zipfile.ZipFile(output_filename, "w", zipfile.ZIP_DEFLATED) as zip_ref:
@@ -539,8 +639,224 @@ class EpubProcessor:
                         zip_ref.write(file_path, arcname)
             logger.info(f"EPUB文件处理完成，保存到: {output_filename}")
 
+    def _build_book_index(self, temp_dir, opf_path):
+        """解压后并行构建书籍引用索引(spine/图片引用/class用量/标题候选)，供图片统计、补全后记、章节分割共用"""
+        from book_index import BookIndex
+        t0 = time.perf_counter()
+        index = self._book_indexes[os.path.normpath(opf_path)] = BookIndex.build(temp_dir, opf_path, auto_workers(8)[0])
+        logger.debug(f"书籍引用索引: {(st := index.stats())['html']} 个html，spine {st['spine']} 项，用时 {time.perf_counter() - t0:.2f}s")
+        return index
+
+    def _get_book_index(self, opf_path):
+        """已构建的书籍引用索引，没有则返回按需解析的空索引"""
+        from book_index import BookIndex
+        return self._book_indexes.get(os.path.normpath(opf_path)) or BookIndex(Path(opf_path).parent, opf_path)
+
+    def _structure_stage(self, temp_dir):
+        """Phase 1: 结构级操作(单线程 依次修改OPF)，返回(opf路径, 合并组, 分隔符html)"""
+        from bs4 import BeautifulSoup; from epub_ncx_generator import EpubNCXGenerator
+        # 清理OPF样式、添加CSS文件及更改语言标识[规格化头部信息与CSS重建移至多进程逻辑]
+        self.process_opf_and_styles(temp_dir)
+
+        opf_path = self._get_opf_path(temp_dir)
+        # 生成ncx并更新opf
+        if self.generate_ncx_enabled.get():
+            success, msg = EpubNCXGenerator.generate_ncx(opf_path)
+            if not success: logger.warning(f"NCX生成警告: {msg}")
+
+        # 调用fix_ncx_paths并传递 目录偏移、强制偏移、补全あとが 开关状态
+        EpubNCXGenerator.fix_ncx_paths(opf_path, self.ncx_offset_enabled.get(), self.ncx_atokagi_enabled.get(), self.ncx_manual_offset_val.get(),
+                                       self._get_book_index(opf_path))
+
+        # 转换epub版本并删除nav
+        if self.convert_epub_version_enabled.get():
+            success, msg = EpubNCXGenerator.convert_to_epub2(opf_path)
+            if not success: logger.warning(f"版本转换警告: {msg}")
+
+        # 重新解析目录 正则匹配追加、分割章节
+        opf_path = self._get_opf_path(temp_dir)
+        toc_data = self._parse_toc(BeautifulSoup(opf_path.read_text('utf-8'), 'xml'), opf_path)
+        self._apply_regex_split(temp_dir, toc_data)
+
+        # 章节间合并 (此处只规划合并组并同步OPF，拼接在Phase 2并行执行)
+        merge_groups, sep_html = self.plan_merge_groups(temp_dir) if self.merge_xhtml_enabled.get() else ([], '')
+        return opf_path, merge_groups, sep_html
+
+    def _choose_executor(self, tasks):
+        """
+        读取UI配置，Auto则按CPU亲和性/cgroup配额/可用内存计算最高8的核心数并按成本模型决定是否直接执行，否则使用指定数值
+        tasks: [(参数, 字节数)]，返回(执行方式, worker数, 预计串行耗时, 预计完工耗时)
+        """
+        if (uw := self._settings_vars_dict['max_workers_var'].get()) == 'Auto':
+            wk, detail = auto_workers(8, max((c for _, c in tasks), default=0), getattr(self, '_image_reserve', (0, 0))); logger.debug(f"自动worker数: {detail}")
+        else: wk = int(uw)
+        predicted, backend = estimate_cost(tasks), resolve_backend(self._settings_vars_dict['executor_backend_var'].get())
+        mode, wk, predicted_wall = choose_strategy(predicted, wk, backend) if uw == 'Auto' else (backend, wk, predicted / wk)
+        return mode, wk, predicted, predicted_wall
+
+    def _content_stage(self, temp_dir, opf_path, merge_groups, sep_html):
+        """Phase 2: 单页内容级操作(多进程流水线)与章节拼接"""
+        from bs4 import BeautifulSoup
+        # 1. 抽取正则规则 (纯数据列表，规避 GUI 组件 pickling 问题)
+        regex_rules = []
+        try:
+            regex_rules = self.regex_manager.get_rules()
+        except Exception as e:
+            logger.warning(f"提取内存正则规则失败: {e}")
+
+        # 2. 抽取布尔开关和变量为纯字典
+        flags_dict = {
+            'is_lang': self.set_lang_enabled.get(),
+            'is_style': self.delete_style_enabled.get(),
+            'is_process_ruby': self.process_ruby_enabled.get(),
+            'is_modify_html': self.modify_html_enabled.get(),
+            'is_process_images': self.process_images_enabled.get(),
+            'remove_blank': self._settings_vars_dict['merge_remove_blank_lines_var'].get(),
+            'limit_blank': self._settings_vars_dict['merge_limit_blank_lines_var'].get(),
+            'remove_head_blank': self._settings_vars_dict['remove_head_blank_enabled'].get()
+        }
+        lang_val = self.set_lang_var.get().strip() if flags_dict['is_lang'] else "ja"
+        class_name = self.class_name_var.get()
+
+        css_dir = opf_path.parent.resolve() / 'css'
+        html_files = [str(xf.resolve()) for xf in Path(temp_dir).rglob("*") if xf.suffix.lower() in ('.xhtml', '.html')]
+        merge_groups = [(str(m), [str(x) for x in subs]) for m, subs in merge_groups]
+        part_of = {p for m, subs in merge_groups for p in [m, *subs]}
+        blank_cfg = (flags_dict['remove_blank'], flags_dict['limit_blank'], flags_dict['remove_head_blank'])
+        if merge_groups and (blank_cfg[0] != '-' or blank_cfg[1] != '-' or blank_cfg[2]):
+            sep_summary = mp_process_blank_lines(sep_soup := BeautifulSoup(sep_html, 'html.parser'), *blank_cfg[:2], mark_lead=True)
+            sep = (mp_fmt(sep_soup), sep_summary)
+        else: sep = (sep_html, None)
+
+        # 超大xhtml按body顶层子节点分块：骨架(头部+空body)与各分块分别交给worker并行处理，限制单个worker的内存峰值
+        expanded = {xf_str: res for xf_str in html_files if os.path.getsize(xf_str) > 2 * MP_CHUNK_BYTES
+                    and (res := mp_expand_large_file(xf_str, MP_CHUNK_BYTES))}
+        for xf_str, (_, chunk_strs) in expanded.items():
+            logger.debug(f"大文件分块处理: {Path(xf_str).name} -> {len(chunk_strs)} 块")
+            if xf_str in part_of and xf_str not in dict(merge_groups): # 被合并文件已完整转存为分块 只取body 无需骨架
+                [os.remove(x) for x in (xf_str, expanded[xf_str][0])]; expanded[xf_str] = (None, chunk_strs)
+
+        # 拼接任务：合并组写回主文件，分块文件写回原文件。(写回路径, 外壳文件, [(类型, 片段)]) 外壳提供头尾及首个body片段
+        parts = lambda xf, kind: [(kind, c) for c in expanded[xf][1]] if xf in expanded else [(kind, xf)]
+        joins = [(m, expanded[m][0] if m in expanded else m,
+                  (parts(m, 'file') if m in expanded else []) + [it for x in subs for it in [('text', sep), *parts(x, 'sub')]])
+                 for m, subs in merge_groups]
+        joins += [(xf, skel, parts(xf, 'file')) for xf, (skel, _) in expanded.items() if xf not in part_of]
+        join_of = {v: j for j, (_, shell, items) in enumerate(joins) for v in [shell, *(v for k, v in items if k != 'text')]}
+        sub_parts = {v for _, _, items in joins for k, v in items if k == 'sub'} # 被合并文件在worker内先清理script 与空行规则的判定保持一致
+        waiting = {j: 1 + sum(k != 'text' for k, _ in items) for j, (_, _, items) in enumerate(joins)}
+        join_at = {out: j for j, (out, _, _) in enumerate(joins)}
+
+        # 3. 组装数据包裹 (拼接片段需返回空行状态摘要，分块片段不做头部规格化) 附带字节数作为调度成本
+        mp_args = []
+        for xf_str in [t for xf in html_files for t in ([expanded[xf][0], *expanded[xf][1]] if xf in expanded else [xf]) if t]:
+            rel_css = os.path.relpath(css_dir / 'style.css', Path(xf_str).parent).replace('\\', '/')
+            flags = {**flags_dict, 'blank_mark': True, 'fragment': xf_str.endswith('.part'), 'strip_script': xf_str in sub_parts} if xf_str in join_of else flags_dict
+            mp_args.append(((
+                xf_str, rel_css, lang_val, class_name, flags, regex_rules
+            ), os.path.getsize(xf_str)))
+
+        logger.info(f"启动多进程流水线处理 {len(html_files)} 个文件" + (f"，{len(merge_groups)} 组章节合并" if merge_groups else "")
+                    + (f"，{len(expanded)} 个大文件分块" if expanded else ""))
+
+        largest = max((c for _, c in mp_args), default=0)
+        mode, wk, predicted, predicted_wall = self._choose_executor(mp_args)
+        # 使用低优先级进程池(或线程池)并行处理xhtml 限制自动最大进程数为8 防止内存占用过高；小书直接在当前线程执行
+        # 按字节数LPT排序分批提交(在途任务有限，进程池可按任务数/RSS上限换新)，小文件打包为批次；拼接所需的片段全部处理完毕后立即提交拼接任务，与其余文件的处理重叠
+        # 任务号：文件任务为mp_args下标，拼接任务为len(mp_args)+拼接序号，供看门狗登记
+        batches = plan_batches([((i, arg), c) for i, (arg, c) in enumerate(mp_args)], wk)
+        logger.debug(f"Phase 2 策略: {mode} x{wk}{' (正则在看门狗子进程执行)' if regex_rules and mode != 'process' else ''}，预计串行 {predicted:.2f}s，预计完工 {predicted_wall:.2f}s")
+        logger.debug(f"Phase 2 调度: {len(mp_args)} 个任务打包为 {len(batches)} 批，"
+                     f"最大批 {batches[0][1] / 1024:.1f}KB，LPT预计负载 {lpt_makespan([c for _, c in batches], wk) / 1024:.1f}KB/worker" if batches else "Phase 2 无任务")
+        # 超时看门狗：单条正则超过MP_RULE_TIMEOUT或单个任务超过MP_FILE_TIMEOUT时结束该worker
+        # 正则超时的文件跳过该规则重新处理，其他步骤超时的文件保持原样；被连带中断的任务重新提交，其余文件按时完成
+        # 线程无法从外部终止：当前线程/线程池执行时只有正则步骤交给看门狗子进程(每个执行线程一个，首次用到时启动)
+        watch = TaskWatch(len(mp_args) + len(joins), MP_RULE_TIMEOUT, MP_FILE_TIMEOUT) if mode == 'process' else None
+        guard = WatchedCall(MP_RULE_TIMEOUT, MP_FILE_TIMEOUT, set_low_priority) if regex_rules and mode != 'process' else contextlib.nullcontext()
+        summaries, work, longest, t0 = {}, 0.0, 0.0, time.perf_counter()
+        pool = make_executor(mode, wk, largest, set_low_priority, watch)
+        with guard, pool as executor:
+            running, pending = {}, batches[::-1]
+            def submit(items, is_join): # items: [(任务号, 参数)]
+                fn = mp_join_document if is_join else mp_process_single_file_pipeline
+                running[executor.submit(run_batch, fn, [a for _, a in items], [t for t, _ in items])] = (is_join, items)
+            def fill(): # 保持约2倍worker数的在途批次 按LPT顺序从大到小提交
+                while pending and sum(not is_join for is_join, _ in running.values()) < wk * 2: submit(pending.pop()[0], False)
+            def collect(is_join, result, sec):
+                nonlocal work, longest
+                success, xf_str, err, summary = result
+                work, longest = work + sec, max(longest, sec)
+                if not success:
+                    logger.error(f"{'拼接失败' if is_join else '处理文件崩溃'} [{Path(xf_str).name}]: {err}")
+                    if is_join: concat(xf_str)
+                if is_join or (j := join_of.get(xf_str)) is None: return
+                summaries[xf_str], waiting[j] = summary, waiting[j] - 1
+                if not waiting[j]:
+                    out, shell, items = joins[j]
+                    submit([(len(mp_args) + j, (out, (shell, summaries.get(shell)), blank_cfg,
+                             [(k, *v) if k == 'text' else (k, v, summaries.get(v)) for k, v in items]))], True)
+            def concat(out): # 拼接失败时在主进程直接拼接 否则被合并章节已从OPF移除却没有写入主文件
+                _, shell, items = joins[join_at[out]]
+                try: mp_concat_document(out, shell, items); logger.warning(f"已改为直接拼接(未处理拼接处的空行): {Path(out).name}")
+                except Exception as e: logger.error(f"直接拼接也失败 [{Path(out).name}]: {e}，被合并的章节内容缺失")
+            def read_blank(xf_str): # 拼接片段提交前写入的空行摘要，不存在或损坏时返回None
+                try: lead, all_blank, trail = map(int, Path(f"{xf_str}.blank").read_text('utf-8').split()); return lead, bool(all_blank), trail
+                except (OSError, ValueError): return None
+            def recover(is_join, items):
+                """进程池损坏(worker被看门狗结束)后按任务记录处理该批次：已写入的不再重试，超时的跳过规则重试或保持原样，其余重新提交"""
+                retry = []
+                for tid, arg in items:
+                    if watch.state(tid) == 'done': collect(is_join, (True, arg[0], "", None if is_join else read_blank(arg[0])), 0.0); continue # 已写入 回传结果丢失 空行摘要从.blank读回
+                    killed = watch.killed.get(tid); watch.reset(tid)
+                    if not killed: retry.append((tid, arg)); continue # 未开始或被连带中断
+                    step, kind, sec = killed
+                    if not is_join and kind == 'step':
+                        logger.error(f"正则超时 [{Path(arg[0]).name}] 规则{step + 1} {arg[5][step][0].pattern} 用时超过{sec:.0f}s，已跳过该规则重新处理")
+                        retry.append((tid, (*arg[:4], {**arg[4], 'skip_rules': {*arg[4].get('skip_rules', ()), step}}, arg[5])))
+                    else:
+                        Path(f"{arg[0]}.tmp").unlink(missing_ok=True)
+                        collect(is_join, (False, arg[0], f"超时({sec:.0f}s{f' 规则{step + 1}' if step >= 0 else ''})" + ("" if is_join else " 保持原样"), None), sec)
+                if retry: submit(retry, is_join)
+            fill()
+            while running:
+                done, _ = concurrent.futures.wait(running, timeout=MP_WATCH_INTERVAL if watch else None, return_when=concurrent.futures.FIRST_COMPLETED)
+                if watch:
+                    for tid, step, kind, sec in watch.check([t for _, items in running.values() for t, _ in items]):
+                        logger.warning(f"任务超时 结束worker: {Path((mp_args[tid][0] if tid < len(mp_args) else joins[tid - len(mp_args)])[0]).name}"
+                                       + (f" 规则{step + 1}" if kind == 'step' else "") + f" {sec:.0f}s")
+                for future in done:
+                    is_join, items = running.pop(future)
+                    try: results = future.result()
+                    except concurrent.futures.BrokenExecutor: # 进程池中有worker被结束
+                        if not watch: raise
+                        recover(is_join, items); continue
+                    for result, sec in results: collect(is_join, result, sec)
+                fill()
+        # 拼接的中间文件(.blank空行摘要 .skel骨架 .part分块 .tmp)只在本阶段内使用，无论拼接成败都不能留在书中被打包
+        [Path(p).unlink(missing_ok=True) for x in join_of for p in (f"{x}.blank", *([x] if x.endswith(('.skel', '.part')) else []))]
+        [Path(f"{out}.tmp").unlink(missing_ok=True) for out, _, _ in joins]
+        logger.debug(f"Phase 2 完工({mode} x{wk}): 预计 {predicted_wall:.2f}s，{makespan_report(work, time.perf_counter() - t0, wk, longest)}"
+                     + (f"，进程池 {pool.generations} 代，worker峰值RSS {pool.peak_rss / 2**20:.0f}MB" if mode == 'process' else "")
+                     + (f"，正则看门狗子进程 {guard.started} 个" if isinstance(guard, WatchedCall) else ""))
+        if merge_groups: logger.info("章节间Xhtml合并 √")
+
+        # 汇报日志输出 使用flags_dict和regex_rules 避免重复调用get
+        f = flags_dict.get
+        [logger.info(msg) for cond, msg in [
+            (f('is_style'), "xhtml头部信息规格化与css重建 √"),
+            (f('is_process_ruby'), "Ruby标签规格化 √"),
+            (f('is_modify_html'), "傍点转换ruby格式 √"),
+            (regex_rules, "正则替换 √"),
+            (f('is_process_images'), "图片标签规格化 √")
+        ] if cond]
+
+        # 空行处理移至多线程逻辑 这里只显示个日志
+        if flags_dict['remove_blank'] != '-' or flags_dict['limit_blank'] != '-':
+            logger.info("空行数量限制清理 √")
+
     def process_opf_and_styles(self, temp_dir):
         """清理OPF样式、添加CSS文件及更改语言标识(XHTML处理已移交多进程)"""
+        from bs4 import BeautifulSoup
         temp_dir, opf_path = Path(temp_dir), self._get_opf_path(Path(temp_dir))
         opf_soup = BeautifulSoup(opf_path.read_text('u8'), 'xml')
         # 获取开关状态
@@ -582,16 +898,25 @@ class EpubProcessor:
         if is_lang_enabled or is_style_enabled:
             opf_path.write_text(str(opf_soup), 'u8')
 
-    def merge_xhtml_files(self, temp_dir):
-        logger.info("章节间Xhtml合并(基于目录)")
+    def plan_merge_groups(self, temp_dir):
+        """
+        章节间合并规划(基于目录)：只计算合并组并同步OPF，文件拼接交给Phase 2的worker并行处理后由mp_join_document完成
+        返回([(主文件, [被合并文件...]), ...], 分隔符html)
+        """
+        from bs4 import BeautifulSoup
+        logger.info("章节间Xhtml合并规划(基于目录)")
         temp_dir, opf_path = Path(temp_dir), self._get_opf_path(Path(temp_dir))
         opf_soup = BeautifulSoup(opf_path.read_text('utf-8'),'xml')
         spine = opf_soup.spine or (_ for _ in ()).throw(ValueError("OPF 文件缺少 spine 定义"))
         opf_dir = opf_path.parent
+        # 预建 manifest/spine 索引 避免每个合并文件都线性查找一次opf
+        id_idx = {it.get('id'): it for it in opf_soup.find_all('item') if it.get('id')}
+        href_idx, ref_idx = {it.get('href'): it for it in id_idx.values()}, {}
+        [ref_idx.setdefault(ref.get('idref'), []).append(ref) for ref in spine.find_all('itemref')]
 
         # 构建 spine 列表
         spine_files = [(opf_dir/itm.get('href')).resolve() for ref in spine.find_all('itemref')
-                    if (idr:=ref.get('idref')) and (itm:=opf_soup.find('item',id=idr))
+                    if (idr:=ref.get('idref')) and (itm:=id_idx.get(idr))
                     and itm.get('media-type') in ['application/xhtml+xml', 'text/html']
                     and (href:=itm.get('href')) and not href.lower().endswith('nav.xhtml')]
         logger.debug(f"Spine文件列表: {spine_files}")
@@ -610,34 +935,35 @@ class EpubProcessor:
             try: idx = spine_files.index(f)
             except ValueError: logger.warning(f"目录条目路径对照spine列表异常: {title} | ({href})"); continue
             toc_anchors.append((idx, title, f, is_ex)) # 将标记存入
-        if not toc_anchors: return logger.warning("未找到有效目录，跳过合并")
+        if not toc_anchors: return logger.warning("未找到有效目录，跳过合并") or ([], '')
 
         toc_anchors.sort(key=lambda x:x[0])
         sep=(self._settings_vars_dict.get('merge_separator_var') or type('',(),{'get':lambda s:'hr+br'})()).get()
         tags=[]if sep=='-'else(['p','hr','p']if sep=='hr+br'else['p']*(int(sep[0])if sep.endswith('br')and sep[0].isdigit()else 2))
+        sep_html=''.join(('<p><br/></p>' if t=='p' else f'<{t}/>')+'\n' for t in tags)
 
-        modified=False
+        groups, modified = [], False
         for i,(s,_,m,is_ex) in enumerate(toc_anchors):
             if is_ex: continue # 仅作为合并边界 不作为发起者合并后续章节
             g=spine_files[s:(toc_anchors[i+1][0] if i+1<len(toc_anchors) else len(spine_files))]
             if len(g)<2: continue
-            logger.debug(f"合并于: {g[0].relative_to(temp_dir).as_posix()} 已合并: {[x.relative_to(temp_dir).as_posix() for x in g[1:]]}")
-            ms=BeautifulSoup(m.read_text('utf-8'),'html.parser')
+            if not MP_BODY_OPEN_RE.search(m.read_text('utf-8')): logger.warning(f"缺失body: {m}"); continue
+            subs = []
             for sub in g[1:]:
                 if not sub.exists(): logger.warning(f"合并目标文件不存在，已跳过: {sub}"); continue
-                mg = BeautifulSoup(sub.read_text('utf-8'), 'html.parser')
-                if not getattr(mg, 'body', None): logger.warning(f"缺失body: {sub}"); continue
-                for t in tags: el=ms.new_tag(t); t=='p' and el.append(ms.new_tag('br')); ms.body.append(el); ms.body.append(ms.new_string('\n'))
-                [ms.body.append(copy.copy(c)) for c in mg.body.children if c.name!='script']
-                sub.unlink(missing_ok=True)
-                rel=sub.relative_to(opf_dir).as_posix()
-                if (it:=opf_soup.find('item',href=rel)):
-                    [tg.decompose() for tg in [*spine.find_all('itemref',idref=it.get('id')),it]]; modified=True
-            m.write_text(str(ms),'utf-8')
-        (opf_path.write_text(str(opf_soup),'utf-8'),logger.info("章节间Xhtml合并 完成")) if modified else logger.info("无需更新 OPF，无章节被合并")
+                if not MP_BODY_OPEN_RE.search(sub.read_text('utf-8')): logger.warning(f"缺失body: {sub}"); continue
+                subs.append(sub)
+                if (it:=href_idx.get(sub.relative_to(opf_dir).as_posix())):
+                    [tg.decompose() for tg in [*ref_idx.pop(it.get('id'), []),it]]; modified=True
+            if not subs: continue
+            logger.debug(f"合并于: {m.relative_to(temp_dir).as_posix()} 待合并: {[x.relative_to(temp_dir).as_posix() for x in subs]}")
+            groups.append((m, subs))
+        (opf_path.write_text(str(opf_soup),'utf-8'),logger.info(f"章节间Xhtml合并规划 完成: {len(groups)} 组")) if modified else logger.info("无需更新 OPF，无章节被合并")
+        return groups, sep_html
 
     def _get_opf_path(self, temp_dir):
         """解析container.xml 准确获取opf名字路径"""
+        from bs4 import BeautifulSoup
         container_path = Path(temp_dir) / 'META-INF' / 'container.xml'
         with container_path.open('r', encoding='utf-8') as f:
             container_content = f.read()
@@ -649,6 +975,7 @@ class EpubProcessor:
 
     def _parse_toc(self, opf_soup, opf_path):
         """解析目录结构 优先nav 后解析ncx"""
+        from bs4 import BeautifulSoup
         # nav
         if (nav_item := opf_soup.find('item', properties='nav')) and (nav_path := (opf_path.parent / nav_item['href']).resolve()).exists():
             with nav_path.open('r', encoding='utf-8') as f:
@@ -671,11 +998,11 @@ class EpubProcessor:
                     for nav_point in nav_map.find_all('navPoint')]
         return []
 
-    def convert_epub_images(self, temp_dir):
-        """集成图片转换、清理旧文件、更新引用"""
+    def plan_epub_images(self, temp_dir):
+        """图片转换规划：解析参数、收集图片、统计高频图片并生成文件名映射(需在文本阶段修改html之前执行)，失败或无图片返回None"""
         logger.info("开始图片转换流程")
         if not self.convert_images_var.get():
-            return
+            return None
         try:
             # ===== 1. 配置初始化 =====
             logger.debug("初始化图片转换配置")
@@ -695,7 +1022,7 @@ class EpubProcessor:
                 if file.is_file() and file.suffix.lower() in ('.png', '.jpg', '.jpeg', '.webp') and file.exists(): # 二次验证文件存在
                     original_images.append(str(file))
                     logger.debug(f"[扫描] 发现图片文件: {file.relative_to(temp_dir_path)}")
-            if not original_images: return logger.warning("未找到需要转换的图片，跳过此流程")
+            if not original_images: return logger.warning("未找到需要转换的图片，跳过此流程") or logger.info("图片处理流程结束")
             # ===== 3.分析统计图片使用次数=====
             high_freq_images = set()
             if hasattr(self, 'auto_override_enabled') and self.auto_override_enabled.get():
@@ -704,21 +1031,23 @@ class EpubProcessor:
                     excluded_paths = set()
                     skip_rule = getattr(self, 'override_skip_var', tk.StringVar(value='gaiji')).get().strip()
                     skip_re = re.compile(skip_rule) if skip_rule else None
-                    # 只处理 .xhtml/.html 文件，且排除 nav.xhtml 正则排除图片(匹配class或src)
-                    for html_file in [f for f in temp_dir_path.rglob('*') if f.suffix.lower() in ('.xhtml', '.html') and f.name.lower() != 'nav.xhtml']:
-                        soup = BeautifulSoup(html_file.read_text('utf-8', 'ignore'), 'html.parser')
-                        for img in soup.find_all('img'):
-                            if (src := img.get('src')) and (abs_src := (html_file.parent / unquote(src)).resolve()).exists():
+                    # 只处理 .xhtml/.html 文件，且排除 nav.xhtml 正则排除图片(匹配class或src)；img引用取自书籍引用索引
+                    for html_file, entry in self._get_book_index(self._get_opf_path(temp_dir_path)).entries():
+                        if html_file.suffix.lower() not in ('.xhtml', '.html') or html_file.name.lower() == 'nav.xhtml': continue
+                        for tag, abs_p, src, cls in entry['img_refs']:
+                            if tag == 'img' and (abs_src := Path(abs_p)).exists():
                                 p_str = str(abs_src)
                                 img_counts[p_str] = img_counts.get(p_str, 0) + 1
                                 # 命中排除正则记录到 excluded_paths
-                                if skip_re and (skip_re.search(' '.join(img.get('class', []))) or skip_re.search(src)):
+                                if skip_re and (skip_re.search(cls) or skip_re.search(src)):
                                     excluded_paths.add(p_str)
-                    for p, c in {k: v for k, v in img_counts.items() if v >= threshold}.items():
+                    # 启用罫線识别时由分类器判定候选(出现次数阈值只用于无法识别的图片)，否则按出现次数阈值
+                    rules = self._classify_rule_images(list(img_counts)) if getattr(self, 'override_classify_enabled', None) and self.override_classify_enabled.get() else None
+                    for p, c in {k: v for k, v in img_counts.items() if (rules[k][0] if rules and k in rules else v >= threshold)}.items():
                         img_name = Path(p).name
                         if p not in excluded_paths and override_str:
                             high_freq_images.add(p)
-                            logger.info(f"[追加参数候选] {img_name} 出现{c}次 将追加独立参数")
+                            logger.info(f"[追加参数候选] {img_name} 出现{c}次" + (f" 罫線得分{rules[p][1]:.2f}" if rules and p in rules else "") + " 将追加独立参数")
                         else:
                             reason = "命中排除规则" if p in excluded_paths else "未配置追加参数"
                             logger.info(f"[追加参数候选] {img_name} 出现{c}次 【{reason}】")
@@ -728,31 +1057,69 @@ class EpubProcessor:
             image_mapping = {Path(p).name: f"{Path(p).stem}.{override_format if (p in high_freq_images and override_str) else output_format}" for p in original_images}
             for old_name, new_name in image_mapping.items():
                 logger.debug(f"[映射] {old_name} → {new_name}")
+            return {'original_images': original_images, 'high_freq_images': high_freq_images, 'image_mapping': image_mapping,
+                    'params': params, 'override_str': override_str, 'media_map': media_map}
+        except Exception as e: logger.error(f"流程异常终止: {e}"); import traceback; traceback.print_exc(); logger.info("图片处理流程结束")
+
+    def _classify_rule_images(self, images):
+        """罫線分类器(依赖numpy)批量判定，debug日志输出各图片得分，返回{路径: (是否罫線, 得分, 说明)}，不可用时返回None"""
+        try: from image_converter import classify_rules
+        except ImportError as e: return logger.warning(f"罫線识别不可用，按出现次数阈值判定: {e}")
+        try: verdicts = classify_rules(images)
+        except ImportError as e: return logger.warning(f"罫線识别不可用，按出现次数阈值判定: {e}")
+        for p, (is_rule, score, detail) in verdicts.items():
+            logger.debug(f"[罫線识别] {Path(p).name} 得分{score:.2f} {'罫線' if is_rule else '非罫線'} | {detail}")
+        logger.info(f"罫線识别: {sum(v[0] for v in verdicts.values())}/{len(images)} 张判定为罫線" + (f"，{n} 张无法判断按出现次数阈值" if (n := len(images) - len(verdicts)) else ""))
+        return verdicts
+
+    def convert_epub_images(self, temp_dir, plan):
+        """按规划调用外部程序转换图片并清理旧文件(独立分支 与结构处理及Phase 2并发)，返回是否成功"""
+        if not plan: return False
+        original_images, high_freq_images, image_mapping = plan['original_images'], plan['high_freq_images'], plan['image_mapping']
+        params, override_str, temp_dir_path = plan['params'], plan['override_str'], Path(temp_dir)
+        try:
             # ===== 5. 执行图片转换 (单次调用 传递追加覆盖参数) =====
             base_dir = Path(getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(sys.argv[0]))))
             converter_path = base_dir / "image_converter.exe"
-            if not converter_path.exists(): raise FileNotFoundError("图片转换器 image_converter.exe 未找到")
+            use_exe = os.name == 'nt' and converter_path.exists()
+            logger.info(f"图片总数: {len(original_images)}|含{len(high_freq_images)}张 追加独立参数")
+            # 书内去重：内容与生效参数都相同的图片只编码组内第一张，其余在转换后复制结果(或在汇合阶段合并为同一manifest条目)
+            overrides = {p: override_str for p in original_images if p in high_freq_images and override_str}
+            dst_of = lambda p: Path(p).with_name(image_mapping[Path(p).name])
+            probes = self._probe_images(original_images, params, overrides)
+            digests, groups = {p: hashlib.sha256(Path(p).read_bytes()).hexdigest() for p in original_images}, {}
+            [groups.setdefault((digests[p], overrides.get(p, '')), []).append(p) for p in original_images]
+            reps, plan['duplicates'] = [g[0] for g in groups.values()], {d: g[0] for g in groups.values() for d in g[1:]}
+            if plan['duplicates']: logger.info(f"重复图片: {len(plan['duplicates'])} 张与其他图片内容相同，只编码 {len(reps)} 张")
+            if skip := [p for p in reps if probes.get(p, (None, False))[1]]: # 已符合目标参数的图片原样保留(仅在后缀不同时复制为新文件名)
+                [shutil.copyfile(p, dst_of(p)) for p in skip if dst_of(p) != Path(p)]
+                reps = [p for p in reps if p not in skip]
+                logger.info(f"已符合目标格式与尺寸 无需重新编码: {len(skip)} 张")
+            # 查询跨书籍共享的转换缓存：键为源图片内容哈希+后端+生效参数，命中的直接写出结果 只转换未命中的图片
+            if cache := self._get_image_cache():
+                keys = {p: cache.key(digests[p], params + overrides.get(p, '').split(), 'exe' if use_exe else 'pillow') for p in reps}
+                todo = [p for p in reps if not cache.fetch(keys[p], dst_of(p))]
+                logger.info(f"图片缓存命中: {len(reps) - len(todo)}/{len(reps)}")
+            else: todo = reps
             # 构建带标记的列表，格式：绝对路径|覆盖参数
-            list_lines = [f"{p}|{override_str}" if p in high_freq_images and override_str else p for p in original_images]
-            with tempfile.NamedTemporaryFile(mode='w', delete=False, encoding='utf-8', dir=self.sesame_root) as list_file:
-                list_file.write('\n'.join(list_lines)); list_path = list_file.name
-            logger.debug(f"生成临时列表文件: {list_path}")
-            # 给图片转换程序传递主命令
-            cmd = [str(converter_path), "-i", f"@{list_path}"] + params
-            try:
-                logger.info(f"图片总数: {len(original_images)}|含{len(high_freq_images)}张 追加独立参数")
-                logger.debug(f"图片转换主命令: {' '.join(cmd)}")
-                result = subprocess.run(cmd, cwd=temp_dir, capture_output=True, check=True, encoding='utf-8', errors='replace')
-                out = result.stdout or ""
-                logger.debug("[转换] 输出日志:\n" + out)
-                m = re.search(r"成功\s*(\d+)/(\d+)", out); success, total = m.groups() if m else ("0", "0")
-                logger.success(f"图片转换成功: {success}/{total}")
-            except subprocess.CalledProcessError as e:
-                err = e.stderr.decode('utf-8', errors='replace') if isinstance(e.stderr, bytes) else (e.stderr or "")
-                logger.error(f"[错误] 转换失败:\n{err}"); raise
-            finally:
-                os.remove(list_path)
-                logger.debug(f"[清理] 已删除临时文件: {list_path}")
+            list_lines, t_start = [f"{p}|{overrides[p]}" if p in overrides else p for p in todo], time.time()
+            if not todo: pass
+            elif use_exe:
+                self._run_image_converter_exe(converter_path, list_lines, re.sub(r'(?:^|\s)-w\s*\d+', ' ', ' '.join(params)).split() + [f"-w{plan['workers']}"], temp_dir)
+            else: # 无exe或非Windows 使用内置转换后端(Pillow) 进程池并行编码 逐张汇报进度
+                try: from image_converter import convert_images
+                except ImportError as e: raise FileNotFoundError(f"图片转换器 image_converter.exe 未找到，内置转换后端不可用: {e}") from None
+                def progress(i, n, src, ok, msg):
+                    logger.debug(f"[转换 {i}/{n}] {'√' if ok else '×'} {Path(src).name} {msg}")
+                    if i * 10 // n != (i - 1) * 10 // n: logger.info(f"图片转换进度: {i}/{n}")
+                success, total, errors = convert_images(list_lines, params, plan['workers'], progress=progress, initializer=set_low_priority)
+                [logger.error(f"[错误] 转换失败: {e}") for e in errors]
+                logger.success(f"图片转换成功: {success}/{total} (内置转换后端)")
+            if cache and todo: # 本次新生成的结果写入缓存(按修改时间判断 排除转换失败仍保留的原图)
+                [cache.store(keys[p], d) for p in todo if (d := dst_of(p)).exists() and d.stat().st_mtime >= t_start]
+                if removed := cache.evict(): logger.debug(f"图片缓存淘汰 {removed} 个条目")
+            for d, r in plan['duplicates'].items(): # 重复图片复制代表图片的转换结果(内容相同 代表图片转换失败时复制的也是同样的原图)
+                if (src := dst_of(r)).exists() and src != dst_of(d): shutil.copyfile(src, dst_of(d))
             # ===== 6. 清理旧图片文件 =====
             deleted_files = 0
             for old_path in original_images:
@@ -769,18 +1136,71 @@ class EpubProcessor:
                     except Exception as e: logger.warning(f"[警告] 删除失败 {old_path}: {e}")
                 else: logger.error(f"[错误] 新文件未生成: {new_path.relative_to(temp_dir_path)}")
             logger.info(f"共清理 {deleted_files}/{len(original_images)} 个旧图片文件")
-            # ===== 7. 更新html内图片引用 =====
-            updated_refs = 0
-            for file in [f for f in temp_dir_path.rglob('*') if f.suffix.lower() in ('.xhtml', '.html')]:
-                try:
-                    content = original_content = file.read_text('utf-8')
-                    for old, new in image_mapping.items():
-                        if old in content: updated_refs += content.count(old); content = content.replace(old, new)
-                    if content != original_content:
-                        file.write_text(content, 'utf-8')
-                        logger.debug(f"更新图片路径: {file.relative_to(temp_dir_path)}")
-                except UnicodeDecodeError: logger.warning(f"[警告] 跳过二进制文件: {file}")
-                except Exception as e: logger.error(f"[错误] 处理文件失败 {file}: {e}")
+            return True
+        except Exception as e: logger.error(f"流程异常终止: {e}"); import traceback; traceback.print_exc(); logger.info("图片处理流程结束")
+        return False
+
+    def _probe_images(self, images, params, overrides):
+        """
+        并行读取图片文件头(尺寸/格式/透明通道)，返回{路径: (信息, 是否已符合目标参数)}，Pillow不可用时返回空字典
+        追加参数中的旋转(-r -R)按探测到的尺寸预先判定：不触发旋转的图片就地去掉旋转参数(overrides)，使其与同内容图片共用编码结果与缓存
+        """
+        try: from image_converter import probe_images, parse_params, drop_flags, should_rotate, is_compliant
+        except ImportError as e: return logger.debug(f"图片文件头探测不可用: {e}") or {}
+        try: base, over = parse_params(params), parse_params(params + next(iter(overrides.values()), '').split())
+        except ValueError as e: return logger.warning(f"图片文件头探测跳过: {e}") or {}
+        infos, result = probe_images(images), {}
+        for p, info in infos.items():
+            if p in overrides and info and not should_rotate(info[1], info[2], over):
+                overrides[p] = ' '.join(drop_flags(overrides[p].split(), ('-r', '-R')))
+                if not overrides[p]: del overrides[p]
+            result[p] = (info, is_compliant(info, parse_params(overrides[p].split(), base) if p in overrides else base))
+        logger.debug(f"图片文件头探测: {len(images)} 张，无法识别 {sum(not i for i in infos.values())} 张")
+        return result
+
+    def _get_image_cache(self):
+        """
+        跨书籍共享的图片转换缓存(依赖Pillow的image_converter模块)，不可用时返回None
+        命中的条目直接拷入书中，只能放在当前用户私有的目录(见class_list.user_cache_dir)，不能放在共享的临时目录
+        """
+        if getattr(self, '_image_cache', None) is None:
+            try: from image_converter import ImageCache
+            except ImportError as e: return logger.debug(f"图片转换缓存不可用: {e}")
+            from class_list import user_cache_dir
+            try: root = user_cache_dir("image_cache") or logger.warning("图片转换缓存目录不属于当前用户，不使用缓存")
+            except OSError as e: root = logger.warning(f"图片转换缓存目录不可用: {e}")
+            self._image_cache = ImageCache(root) if root else False # 不可用时记为False 不再重复尝试
+        return self._image_cache or None
+
+    def _run_image_converter_exe(self, converter_path, list_lines, params, temp_dir):
+        """通过临时列表文件调用image_converter.exe，解析输出中的 成功 N/M"""
+        with tempfile.NamedTemporaryFile(mode='w', delete=False, encoding='utf-8', dir=self.sesame_root) as list_file:
+            list_file.write('\n'.join(list_lines)); list_path = list_file.name
+        logger.debug(f"生成临时列表文件: {list_path}")
+        # 给图片转换程序传递主命令
+        cmd = [str(converter_path), "-i", f"@{list_path}"] + params
+        try:
+            logger.debug(f"图片转换主命令: {' '.join(cmd)}")
+            result = subprocess.run(cmd, cwd=temp_dir, capture_output=True, check=True, encoding='utf-8', errors='replace')
+            out = result.stdout or ""
+            logger.debug("[转换] 输出日志:\n" + out)
+            m = re.search(r"成功\s*(\d+)/(\d+)", out); success, total = m.groups() if m else ("0", "0")
+            logger.success(f"图片转换成功: {success}/{total}")
+        except subprocess.CalledProcessError as e:
+            err = e.stderr.decode('utf-8', errors='replace') if isinstance(e.stderr, bytes) else (e.stderr or "")
+            logger.error(f"[错误] 转换失败:\n{err}"); raise
+        finally:
+            os.remove(list_path)
+            logger.debug(f"[清理] 已删除临时文件: {list_path}")
+
+    def fix_image_refs(self, temp_dir, plan):
+        """图片分支与文本分支汇合后 更新html内图片引用与OPF媒体类型"""
+        from bs4 import BeautifulSoup
+        image_mapping, media_map, temp_dir_path = plan['image_mapping'], plan['media_map'], Path(temp_dir)
+        try:
+            # ===== 7. 更新html/css内图片引用 (按绝对路径精确匹配属性值与url()，每个文件单次扫描 多文件并行) =====
+            path_map = {os.path.realpath(p): os.path.realpath(Path(p).with_name(new)) for p in plan['original_images'] if (new := image_mapping[Path(p).name]) != Path(p).name}
+            updated_refs = self._rewrite_refs(temp_dir_path, path_map) if path_map else 0
             logger.info(f"共更新 {updated_refs} 个图片路径引用")
             # ===== 8. 强制更新OPF媒体类型 =====
             logger.info("更新opf媒体类型和路径")
@@ -817,14 +1237,52 @@ class EpubProcessor:
                 else:
                     logger.info("opf媒体类型和路径 无需修改")
             except Exception as e: logger.error(f"[严重错误] OPF处理失败: {e}"); raise
+            # ===== 9. 合并重复图片 =====
+            if plan.get('duplicates') and getattr(self, 'image_dedup_enabled', None) and self.image_dedup_enabled.get():
+                dst_of = lambda p: Path(p).with_name(image_mapping[Path(p).name]).resolve()
+                self._collapse_duplicate_images(temp_dir_path, opf_path, {dst_of(d): dst_of(r) for d, r in plan['duplicates'].items()})
         except Exception as e: logger.error(f"流程异常终止: {e}"); import traceback; traceback.print_exc()
         finally: logger.info("图片处理流程结束")
 
+    def _rewrite_refs(self, temp_dir_path, path_map):
+        """对书内全部html/css/svg并行执行mp_rewrite_refs(执行方式同Phase 2按成本模型选择)，返回改写总数"""
+        tasks = [((str(f), path_map), f.stat().st_size) for f in temp_dir_path.rglob('*') if f.suffix.lower() in MP_REF_SUFFIXES and f.is_file()]
+        mode, wk = self._choose_executor(tasks)[:2]
+        total = 0
+        with make_executor(mode, wk, max((c for _, c in tasks), default=0), set_low_priority) as executor:
+            for future in [executor.submit(run_batch, mp_rewrite_refs, batch) for batch, _ in plan_batches(tasks, wk)]:
+                for (success, file_str, err, count), _ in future.result():
+                    if not success: logger.error(f"[错误] 处理文件失败 {file_str}: {err}"); continue
+                    if count: total += count; logger.debug(f"更新图片路径: {Path(file_str).relative_to(temp_dir_path)} ({count})")
+        return total
+
+    def _collapse_duplicate_images(self, temp_dir_path, opf_path, dups):
+        """
+        重复图片合并为同一个manifest条目：html/css中指向重复图片的引用改写为指向代表图片的相对路径，删除重复文件及其manifest条目
+        dups: {重复图片绝对路径: 代表图片绝对路径}；封面条目保留不合并：带properties(如cover-image)、EPUB2 <meta name="cover"> 指向的id、guide中cover类引用的文件
+        """
+        from bs4 import BeautifulSoup
+        soup, opf_dir = BeautifulSoup(opf_path.read_text('utf-8'), 'xml'), opf_path.parent
+        items = {(opf_dir / unquote(i['href'])).resolve(): i for i in soup.find_all('item') if i.get('href')}
+        cover_ids = {m.get('content') for m in soup.find_all('meta', attrs={'name': 'cover'})}
+        cover_paths = {(opf_dir / unquote(r['href'].split('#')[0])).resolve().with_suffix('') for r in soup.find_all('reference')
+                       if r.get('href') and 'cover' in (r.get('type') or '').lower()} # 不比较后缀 guide中可能仍是转换前的文件名
+        dups = {d: r for d, r in dups.items() if d in items and r in items and not items[d].get('properties')
+                and items[d].get('id') not in cover_ids and d.with_suffix('') not in cover_paths and d.exists() and r.exists()}
+        if not dups: return
+        rewritten = self._rewrite_refs(temp_dir_path, {str(d): str(r) for d, r in dups.items()})
+        for d in dups:
+            items[d].decompose(); d.unlink(missing_ok=True)
+            logger.debug(f"[合并] {d.relative_to(temp_dir_path)} → {dups[d].relative_to(temp_dir_path)}")
+        opf_path.write_text(str(soup), 'utf-8')
+        logger.success(f"合并重复图片: 删除 {len(dups)} 个文件及manifest条目，改写 {rewritten} 处引用")
+
     def show_exclude_dialog(self):
         """章节合并排除/正则追加分割章节 对话框"""
+        from bs4 import BeautifulSoup; from book_index import ArchiveBookIndex; from epub_ncx_generator import EpubNCXGenerator
         if not getattr(self, "epub_path", None): return messagebox.showwarning("警告", "请先选择EPUB文件")
         # 1. 环境准备与记忆初始化
-        self._fcache, self._saved_hrefs = {}, {item[1] for item in getattr(self, "excluded_toc_entries", [])}
+        self._saved_hrefs = {item[1] for item in getattr(self, "excluded_toc_entries", [])}
         # 使用文件修改时间和路径哈希生成唯一的临时目录，避免多次操作时的冲突
         st = Path(self.epub_path).stat()
         h_p = abs(hash(str(Path(self.epub_path).resolve())))
@@ -834,14 +1292,22 @@ class EpubProcessor:
         self._exclude_tempdirs.add(self._exclude_tempdir)
         temp_path = self._exclude_tempdir
 
-        with zipfile.ZipFile(self.epub_path) as z: [z.extract(n, temp_path) for n in z.namelist() if n.lower().endswith(('.opf', '.ncx', '.xml', '.html', '.xhtml', '.htm'))]
-        opf = self._get_opf_path(temp_path)
-        EpubNCXGenerator.fix_ncx_paths(opf, self.ncx_offset_enabled.get(), self.ncx_atokagi_enabled.get(), self.ncx_manual_offset_val.get())
+        # 只解压OPF/NCX/nav等目录文件(目录修正会改写它们)，html的存在性、标题候选与分割预览的正文都直接从压缩包读取
+        with zipfile.ZipFile(self.epub_path) as z:
+            [z.extract(n, temp_path) for n in z.namelist() if n.lower().endswith(('.opf', '.ncx', '.xml'))]
+            opf = self._get_opf_path(temp_path)
+            if (nav := BeautifulSoup(opf.read_text("utf-8"), "xml").find('item', properties='nav')) and nav.get('href'):
+                nav_name = Path(os.path.relpath(os.path.normpath(opf.parent / nav['href']), temp_path)).as_posix()
+                if nav_name in z.namelist(): z.extract(nav_name, temp_path)
+        index = ArchiveBookIndex(temp_path, opf, self.epub_path)
+        EpubNCXGenerator.fix_ncx_paths(opf, self.ncx_offset_enabled.get(), self.ncx_atokagi_enabled.get(), self.ncx_manual_offset_val.get(), index)
         self._init_toc, self._curr_toc = (t := self._parse_toc(BeautifulSoup(opf.read_text("utf-8"), "xml"), opf)), t.copy()
-        if not t: return messagebox.showwarning("警告", "未找到目录条目")
+        if not t: return index.close() or messagebox.showwarning("警告", "未找到目录条目")
 
         # 2. UI 构建
         dialog = tk.Toplevel(self.root); dialog.title("选择不合并条目 / 正则追加分割章节")
+        split_state = {'gen': 0} # 分割预览代数 新预览开始或窗口关闭后旧结果作废(后台线程在下一个文件处中止)
+        dialog.bind("<Destroy>", lambda e: e.widget is dialog and (split_state.update(gen=split_state['gen'] + 1), index.close()))
         self.win_size.setup(dialog, "show_exclude_dialog", f"605x600+{self.root.winfo_x()+50}+{self.root.winfo_y()+30}"); dialog.focus_force()
         main_frame = ttk.Frame(dialog); main_frame.pack(fill="both", expand=True, padx=5, pady=5)
         tree = ttk.Treeview(main_frame, columns=("t", "h"), show="headings", selectmode="extended")
@@ -852,29 +1318,47 @@ class EpubProcessor:
         def update_mem(): 
             # 通过绑定的iid(即索引)，直接从源数据获取原始 href，避免 UI 污染
             if tree.get_children(): self._saved_hrefs = {self._curr_toc[int(i)]['href'] for i in tree.selection()}
+        shown = {} # 树中已显示的 iid -> (values, tags)
         def refresh():
+            """按差异更新目录树：iid即条目索引，只改写内容变化的行，追加新增行、删除多余行，选中状态一次性设置"""
             ttk.Style().map("Treeview", foreground=[e for e in ttk.Style().map("Treeview", query_opt="foreground") if e[:2] != ("!disabled", "!selected")]) #修复py3.8 Tk8.6.9树视图tag颜色失效Bug
-            tree.delete(*tree.get_children())
             tree.tag_configure("mis", font=("", 10, "overstrike"), foreground="gray") # 定义删除线样式
             tree.tag_configure("warn", foreground="red")
-            ex, sn = getattr(self, "excluded_toc_entries", []), {f.name for f in self._get_spine_ordered_files(opf)}
+            ex, sn = getattr(self, "excluded_toc_entries", []), {f.name for f in index.spine_files()}
+            ex_titles, sel = {x[0] for x in ex}, []
             for idx, e in enumerate(self._curr_toc):
                 t, h = e.get('title', ''), e['href']
                 fn = unquote(h.split('#')[0]).split('/')[-1]
-                p_ex = (opf.parent / unquote(h.split('#')[0])).exists()
+                p_ex = index.exists(opf.parent / unquote(h.split('#')[0]))
                 # 判定：路径不存在的文件用mis 不在spine内用warn
                 tag = ("mis",) if "_spt_" not in h and not p_ex else (("warn",) if "_spt_" not in h and fn not in sn else ())
                 pre = "[!路径文件不存在] " if tag == ("mis",) else ("[!spine列表内不存在] " if tag == ("warn",) else "")
-                iid = tree.insert("", "end", iid=str(idx), values=(("\u3000"*e.get('depth', 0)) + pre + t, unquote(h)), tags=tag)
+                row = ((("\u3000"*e.get('depth', 0)) + pre + t, unquote(h)), tag)
+                if (iid := str(idx)) not in shown: tree.insert("", "end", iid=iid, values=row[0], tags=row[1])
+                elif shown[iid] != row: tree.item(iid, values=row[0], tags=row[1])
+                shown[iid] = row
                 # 匹配逻辑：1.记忆中的href 2.完整匹配 3.无锚点匹配 4.标题匹配
-                if h in self._saved_hrefs or (t, h) in ex or (t, h.split('#')[0]) in ex or any(t == x[0] for x in ex): tree.selection_add(iid)
-        def run_splits():
-            update_mem(); self._curr_toc, self._split_rules = self._init_toc.copy(), []
+                if h in self._saved_hrefs or (t, h) in ex or (t, h.split('#')[0]) in ex or t in ex_titles: sel.append(iid)
+            if stale := [i for i in shown if int(i) >= len(self._curr_toc)]: tree.delete(*stale); [shown.pop(i) for i in stale]
+            tree.selection_set(sel)
+        def run_splits(wait=False):
+            """后台线程计算分割预览(直接读取压缩包)，主线程轮询结果后差异刷新；新的预览开始时旧的计算在下一个文件处中止"""
+            update_mem(); self._split_rules = []
             for cb, en in regex_entries:
                 if (p := en.get().strip()): self._split_rules.append((p, '分割章节{idx}', 2 if cb.get() == "层级2(子章节)" else 1))
-            patterns = [r[0] for r in self._split_rules]
-            if patterns and (nt := self._internal_split_logic(patterns, self._curr_toc, temp_path, self._split_rules)): self._curr_toc = nt
-            refresh()
+            patterns, rules, base = [r[0] for r in self._split_rules], list(self._split_rules), self._init_toc.copy()
+            gen = split_state['gen'] = split_state['gen'] + 1
+            result = {}
+            worker = threading.Thread(target=lambda: result.update(toc=patterns and self._internal_split_logic(
+                patterns, base, index, rules, cancel=lambda: gen != split_state['gen'])), daemon=True)
+            worker.start()
+            def apply():
+                if gen != split_state['gen'] or not dialog.winfo_exists(): return # 已被更新的预览取代
+                if worker.is_alive(): return dialog.after(30, apply)
+                update_mem(); self._curr_toc = result.get('toc') or base
+                refresh()
+            if wait: worker.join()
+            apply()
         # 正则输入区
         regex_entries, reg_frame = [], ttk.Frame(dialog); reg_frame.pack(fill="x", padx=5)
         def add_row(txt="", level=2):
@@ -893,7 +1377,7 @@ class EpubProcessor:
         inner_box = ttk.Frame(btn_frame); inner_box.pack(anchor="center")
         ttk.Button(inner_box, text="预览全部正则追加、分割章节", command=run_splits).pack(side="left", padx=5)
         def on_confirm():
-            run_splits(); update_mem()
+            run_splits(wait=True); update_mem()
             self._saved_regex_list = [en.get().strip() for _, en in regex_entries if en.get().strip()] or [""]
             self._saved_regex_levels = [2 if cb.get() == "层级2(子章节)" else 1 for cb, en in regex_entries]
             exist = {i[1] for i in getattr(self, "excluded_toc_entries", [])}
@@ -904,31 +1388,30 @@ class EpubProcessor:
         ttk.Button(inner_box, text="追加排除条目/正则追加&分割子章节", command=on_confirm).pack(side="left", padx=5)
 
     def _get_spine_ordered_files(self, opf_path):
-        """获取按 Spine 顺序排列的 HTML 文件列表"""
-        soup = BeautifulSoup(opf_path.read_text('utf-8'), 'xml')
-        m = {it['id']: it['href'] for it in soup.find('manifest').find_all('item')}
-        return [f for r in soup.find('spine').find_all('itemref') if (idr := r.get('idref')) and (href := m.get(idr)) and (f := opf_path.parent / href)
-                and f.exists() and f.suffix.lower() in ['.html', '.xhtml', '.htm']]
+        """获取按 Spine 顺序排列的 HTML 文件列表 (由书籍引用索引缓存，OPF未修改时不重复解析)"""
+        return self._get_book_index(opf_path).spine_files()
 
     def _clean_title(self, html_fragment):
         """统一标题清洗 处理多余标签及空格"""
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(html_fragment, 'html.parser')
         for img in soup.find_all('img'): img.decompose() # 移除所有图片标签，避免 alt 属性干扰标题
         t = soup.get_text().replace('\u3000', ' ').replace('\xa0', ' ').strip() # 直接取 text，并处理全角/半角空格
         return ' '.join(t.split()) # 将多个连续空格合并为一个
 
-    def _internal_split_logic(self, patterns, current_toc, temp_dir, split_rules=None):
-        """章节分割预览逻辑"""
+    def _internal_split_logic(self, patterns, current_toc, index, split_rules=None, cancel=None):
+        """章节分割预览逻辑 (index: 书籍引用索引，提供spine与正文文本；cancel()为真时中止并返回None)"""
         try: rules = re.compile("|".join(f"(?:{p})" for p in patterns))
         except: return None
-        if not hasattr(self, "_fcache"): self._fcache = {}
-        opf, new_toc, dep, s_rules = self._get_opf_path(Path(temp_dir)), [], 0, split_rules or []
+        new_toc, dep, s_rules = [], 0, split_rules or []
         lookup = {t['href'].split('#')[0].split('/')[-1]: t for t in current_toc}
-        for hf in self._get_spine_ordered_files(opf):
+        for hf in index.spine_files():
+            if cancel and cancel(): return None
             if (n := hf.name) in lookup: new_toc.append(e := lookup.pop(n)); dep = e.get('depth', 0)
-            if not hf.exists(): continue
-            if n not in self._fcache: self._fcache[n] = hf.read_text('utf-8', 'ignore')
-            if rules.search(c := self._fcache[n]):
+            if not index.exists(hf): continue
+            try: c = index.read_text(hf)
+            except ValueError: return None # 窗口关闭后压缩包句柄已关闭
+            if rules.search(c):
                 for i, m in enumerate(rules.finditer(c), 1):
                     # 匹配层级(1=同级, 2=子级)，计算相对深度
                     matched = m.group()
@@ -940,6 +1423,7 @@ class EpubProcessor:
 
     def _apply_regex_split(self, temp_dir, current_toc=None):
         """正则匹配子章节追加分割逻辑"""
+        from bs4 import BeautifulSoup; from epub_ncx_generator import EpubNCXGenerator
         if not (rules := getattr(self, '_split_rules', [])): return current_toc
         opf_p, total = self._get_opf_path(Path(temp_dir)), 0
         last_href = current_toc[0]['href'] if current_toc else None
@@ -1045,6 +1529,7 @@ class EpubProcessor:
 
     def show_class_list(self):
         """class样式收集分析对话框"""
+        from class_list import ClassList
         if not getattr(self, 'epub_path', None): return messagebox.showwarning("警告", "请先选择EPUB文件")
         if not hasattr(self, 'temp_style_content'): self.temp_style_content = ""
         ClassList(self.root, self.epub_path, 
@@ -1052,7 +1537,7 @@ class EpubProcessor:
                   lambda v: setattr(self, 'temp_style_content', v), 
                   lambda v: setattr(self, 'temp_style_content', self.temp_style_content + v),
                   self._settings_vars_dict['max_workers_var'].get(),
-                  self.win_size)
+                  self.win_size, self._settings_vars_dict['executor_backend_var'].get())
 
     def save_app_settings(self, return_config=False):
         """保存到配置文件，或返回ConfigParser对象"""
@@ -1071,12 +1556,12 @@ class EpubProcessor:
             logger.info(f"设置已保存到: {self.config_file}")
         except Exception as e: logger.error(f"保存设置失败: {e}")
 
-    def load_app_settings(self):
-        """用 configparser 读取配置（跳过正则段）"""
-        if not self.config_file.exists(): return logger.warning(f"配置文件不存在: {self.config_file}")
+    def load_app_settings(self, text=None):
+        """用 configparser 读取配置（跳过正则段），text为已读取的配置文件内容(启动时)，为None则从文件读取"""
+        if text is None and not self.config_file.exists(): return logger.warning(f"配置文件不存在: {self.config_file}")
         try:
             config = configparser.ConfigParser()
-            config.read_string(self.config_file.read_text('utf-8').split('[RegexRules]', 1)[0])
+            config.read_string((self.config_file.read_text('utf-8') if text is None else text).split('[RegexRules]', 1)[0])
             if 'AppSettings' in config:
                 sec = config['AppSettings']
                 for name, var in self._settings_vars_dict.items():
@@ -1090,25 +1575,25 @@ class EpubProcessor:
 
     def reset_app_settings(self):
         """重置所有设置为控件默认值，并重置正则规则"""
-        [var.set(True) if isinstance(var, tk.BooleanVar)
+        [var.set(name not in self.CFG_OFF) if isinstance(var, tk.BooleanVar)
         else var.set(
             'em-sesame|em-dot' if name == 'class_name_var' else
             "-f webp -q80 -H1300 -W1200 -s1.0 -A -w8" if name == 'image_params_var' else
             'hr+br' if name == 'merge_separator_var' else
             '-' if name == 'merge_remove_blank_lines_var' else
             '3' if name == 'merge_limit_blank_lines_var' else
-            'Auto' if name == 'max_workers_var' else
+            'Auto' if name in ('max_workers_var', 'executor_backend_var') else
             '')
         for name, var in self._settings_vars_dict.items()]
         # 同步重置正则规则
         if hasattr(self, 'regex_manager'): self.regex_manager.reset_to_default()
 
 class WinSize:
-    def __init__(self, config_file=None):
+    def __init__(self, config_file=None, text=None):
         self._states = {}
-        if config_file and config_file.exists():
+        if text is not None or (config_file and config_file.exists()):
             try:
-                c = config_file.read_text('utf-8').split('[WinSize]', 1)[1].split('[', 1)[0]
+                c = (config_file.read_text('utf-8') if text is None else text).split('[WinSize]', 1)[1].split('[', 1)[0]
                 self._states = {k.strip(): v.strip() for l in c.splitlines() if '=' in l for k, v in [l.split('=', 1)]}
             except Exception: pass
 
@@ -1141,8 +1626,34 @@ class WinSize:
     def save(self, config):
         config['WinSize'] = self._states
 
+def mp_benchmark(epub_path, workers=None):
+    """
+    并行后端基准：解包同一本EPUB的xhtml，用默认处理开关分别以 直接执行/线程池/进程池 跑Phase 2单文件流水线与Class分析的html解析，输出吞吐量
+    用法: python sesame-to-ruby.py --bench book.epub [worker数]
+    """
+    from book_index import mp_index_html
+    wk = workers or auto_workers(8)[0]
+    flags = {'is_style': True, 'is_process_ruby': True, 'is_modify_html': True, 'is_process_images': True,
+             'remove_blank': '-', 'limit_blank': '3', 'remove_head_blank': True}
+    with zipfile.ZipFile(epub_path) as z, tempfile.TemporaryDirectory(prefix="sesame_bench_") as tmp:
+        names = [n for n in z.namelist() if n.lower().endswith(('.xhtml', '.html'))]
+        def make_tasks(): # 每轮解包新副本 流水线会原地改写文件
+            run_dir = Path(tempfile.mkdtemp(dir=tmp)); z.extractall(run_dir, names)
+            return [((str(run_dir / n), '../css/style.css', 'ja', 'em-sesame|em-dot|kenten', flags, []), (run_dir / n).stat().st_size) for n in names]
+        for mode, n, size, sec in benchmark(mp_process_single_file_pipeline, make_tasks, wk, initializer=set_low_priority):
+            logger.info(f"[{mode:>7}] x{1 if mode == 'inline' else wk} {n} 个文件 {size / 2**20:.1f}MB 用时 {sec:.2f}s "
+                        f"吞吐 {n / sec:.1f} 文件/s {size / 2**20 / sec:.2f}MB/s")
+        # Class分析的html解析(只读 不需要副本)：线程池受GIL限制的部分与进程池回传紧凑结果的开销对比
+        html = [((z.read(n), n, frozenset()), z.getinfo(n).file_size) for n in names]
+        for mode, n, size, sec in benchmark(mp_index_html, lambda: html, wk):
+            logger.info(f"[Class分析 {mode:>7}] x{1 if mode == 'inline' else wk} {n} 个文件 {size / 2**20:.1f}MB 用时 {sec:.2f}s "
+                        f"吞吐 {n / sec:.1f} 文件/s {size / 2**20 / sec:.2f}MB/s")
+    logger.info(f"GIL: {'禁用' if resolve_backend() == 'thread' else '启用'}，Auto后端: {resolve_backend()}")
+
 if __name__ == "__main__":
     multiprocessing.freeze_support()
+    if len(sys.argv) > 2 and sys.argv[1] == '--bench':
+        sys.exit(mp_benchmark(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None))
     logger.info("程序初始化")
     root = TkinterDnD.Tk()
     processor = EpubProcessor(root)
@@ -0,0 +1,83 @@
+import bisect
+import re
+from array import array
+
+try: from re import _parser as sre_parse # 3.11+ 直接导入sre_parse会触发弃用警告
+except ImportError: import sre_parse
+
+# ===================================================================== #
+# 预览搜索的全文索引：首次搜索时按需加载各文件的解码文本并建立三元组(trigram)倒排表
+# 正则中必然出现的字面量拆成三元组作为预过滤，只对可能命中的文件执行正则；文件内容来源变化(如被替换)时自动重建该文件的条目
+
+GRAM = 3
+INDEX_MAX_POSTINGS = 1 << 24 # 倒排条目总数上限(约64MB)，超出后新加载的文件只保存文本不建索引，搜索时直接执行正则
+_LITERAL, _SUBPATTERN = sre_parse.LITERAL, sre_parse.SUBPATTERN
+
+def required_literals(pattern):
+    """正则匹配结果中必然出现的字面量(顶层及无标志分组内连续的普通字符)，含忽略大小写标志或无法解析时返回[]"""
+    try: parsed = sre_parse.parse(pattern) if isinstance(pattern, str) else sre_parse.parse(pattern.pattern, pattern.flags)
+    except re.error: return []
+    if parsed.state.flags & re.I: return []
+    runs, cur = [], []
+    def walk(items):
+        for op, av in items:
+            if op is _LITERAL: cur.append(chr(av)); continue
+            if op is _SUBPATTERN and not (av[1] or av[2]): walk(av[3]); continue # (组号, 追加标志, 移除标志, 子模式)
+            runs.append(''.join(cur)); cur.clear()
+    walk(parsed)
+    runs.append(''.join(cur))
+    return [r for r in runs if len(r) >= GRAM]
+
+def gram_keys(text):
+    """text中全部三元组的哈希(截为32位整数)，哈希冲突只会多放过文件，不会漏掉"""
+    return {hash(text[i:i + GRAM]) & 0xFFFFFFFF for i in range(len(text) - GRAM + 1)}
+
+class TextIndex:
+    """
+    文件名 -> (内容来源标识, 解码文本, 文件序号)，倒排表 三元组哈希 -> 文件序号(只在一个文件中出现时为int，否则为升序的array('I'))
+    不保存各文件的三元组集合，丢弃条目时从文本重新计算；序号单调递增不复用，搜索开始后新建的条目一律直接执行正则
+    来源标识由调用方给出(如修改后的字节对象或EPUB修改时间)，与已索引的不相等时重新加载
+    """
+    def __init__(self, max_postings=INDEX_MAX_POSTINGS):
+        self._files, self._postings, self._next, self._size, self.max_postings = {}, {}, 0, 0, max_postings
+
+    def text(self, name, token, load):
+        """name的解码文本，未索引或来源变化时调用load()取字节并重建该文件的条目(倒排表已满时文件序号为None)"""
+        if (entry := self._files.get(name)) and entry[0] == token: return entry[1]
+        self.discard(name)
+        text = load().decode('utf-8', 'ignore')
+        if self._size + len(keys := gram_keys(text)) > self.max_postings: self._files[name] = (token, text, None); return text
+        o, self._next, self._size = self._next, self._next + 1, self._size + len(keys)
+        for k in keys:
+            if (p := self._postings.get(k)) is None: self._postings[k] = o
+            elif type(p) is int: self._postings[k] = array('I', (p, o))
+            else: p.append(o)
+        self._files[name] = (token, text, o)
+        return text
+
+    def discard(self, name):
+        if not (entry := self._files.pop(name, None)) or (o := entry[2]) is None: return
+        self._size -= len(keys := gram_keys(entry[1]))
+        for k in keys:
+            if (p := self._postings.get(k)) == o: del self._postings[k]
+            elif type(p) is array and (i := bisect.bisect_left(p, o)) < len(p) and p[i] == o:
+                del p[i]
+                if len(p) == 1: self._postings[k] = p[0]
+
+    def candidates(self, literals):
+        """全部必需字面量的三元组都出现的文件序号集合，无字面量时返回None(不过滤)"""
+        found = None
+        for k in {k for lit in literals for k in gram_keys(lit)}:
+            p = self._postings.get(k, ())
+            found = (s := {p} if type(p) is int else set(p)) if found is None else found & s
+            if not found: break
+        return found
+
+    def search(self, rx, names, token_of, load):
+        """按names顺序逐个文件执行已编译的正则rx，每个文件产出一次(文件名, [(起, 止)])，预过滤排除的文件产出空列表以便调用方分帧"""
+        found, top = self.candidates(required_literals(rx)), self._next
+        for name in names:
+            token = token_of(name)
+            if found is not None and (entry := self._files.get(name)) and entry[0] == token and entry[2] is not None and entry[2] < top and entry[2] not in found:
+                yield name, []; continue
+            yield name, [m.span() for m in rx.finditer(self.text(name, token, lambda: load(name)))]
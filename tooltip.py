@@ -6,6 +6,7 @@ class ToolTip:
         self._text = text
         self.wrap_length = wrap_length  # 新增换行长度参数
         self.follow_widget = follow_widget
+        self.note = "" # 附加显示在提示文本下方、不随text保存的说明(如规则耗时分析结果)
         self.tip_window = None
         self.widget.bind("<Enter>", self.show_tip)
         self.widget.bind("<Leave>", self.hide_tip)
@@ -21,7 +22,7 @@ class ToolTip:
 
     def show_tip(self, event=None):
         """显示多行提示"""
-        if self.tip_window or not self._text:
+        if self.tip_window or not (shown := "\n\n".join(t for t in (self._text, self.note) if t)):
             return
 
         # 计算提示窗口位置
@@ -36,7 +37,7 @@ class ToolTip:
         # 创建支持多行显示的Label
         label = tk.Label(
             self.tip_window,
-            text=self._text,
+            text=shown,
             bg="#FFFFE0",
             relief="solid",
             borderwidth=1,
@@ -0,0 +1,328 @@
+import heapq
+import math
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+# ===================================================================== #
+# 并行任务调度工具 (纯数据，不依赖GUI，可被worker进程按模块引用反序列化)
+
+BATCH_BYTES = 64 * 1024 # 小文件打包的目标字节数 标题页/插图页等小文件合并为一个任务以摊薄进程间通信开销
+# 成本模型(秒) 按单文件流水线实测粗略标定：固定开销+按字节线性增长；进程池启动含子进程导入bs4等模块(Windows spawn较慢)
+COST_PER_FILE, COST_PER_BYTE, POOL_START_COST, THREAD_START_COST = 0.005, 5e-6, 0.5, 0.01
+BACKENDS = ['Auto', 'Process', 'Thread'] # 并行后端 Auto: GIL禁用(自由线程版CPython)时用线程，否则用进程
+# 内存模型 单个worker基础占用(导入模块后)与BS4解析时每字节源文件的内存膨胀倍数，实际运行中观测到的峰值RSS会覆盖估算
+WORKER_BASE_RSS, RSS_PER_BYTE = 80 * 2**20, 60
+IMAGE_WORKER_RSS = 256 * 2**20 # 图片编码单进程预计占用(解码后的位图与编码缓冲) 与Phase 2并发时从内存预算中扣除
+RECYCLE_TASKS, RECYCLE_RSS = 64, 1536 * 2**20 # 每个worker累计处理任务数或RSS超过上限后换新进程池 抑制长批处理的内存碎片
+_observed_per_byte = 0 # 本进程内观测到的worker峰值RSS折算的每字节膨胀倍数 供后续书籍的自动规划参考
+# 看门狗任务记录 每个任务一组(进程号, 任务开始, 步骤号, 步骤开始, 状态)，worker在共享内存中登记，主进程据此判断超时与进程池损坏后的重试
+WATCH_FIELDS, WATCH_RUNNING, WATCH_DONE = 5, 1, 2
+# 看门狗时限(秒)：单条正则作用于单个文件/单个任务的时间上限，超时结束worker；主进程每隔MP_WATCH_INTERVAL检查一次(Phase 2与规则耗时分析共用)
+MP_RULE_TIMEOUT, MP_FILE_TIMEOUT, MP_WATCH_INTERVAL = 10.0, 120.0, 0.5
+WATCH_COMMITTED = -2 # 步骤号：结果已写入磁盘，进程池损坏时不可重试
+_watch, _watch_task = None, -1 # worker端：共享任务记录、当前任务号
+_guard = None # 主进程：当前线程/线程池执行时启用的WatchedCall，guarded()据此把可能失控的步骤交给子进程
+
+def init_watch(records, initializer=None):
+    """进程池initializer：保存共享任务记录后执行原initializer"""
+    global _watch
+    _watch = records
+    if initializer: initializer()
+
+def watch_step(step=-1):
+    """worker端：当前任务进入的步骤(如正则规则序号，-1为其他步骤)，未启用看门狗时无操作"""
+    if _watch is not None and _watch_task >= 0:
+        i = _watch_task * WATCH_FIELDS
+        _watch[i + 2], _watch[i + 3] = step, time.monotonic()
+
+def guarded(fn, arg):
+    """执行可能失控的步骤(如用户正则)：进程池worker内直接执行(worker本身受看门狗约束)，主进程启用WatchedCall时交给其子进程"""
+    return fn(arg) if _guard is None else _guard(fn, arg)
+
+def run_batch(fn, batch, ids=None):
+    """worker端顺序执行一批任务，返回[(结果, 耗时秒)]，耗时用于统计总工作量；ids为看门狗任务号(与batch对齐)"""
+    global _watch_task
+    results = []
+    for n, arg in enumerate(batch):
+        if _watch is not None and ids: # 登记 (进程号, 任务开始, 步骤-1, 步骤开始, 运行中)
+            _watch_task, now = ids[n], time.monotonic()
+            _watch[_watch_task * WATCH_FIELDS:(_watch_task + 1) * WATCH_FIELDS] = [os.getpid(), now, -1, now, WATCH_RUNNING]
+        t0 = time.perf_counter()
+        results.append((fn(arg), time.perf_counter() - t0))
+        if _watch is not None and ids: _watch[_watch_task * WATCH_FIELDS + 4], _watch_task = WATCH_DONE, -1
+    return results
+
+def plan_batches(tasks, workers, batch_bytes=BATCH_BYTES):
+    """
+    按字节数估算成本的LPT(最长处理时间优先)调度：大任务先提交，避免最后提交的大文件拖尾
+    tasks: [(参数, 字节数)]；小于目标批量的任务按从大到小顺序打包，目标批量不超过 总量/(workers*4) 以保留负载均衡的粒度
+    返回 [(参数列表, 字节数)] 按成本降序
+    """
+    target = min(batch_bytes, sum(c for _, c in tasks) // (max(workers, 1) * 4))
+    batches, small, acc = [], [], 0
+    for arg, cost in sorted(tasks, key=lambda t: t[1], reverse=True):
+        if cost >= target: batches.append(([arg], cost)); continue
+        small.append(arg); acc += cost
+        if acc >= target: batches.append((small, acc)); small, acc = [], 0
+    if small: batches.append((small, acc))
+    return sorted(batches, key=lambda b: b[1], reverse=True)
+
+def lpt_makespan(costs, workers):
+    """按LPT列表调度模拟各worker的负载，返回预计完工量(与costs同单位)"""
+    loads = [0] * max(workers, 1)
+    for c in sorted(costs, reverse=True): heapq.heapreplace(loads, loads[0] + c)
+    return max(loads)
+
+def makespan_report(work, wall, workers, longest=0.0):
+    """理想完工时间 = max(总工作量/worker数, 最长单任务)，与实际墙钟时间对比得出调度效率"""
+    ideal = max(work / max(workers, 1), longest)
+    return f"总工作量 {work:.2f}s / {workers} worker，理想完工 {ideal:.2f}s，实际 {wall:.2f}s，效率 {ideal / wall:.0%}" if wall else ""
+
+def estimate_cost(tasks):
+    """按文件数与字节数估算串行处理总耗时(秒) tasks: [(参数, 字节数)]"""
+    return len(tasks) * COST_PER_FILE + sum(c for _, c in tasks) * COST_PER_BYTE
+
+def choose_strategy(predicted, max_workers, backend='process'):
+    """
+    按预计串行耗时选择执行方式，返回(方式, worker数, 预计墙钟耗时)
+    不足以摊薄线程/进程池启动开销时在当前线程直接执行；否则保证每个worker至少分到一份启动开销的工作量
+    """
+    start = THREAD_START_COST if backend == 'thread' else POOL_START_COST
+    if predicted < start * 2 or max_workers <= 1: return 'inline', 1, predicted
+    wk = min(max_workers, max(2, int(predicted / start)))
+    return backend, wk, predicted / wk + start
+
+def gil_disabled():
+    """自由线程版CPython(3.13t+)且运行时未重新启用GIL"""
+    return hasattr(sys, '_is_gil_enabled') and not sys._is_gil_enabled()
+
+def resolve_backend(cfg='Auto'):
+    """配置值(Auto/Process/Thread)转为执行方式 process/thread"""
+    return cfg.lower() if cfg in ('Process', 'Thread') else 'thread' if gil_disabled() else 'process'
+
+def make_executor(mode, workers, largest_bytes=0, initializer=None, watch=None):
+    """
+    按执行方式创建Executor：inline当前线程 / thread线程池 / process可回收进程池(initializer仅用于进程，如降低优先级)
+    watch: TaskWatch，仅进程池生效(线程无法从外部终止)
+    """
+    if mode == 'inline': return InlineExecutor()
+    if mode == 'thread': return ThreadPoolExecutor(max_workers=workers)
+    if watch: return RecyclingPool(workers, largest_bytes=largest_bytes, initializer=init_watch, initargs=(watch.records, initializer))
+    return RecyclingPool(workers, largest_bytes=largest_bytes, initializer=initializer)
+
+def benchmark(fn, make_tasks, workers, modes=('inline', 'thread', 'process'), initializer=None):
+    """
+    同一语料依次用各执行方式跑完全部任务，返回[(方式, 任务数, 字节数, 耗时秒)]
+    make_tasks: 每轮调用一次生成新的[(参数, 字节数)] (流水线会原地改写文件 每轮需要新副本)
+    """
+    results = []
+    for mode in modes:
+        tasks = make_tasks()
+        t0 = time.perf_counter()
+        with make_executor(mode, workers, max((c for _, c in tasks), default=0), initializer) as executor:
+            wait([executor.submit(run_batch, fn, batch) for batch, _ in plan_batches(tasks, workers)])
+        results.append((mode, len(tasks), sum(c for _, c in tasks), time.perf_counter() - t0))
+    return results
+
+class InlineExecutor(Executor):
+    """在调用线程内同步执行的Executor，接口与进程池一致，供小书跳过进程池"""
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        try: future.set_result(fn(*args, **kwargs))
+        except BaseException as e: future.set_exception(e)
+        return future
+
+def _read_cgroup(*paths):
+    """读取首个存在的cgroup文件内容，不存在返回None"""
+    for path in paths:
+        try:
+            with open(path, encoding='utf-8') as f: return f.read().strip()
+        except OSError: continue
+    return None
+
+def available_cpus():
+    """可用CPU数：CPU亲和性掩码与cgroup配额(cpu.max / cfs_quota_us)取较小值"""
+    try: n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        try: import psutil; n = len(psutil.Process().cpu_affinity())
+        except Exception: n = os.cpu_count() or 1
+    quota = None
+    if (v2 := _read_cgroup('/sys/fs/cgroup/cpu.max')) and not v2.startswith('max'):
+        q, period = v2.split()[:2]; quota = int(q) / int(period)
+    elif (q := _read_cgroup('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us')) and int(q) > 0:
+        quota = int(q) / int(_read_cgroup('/sys/fs/cgroup/cpu/cpu.cfs_period_us', '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us') or 100000)
+    return max(1, min(n, math.ceil(quota))) if quota else max(1, n)
+
+def available_memory():
+    """可用内存：系统可用内存与cgroup内存上限剩余量(memory.max / limit_in_bytes)取较小值"""
+    import psutil # 延迟导入 GUI启动时只用到本模块的常量
+    avail = psutil.virtual_memory().available
+    limit = _read_cgroup('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    if limit and limit.isdigit() and int(limit) < 2**60: # v1无限制时为接近2^63的值
+        used = _read_cgroup('/sys/fs/cgroup/memory.current', '/sys/fs/cgroup/memory/memory.usage_in_bytes')
+        avail = min(avail, int(limit) - int(used or 0))
+    return max(avail, 0)
+
+def auto_workers(cap=8, largest_bytes=0, reserve=(0, 0)):
+    """
+    自动worker数：min(上限, 可用CPU, 可用内存*0.8/单worker预计RSS)，返回(worker数, 说明)
+    单worker预计RSS = 基础占用 + 最大任务字节数 * 膨胀倍数(默认值与此前观测值取较大)
+    reserve: 同时运行的其他阶段(如图片编码)占用的(CPU数, 内存字节数)，先从可用预算中扣除
+    """
+    cpus, mem = max(1, available_cpus() - reserve[0]), max(0, available_memory() - reserve[1])
+    per = WORKER_BASE_RSS + largest_bytes * max(RSS_PER_BYTE, _observed_per_byte)
+    wk = max(1, min(cap, cpus, int(mem * 0.8 // per)))
+    return wk, (f"CPU {cpus}，可用内存 {mem / 2**20:.0f}MB" + (f"(已扣除并发阶段 {reserve[0]} 核 {reserve[1] / 2**20:.0f}MB)" if any(reserve) else "")
+                + f"，单worker预计 {per / 2**20:.0f}MB -> {wk}")
+
+def split_budget(requested=0):
+    """与Phase 2并发的阶段(图片编码)的进程数：最多取可用CPU的一半，requested为用户指定的进程数(0为不指定)"""
+    half = max(1, available_cpus() // 2)
+    return min(requested, half) if requested else half
+
+class RecyclingPool(Executor):
+    """
+    可回收的进程池：当前代累计提交 workers*max_tasks 个任务，或任一子进程RSS超过rss_limit后，后续任务提交到新一代进程池
+    旧池处理完手头任务后自行退出；调用方需分批提交(保持有限的在途任务)回收才能生效
+    """
+    def __init__(self, max_workers, max_tasks=RECYCLE_TASKS, rss_limit=RECYCLE_RSS, largest_bytes=0, **kwargs):
+        self.max_workers, self.max_tasks, self.rss_limit, self.largest_bytes, self.kwargs = max_workers, max_tasks, rss_limit, largest_bytes, kwargs
+        self._pool, self._count, self._retired, self.peak_rss, self.generations = None, 0, [], 0, 0
+
+    def sample_rss(self):
+        """采样当前代子进程RSS并记录峰值，返回当前最大值 (_processes为ProcessPoolExecutor内部的pid->进程表)"""
+        import psutil
+        rss = 0
+        for pid in list(getattr(self._pool, '_processes', None) or {}):
+            try: rss = max(rss, psutil.Process(pid).memory_info().rss)
+            except psutil.Error: continue
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def submit(self, fn, /, *args, **kwargs):
+        """当前代进程池达到回收条件或已损坏(worker被看门狗结束)时换新一代后提交"""
+        if self._pool and (self._pool._broken or self._count >= self.max_workers * self.max_tasks or self.sample_rss() > self.rss_limit):
+            self._pool.shutdown(wait=False); self._retired.append(self._pool); self._pool = None
+        if not self._pool:
+            self._pool, self._count = ProcessPoolExecutor(max_workers=self.max_workers, **self.kwargs), 0
+            self.generations += 1
+        self._count += 1
+        return self._pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        global _observed_per_byte
+        if self._pool: self.sample_rss()
+        for pool in [*self._retired, self._pool]:
+            if pool: pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+        if self.peak_rss > WORKER_BASE_RSS and self.largest_bytes: _observed_per_byte = (self.peak_rss - WORKER_BASE_RSS) / self.largest_bytes
+
+class TaskWatch:
+    """
+    进程池任务看门狗(主进程端)：worker在共享内存中登记各任务的进程号、开始时间、当前步骤与完成状态
+    re等C扩展执行期间既不释放GIL也不响应信号，超时的任务只能从外部结束worker进程；进程池随之损坏，
+    其余未完成的任务由调用方按 state() 判断能否重新提交(未开始/运行中未写入可重试，已完成或已写入不可重试)
+    """
+    def __init__(self, n_tasks, step_budget, task_budget):
+        from multiprocessing import RawArray # 无锁共享数组 每个字段只有一个写入方
+        self.records, self.step_budget, self.task_budget = RawArray('d', n_tasks * WATCH_FIELDS), step_budget, task_budget
+        self.killed = {} # {任务号: (步骤号, 超时类型, 已用秒)}
+
+    def record(self, tid):
+        """(进程号, 任务开始, 步骤号, 步骤开始, 状态)"""
+        return tuple(self.records[tid * WATCH_FIELDS:(tid + 1) * WATCH_FIELDS])
+
+    def state(self, tid):
+        """任务状态：'queued' 未开始 / 'running' 运行中且未写入结果 / 'done' 已完成或结果已写入"""
+        _, _, step, _, st = self.record(tid)
+        return 'done' if st == WATCH_DONE or step == WATCH_COMMITTED else 'running' if st == WATCH_RUNNING else 'queued'
+
+    def reset(self, tid):
+        """重新提交前清空任务记录与超时标记(重试时仍受看门狗约束)"""
+        self.records[tid * WATCH_FIELDS:(tid + 1) * WATCH_FIELDS] = [0] * WATCH_FIELDS
+        self.killed.pop(tid, None)
+
+    def check(self, ids):
+        """
+        检查ids中运行中的任务：当前步骤(步骤号>=0)超过step_budget或整个任务超过task_budget时结束其worker进程
+        返回本次结束的 [(任务号, 步骤号, 超时类型 'step'/'task', 已用秒)]
+        """
+        now, killed = time.monotonic(), []
+        for tid in ids:
+            pid, t_task, step, t_step, st = self.record(tid)
+            if st != WATCH_RUNNING or step == WATCH_COMMITTED or tid in self.killed: continue
+            kind = 'step' if step >= 0 and now - t_step > self.step_budget else 'task' if now - t_task > self.task_budget else None
+            if not kind: continue
+            try: os.kill(int(pid), signal.SIGTERM) # Windows下为TerminateProcess
+            except OSError: continue
+            self.killed[tid] = (int(step), kind, now - (t_step if kind == 'step' else t_task))
+            killed.append((tid, *self.killed[tid]))
+        return killed
+
+class TaskTimeout(Exception):
+    """WatchedCall中的调用超时被结束 args: (步骤号, 超时类型 'step'/'task', 已用秒)"""
+    def __str__(self): return f"超时({self.args[2]:.0f}s)"
+
+class WatchedCall:
+    """
+    当前线程/线程池执行时的看门狗：re等C扩展执行期间不释放GIL，同进程内的计时线程无法运行，只能把该步骤交给子进程
+    每个调用线程独占一个单worker进程池(首次调用时启动 被结束后下次调用换新)，超时时结束该进程并抛出TaskTimeout
+    with语句期间通过guarded()生效，退出时关闭全部子进程
+    """
+    def __init__(self, step_budget, task_budget, initializer=None):
+        self.step_budget, self.task_budget, self.initializer = step_budget, task_budget, initializer
+        self._local, self._slots, self._lock = threading.local(), [], threading.Lock()
+
+    def __call__(self, fn, arg):
+        if not (slot := getattr(self._local, 'slot', None)):
+            watch = TaskWatch(1, self.step_budget, self.task_budget)
+            slot = self._local.slot = (watch, make_executor('process', 1, initializer=self.initializer, watch=watch))
+            with self._lock: self._slots.append(slot)
+        watch, pool = slot
+        watch.reset(0)
+        future = pool.submit(run_batch, fn, [arg], [0])
+        while not wait([future], timeout=MP_WATCH_INTERVAL).done: watch.check([0])
+        try: return future.result()[0][0]
+        except BrokenExecutor:
+            if 0 in watch.killed: raise TaskTimeout(*watch.killed[0]) from None
+            raise
+
+    def __enter__(self):
+        global _guard
+        _guard = self
+        return self
+
+    def __exit__(self, *exc):
+        global _guard
+        _guard = None
+        for _, pool in self._slots: pool.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def started(self):
+        """已启动的子进程池数"""
+        return len(self._slots)
+
+def run_stages(stages, max_workers=4):
+    """
+    按依赖关系并发执行阶段(线程池，适合自身再调度进程池/外部程序的粗粒度阶段)
+    stages: {名称: (函数, (依赖名称...))}，函数接收{名称: 结果}只读字典；依赖全部完成后立即启动
+    任一阶段异常时不再启动新阶段，等待已启动阶段结束后抛出首个异常；返回{名称: 结果}
+    """
+    results, running, pending, error = {}, {}, dict(stages), None
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage") as executor:
+        while pending or running:
+            for name in [n for n, (_, deps) in pending.items() if not error and all(d in results for d in deps)]:
+                fn, _ = pending.pop(name)
+                running[executor.submit(fn, results)] = name
+            if not running: break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try: results[name] = future.result()
+                except Exception as e: error = error or e
+    if error: raise error
+    if pending: raise RuntimeError(f"阶段依赖无法满足: {', '.join(pending)}")
+    return results